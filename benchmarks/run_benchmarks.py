@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import gc
+import subprocess
+from datetime import datetime, timezone
+try:
+    import resource
+except ImportError:    # Not available on Windows
+    resource = None
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_FOLDER, '..', 'src'))
+
+from synthetic_data import generate_dataset
+from eggnog_to_gsc import process_eggnog
+from background_cache import load_background
+from go_ontology import load_go_ontology
+from go_enrichment import build_annotation_index, enrich_batch, read_ids, write_results
+from revigo_plotting import process_file, plot_jobs, NAMESPACE_NAMES
+from barplot_generator import render_jobs
+import profiling
+
+# Number of transcripts of each size preset
+SIZES = {'small': 5000, 'medium': 100000, 'large': 1000000, 'xlarge': 5000000}
+DATA_FOLDER = os.path.join(BENCHMARKS_FOLDER, 'data')
+RESULTS_FOLDER = os.path.join(BENCHMARKS_FOLDER, 'results')
+# Relative increase of the wall time or memory of a stage reported as a regression
+THRESHOLD = 0.2
+# Smaller absolute increases are considered noise: 50 ms of wall time and 16 MB of memory
+MIN_WALL = 0.05
+MIN_MEMORY = 16 << 20
+
+
+def reset_peak_rss():
+    '''
+    Function to reset the peak resident set size of the process (Linux only), so that the peak of each stage
+    can be measured separately.
+
+    Returns:
+    - reset: Whether the peak was reset
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def memory_status(field):
+    '''
+    Function to get a memory field of /proc/self/status (e.g. 'VmRSS' or 'VmHWM', the peak since the last
+    reset_peak_rss) in bytes, or None if it is not available.
+    '''
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure(results, size, stage, function, *args, **kwargs):
+    '''
+    Function to run a stage of the benchmark and record its wall time, CPU time (of the whole process,
+    including the time of its threads, and of the worker processes that finished during the stage), peak
+    memory of the process, memory allocated by the stage ('memory', the peak minus the memory in use when
+    the stage started) and throughput.
+
+    Args:
+    - results: List where the record of the stage is appended
+    - size: Number of transcripts of the dataset
+    - stage: Name of the stage
+    - function: Function run by the stage. It must return a (value, items) tuple, where items is the number
+      of items processed (rows, transcripts, terms, candidate sets or plots).
+
+    Returns:
+    - value: Value returned by the function
+    '''
+    gc.collect()
+    start_rss = memory_status('VmRSS') if reset_peak_rss() else None
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    value, items = function(*args, **kwargs)
+    wall = time.perf_counter() - start
+    record = {'size': size, 'stage': stage, 'wall': wall, 'cpu': time.process_time() - start_cpu, 'children_cpu': None,
+              'peak_rss': None, 'memory': None, 'items': items, 'throughput': items / wall if wall > 0 else None}
+    if start_rss is not None:
+        record['peak_rss'] = memory_status('VmHWM')
+        record['memory'] = record['peak_rss'] - start_rss
+    else:
+        record['peak_rss'] = profiling.peak_rss()
+    if resource:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record['children_cpu'] = children.ru_utime + children.ru_stime - start_children.ru_utime - start_children.ru_stime
+    results.append(record)
+    print(f"  {stage:<24} {wall:9.3f} s  {(record['memory'] or 0) / 2 ** 20:9.1f} MB  {items} items")
+    return value
+
+
+def run_size(n_transcripts, args, results):
+    '''
+    Function to run every stage of the benchmark on a synthetic dataset of n_transcripts transcripts.
+    '''
+    dataset = generate_dataset(os.path.join(args.data_folder, str(n_transcripts)), n_transcripts, args.terms, args.density,
+                               args.annotated, n_groups=args.groups, candidate_fraction=args.candidate_fraction,
+                               compress=args.compress, seed=args.seed)
+    work_folder = os.path.join(args.data_folder, str(n_transcripts), 'work')
+    shutil.rmtree(work_folder, ignore_errors=True)
+    cache_folder = os.path.join(work_folder, 'cache')
+    print(f"Benchmarking {n_transcripts} transcripts:")
+
+    def parse():
+        stats = process_eggnog(dataset['annotation'], os.path.join(work_folder, 'annotation.txt'), args.workers)
+        return stats, stats['rows']
+
+    def background():
+        background = load_background(dataset['annotation'], cache_folder, memory_budget=args.memory_budget)
+        return background, len(background['transcripts'])
+
+    def ontology():
+        terms, alt_ids = load_go_ontology(dataset['obo'])
+        return (terms, alt_ids), len(terms)
+
+    def index(background, terms, alt_ids):
+        index = build_annotation_index(background, terms, alt_ids, memory_budget=args.memory_budget, spill_folder=work_folder)
+        return index, len(index['terms'])
+
+    def enrichment(index, candidate_sets, universe, conditional, permutations=0):
+        batch_results = enrich_batch(index, candidate_sets, universe, args.pvalue_cutoff, 5, conditional, permutations,
+                                     workers=args.workers)
+        return batch_results, len(candidate_sets)
+
+    def clustering(index, files):
+        outputs = [path for file_path in files for ns in NAMESPACE_NAMES for path in process_file(file_path, ns, index)]
+        return outputs, len(files) * len(NAMESPACE_NAMES)
+
+    def plotting(files):
+        jobs = [job for file_path in files for job in plot_jobs(file_path, work_folder)]
+        return render_jobs(jobs, workers=args.workers), len(jobs)
+
+    os.makedirs(work_folder, exist_ok=True)
+    measure(results, n_transcripts, 'parse_annotation', parse)
+    measure(results, n_transcripts, 'load_background_cold', background)
+    background_arrays = measure(results, n_transcripts, 'load_background_warm', background)
+    terms, alt_ids = measure(results, n_transcripts, 'load_ontology', ontology)
+    annotation_index = measure(results, n_transcripts, 'build_index', index, background_arrays, terms, alt_ids)
+
+    # Every group has its own universe, as in the data folder, and is tested in its own batch
+    batches = [({candidates: read_ids(candidates)}, read_ids(universe))
+               for candidates, universe in zip(dataset['candidates'], dataset['universe'])]
+    classic = {}
+    stages = [('enrichment', False, 0), ('enrichment_conditional', True, 0)]
+    if args.permutations:
+        stages.append(('enrichment_permutations', False, args.permutations))
+    for stage, conditional, permutations in stages:
+        def enrich_all():
+            batch_results = {}
+            for candidate_sets, universe in batches:
+                batch_results.update(enrichment(annotation_index, candidate_sets, universe, conditional, permutations)[0])
+            return batch_results, len(batch_results)
+        batch_results = measure(results, n_transcripts, stage, enrich_all)
+        if stage == 'enrichment':
+            classic = batch_results
+
+    files = []
+    for candidates, result in classic.items():
+        output_txt = write_results(result, candidates, os.path.join(work_folder, 'results'), args.pvalue_cutoff)
+        if output_txt is not None:
+            files.append(output_txt)
+    if not files:
+        print("  No enriched terms, the clustering and plotting stages are skipped")
+        return
+    measure(results, n_transcripts, 'term_clustering', clustering, annotation_index, files)
+    if not args.skip_plots:
+        measure(results, n_transcripts, 'plotting', plotting, files)
+
+
+def git_commit():
+    '''
+    Function to get the current git commit of the repository and whether the working tree has changes.
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_FOLDER, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCHMARKS_FOLDER,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def run_benchmarks(args):
+    '''
+    Function to run the benchmark for every requested size and save the results in a JSON file named after
+    the date and the git commit, to compare them across commits with compare_results. With args.repeat > 1,
+    the record of the fastest run of each stage is kept, with the wall times of every run in 'runs' and the
+    highest memory of the runs (later runs reuse memory already obtained by the process).
+
+    Returns:
+    - results_path: Path to the JSON file with the results
+    '''
+    commit, dirty = git_commit()
+    results = []
+    for size in args.sizes:
+        runs = []
+        for _ in range(args.repeat):
+            runs.append([])
+            run_size(SIZES[size] if size in SIZES else int(size), args, runs[-1])
+        # The fastest run of each stage is kept, as it is the least affected by other processes of the machine
+        for records in zip(*runs):
+            record = dict(min(records, key=lambda record: record['wall']), runs=[record['wall'] for record in records])
+            if record['memory'] is not None:
+                record['memory'] = max(record['memory'] for record in records)
+            results.append(record)
+
+    report = {'commit': commit, 'dirty': dirty, 'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+              'config': {key: value for key, value in vars(args).items() if key not in ['command', 'data_folder', 'results_folder']},
+              'results': results}
+    os.makedirs(args.results_folder, exist_ok=True)
+    results_path = os.path.join(args.results_folder, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{commit or 'nogit'}.json")
+    with open(results_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Benchmark results written to {results_path}")
+    return results_path
+
+
+def compare_results(baseline_path, current_path, threshold=THRESHOLD):
+    '''
+    Function to compare two benchmark results files, stage by stage, and report the stages whose wall time
+    or memory increased by more than threshold (and by more than MIN_WALL or MIN_MEMORY, below which the
+    differences are noise). Only the stages measured in both files are compared.
+
+    Args:
+    - baseline_path: Path to the results of the reference commit
+    - current_path: Path to the results to check
+    - threshold: Relative increase reported as a regression. By default, 0.2 (20%).
+
+    Returns:
+    - regressions: List of (size, stage, metric, ratio) tuples
+    '''
+    with open(baseline_path, 'r') as file:
+        baseline = json.load(file)
+    with open(current_path, 'r') as file:
+        current = json.load(file)
+    print(f"Comparing {current['commit']} ({current['date']}) with {baseline['commit']} ({baseline['date']})")
+    if baseline['cpus'] != current['cpus'] or baseline['platform'] != current['platform']:
+        print("Warning: the results were obtained on different machines")
+
+    reference = {(record['size'], record['stage']): record for record in baseline['results']}
+    regressions = []
+    print(f"{'size':>9} {'stage':<24} {'wall':>10} {'ratio':>7} {'memory MB':>10} {'ratio':>7}")
+    for record in current['results']:
+        key = (record['size'], record['stage'])
+        if key not in reference:
+            continue
+        ratios = {}
+        for metric, noise in [('wall', MIN_WALL), ('memory', MIN_MEMORY)]:
+            if record.get(metric) is None or reference[key].get(metric) is None:
+                continue
+            ratios[metric] = record[metric] / max(reference[key][metric], 1e-9)
+            if ratios[metric] > 1 + threshold and record[metric] - reference[key][metric] > noise:
+                regressions.append((record['size'], record['stage'], metric, ratios[metric]))
+        print(f"{record['size']:>9} {record['stage']:<24} {record['wall']:9.3f}s {ratios.get('wall', float('nan')):6.2f}x "
+              f"{(record.get('memory') or 0) / 2 ** 20:10.1f} {ratios.get('memory', float('nan')):6.2f}x")
+
+    for size, stage, metric, ratio in regressions:
+        print(f"Regression: {stage} with {size} transcripts, {metric} is {ratio:.2f} times the baseline")
+    if not regressions:
+        print(f"No regression above {threshold:.0%}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the enrichment pipeline on synthetic data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmark and save the results')
+    run_parser.add_argument('sizes', nargs='*', default=['small', 'medium'],
+                            help=f"Size presets ({', '.join(f'{name}: {size}' for name, size in SIZES.items())}) or numbers of transcripts. By default, small and medium.")
+    run_parser.add_argument('--terms', type=int, default=10000, help='Number of GO terms of the synthetic ontology. By default, 10000.')
+    run_parser.add_argument('--density', type=float, default=4.0, help='Mean number of GO terms per annotated transcript. By default, 4.')
+    run_parser.add_argument('--annotated', type=float, default=0.6, help='Fraction of annotated transcripts. By default, 0.6.')
+    run_parser.add_argument('--groups', type=int, default=4, help='Number of candidate sets. By default, 4.')
+    run_parser.add_argument('--candidate-fraction', type=float, default=0.02, help='Size of the candidate sets relative to the universe. By default, 0.02.')
+    run_parser.add_argument('--compress', choices=['gz', 'zst'], default=None, help='Compress the annotation file')
+    run_parser.add_argument('--pvalue-cutoff', type=float, default=0.01, help='P-value cutoff of the enrichment. By default, 0.01.')
+    run_parser.add_argument('--permutations', type=int, default=1000, help='Number of permutations of the empirical p-values stage (0 to skip it). By default, 1000.')
+    run_parser.add_argument('--workers', type=int, default=None, help='Number of processes. By default, the number of CPUs.')
+    run_parser.add_argument('--repeat', type=int, default=1, help='Number of runs of each size, the fastest is kept. By default, 1.')
+    run_parser.add_argument('--memory-budget', type=float, default=None,
+                            help='Memory budget in MB to build the background and the index out of core. By default, in memory.')
+    run_parser.add_argument('--skip-plots', action='store_true', help='Do not benchmark the plots')
+    run_parser.add_argument('--seed', type=int, default=1, help='Random seed of the synthetic data. By default, 1.')
+    run_parser.add_argument('--data-folder', default=DATA_FOLDER, help='Folder of the synthetic datasets')
+    run_parser.add_argument('--results-folder', default=RESULTS_FOLDER, help='Folder where the results are saved')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two results files')
+    compare_parser.add_argument('baseline', help='Results of the reference commit')
+    compare_parser.add_argument('current', help='Results to check')
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD, help='Relative increase reported as a regression. By default, 0.2.')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_benchmarks(args)
+    else:
+        sys.exit(1 if compare_results(args.baseline, args.current, args.threshold) else 0)
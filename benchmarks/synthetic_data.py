@@ -0,0 +1,200 @@
+import os
+import sys
+import gzip
+import json
+import argparse
+import numpy as np
+
+NAMESPACES = ['biological_process', 'molecular_function', 'cellular_component']
+ROOTS = {'biological_process': 'GO:0008150', 'molecular_function': 'GO:0003674', 'cellular_component': 'GO:0005575'}
+
+EMAPPER_COLUMNS = ['query', 'seed_ortholog', 'evalue', 'score', 'eggNOG_OGs', 'max_annot_lvl', 'COG_category', 'Description',
+                   'Preferred_name', 'GOs', 'EC', 'KEGG_ko', 'KEGG_Pathway', 'KEGG_Module', 'KEGG_Reaction', 'KEGG_rclass',
+                   'BRITE', 'KEGG_TC', 'CAZy', 'BiGG_Reaction', 'PFAMs']
+
+
+def synthetic_go_id(number):
+    return f'GO:{1000000 + number:07d}'
+
+
+def write_ontology(obo_path, n_terms, rng):
+    '''
+    Function to write a synthetic go-basic.obo file. Every term gets an is_a parent chosen among the previous
+    terms of its namespace, and about a third of them a second part_of parent, which gives a DAG with the
+    depth (logarithmic in the number of terms) and multiple inheritance of the real GO.
+
+    Args:
+    - obo_path: Path to the OBO file
+    - n_terms: Number of terms, besides the three roots
+    - rng: numpy random Generator
+
+    Returns:
+    - terms: List of (GO ID, namespace index) tuples, without the roots
+    '''
+    namespace = np.arange(n_terms) % 3
+    terms = []
+    previous = [[ROOTS[ns]] for ns in NAMESPACES]
+    with open(obo_path, 'w') as file:
+        file.write('format-version: 1.2\ndata-version: synthetic\n\n')
+        for ns in NAMESPACES:
+            file.write(f'[Term]\nid: {ROOTS[ns]}\nname: {ns}\nnamespace: {ns}\n\n')
+        for number in range(n_terms):
+            ns = namespace[number]
+            go_id = synthetic_go_id(number)
+            candidates = previous[ns]
+            file.write(f'[Term]\nid: {go_id}\nname: synthetic term {number} of {NAMESPACES[ns]}\nnamespace: {NAMESPACES[ns]}\n')
+            file.write(f'is_a: {candidates[rng.integers(len(candidates))]} ! parent\n')
+            if len(candidates) > 1 and rng.random() < 0.3:
+                file.write(f'relationship: part_of {candidates[rng.integers(len(candidates))]} ! part\n')
+            file.write('\n')
+            candidates.append(go_id)
+            terms.append((go_id, ns))
+        file.write('[Typedef]\nid: part_of\nname: part of\n')
+    return terms
+
+
+def transcript_ids(n_transcripts, rng):
+    '''
+    Function to create Trinity-style transcript IDs, with one to three isoforms per gene.
+    '''
+    isoforms = rng.integers(1, 4, size=n_transcripts)
+    genes = np.repeat(np.arange(n_transcripts), isoforms)[:n_transcripts]
+    isoform = np.arange(n_transcripts) - np.searchsorted(genes, genes) + 1
+    return [f'TRINITY_DN{gene}_c0_g1_i{i}' for gene, i in zip(genes, isoform)], genes
+
+
+def generate_dataset(output_folder, n_transcripts=10000, n_terms=5000, density=4.0, annotated=0.6, universe=0.8,
+                     n_groups=4, candidate_fraction=0.02, compress=None, seed=1):
+    '''
+    Function to generate a synthetic dataset: a GO ontology, an eggNOG-mapper annotation file, and the
+    universe and candidates files of several groups.
+
+    GO terms are assigned with a skewed (Zipf-like) popularity, the isoforms of a gene share their
+    annotation, and each candidate set is enriched in a few target terms so that the enrichment, the term
+    clustering and the plots have realistic amounts of work.
+
+    Args:
+    - output_folder: Folder where the dataset is written, with the same layout as the data folder
+    - n_transcripts: Number of transcripts. By default, 10000.
+    - n_terms: Number of GO terms of the ontology. By default, 5000.
+    - density: Mean number of GO terms per annotated transcript. By default, 4.
+    - annotated: Fraction of transcripts with GO terms. By default, 0.6.
+    - universe: Fraction of transcripts in the universe of each group. By default, 0.8.
+    - n_groups: Number of groups (candidates and universe files). By default, 4.
+    - candidate_fraction: Size of each candidate set, as a fraction of the universe. By default, 0.02.
+    - compress: None, 'gz' or 'zst' to compress the annotation file. By default, None.
+    - seed: Random seed. By default, 1.
+
+    Returns:
+    - dataset: Dictionary with the paths of the 'obo', 'annotation', 'candidates' and 'universe' files
+      (the last two are lists) and the generation 'config'
+    '''
+    config = {'n_transcripts': n_transcripts, 'n_terms': n_terms, 'density': density, 'annotated': annotated,
+              'universe': universe, 'n_groups': n_groups, 'candidate_fraction': candidate_fraction,
+              'compress': compress, 'seed': seed}
+    config_path = os.path.join(output_folder, 'dataset.json')
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as file:
+            dataset = json.load(file)
+        if dataset['config'] == config:
+            print(f"Using the synthetic dataset in {output_folder}")
+            return dataset
+
+    print(f"Generating a synthetic dataset of {n_transcripts} transcripts in {output_folder}...")
+    rng = np.random.default_rng(seed)
+    for folder in ['ontology', 'annotation', 'candidates', 'universe']:
+        os.makedirs(os.path.join(output_folder, folder), exist_ok=True)
+
+    obo_path = os.path.join(output_folder, 'ontology', 'go-basic.obo')
+    terms = write_ontology(obo_path, n_terms, rng)
+    go_ids = np.array([go_id for go_id, _ in terms])
+    popularity = 1 / (1 + rng.permutation(len(go_ids))) ** 0.8
+    popularity /= popularity.sum()
+
+    transcripts, genes = transcript_ids(n_transcripts, rng)
+    n_genes = genes[-1] + 1 if n_transcripts else 0
+    gene_annotated = rng.random(n_genes) < annotated
+    gene_sizes = np.where(gene_annotated, 1 + rng.poisson(max(density - 1, 0), size=n_genes), 0)
+    gene_offsets = np.concatenate([[0], np.cumsum(gene_sizes)])
+    gene_terms = rng.choice(len(go_ids), size=int(gene_offsets[-1]), p=popularity)
+
+    annotation_path = os.path.join(output_folder, 'annotation', 'synthetic.emapper.annotations')
+    if compress:
+        annotation_path += f'.{compress}'
+    if compress == 'gz':
+        out = gzip.open(annotation_path, 'wt')
+    elif compress == 'zst':
+        import zstandard
+        out = zstandard.open(annotation_path, 'wt')
+    else:
+        out = open(annotation_path, 'w')
+
+    with out:
+        out.write('## emapper-2.1.12\n## synthetic annotation generated by benchmarks/synthetic_data.py\n##\n')
+        out.write('#' + '\t'.join(EMAPPER_COLUMNS) + '\n')
+        chunk = 100000
+        for start in range(0, n_transcripts, chunk):
+            lines = []
+            for transcript, gene in zip(transcripts[start:start + chunk], genes[start:start + chunk]):
+                annotation = gene_terms[gene_offsets[gene]:gene_offsets[gene + 1]]
+                if len(annotation):
+                    gos = ','.join(go_ids[np.unique(annotation)])
+                    ko = f'ko:K{gene % 20000:05d}'
+                    pathway = f'map{gene % 400:05d},ko{gene % 400:05d}'
+                    ec = f'{gene % 6 + 1}.{gene % 4 + 1}.1.{gene % 50 + 1}' if gene % 3 == 0 else '-'
+                    pfam = f'PF{gene % 3000:05d}'
+                    lines.append(f'{transcript}\t{gene}.seed\t1e-30\t120.5\tOG{gene % 5000}@2759\tEukaryota\tS\tsynthetic protein\t-\t'
+                                 f'{gos}\t{ec}\t{ko}\t{pathway}\t-\t-\t-\t-\t-\t-\t-\t{pfam}\n')
+                else:
+                    lines.append(f'{transcript}\t{gene}.seed\t1e-10\t50.0\tOG{gene % 5000}@2759\tEukaryota\tS\t-\t-\t'
+                                 '-\t-\t-\t-\t-\t-\t-\t-\t-\t-\t-\t-\n')
+            out.write(''.join(lines))
+        out.write('## Total time (seconds): 0\n')
+
+    # Transcripts annotated with each term, to build candidate sets enriched in a few target terms
+    term_transcripts = np.repeat(np.arange(n_genes), gene_sizes)
+    dataset = {'obo': obo_path, 'annotation': annotation_path, 'candidates': [], 'universe': [], 'config': config}
+    transcripts = np.array(transcripts)
+    for group in range(n_groups):
+        name = f'group{group:03d}'
+        universe_ids = rng.choice(n_transcripts, size=int(n_transcripts * universe), replace=False)
+        in_universe = np.zeros(n_transcripts, dtype=bool)
+        in_universe[universe_ids] = True
+        size = max(int(len(universe_ids) * candidate_fraction), 10)
+
+        targets = rng.choice(len(go_ids), size=3, replace=False)
+        target_genes = term_transcripts[np.isin(gene_terms, targets)]
+        enriched = np.flatnonzero(np.isin(genes, target_genes) & in_universe)
+        enriched = rng.permutation(enriched)[:size // 3]
+        rest = rng.choice(universe_ids, size=size - len(enriched), replace=False)
+        candidates = np.unique(np.concatenate([enriched, rest]))
+
+        universe_path = os.path.join(output_folder, 'universe', f'{name}.universe.txt')
+        candidates_path = os.path.join(output_folder, 'candidates', f'{name}.candidates.txt')
+        with open(universe_path, 'w') as file:
+            file.write('\n'.join(transcripts[np.sort(universe_ids)]) + '\n')
+        with open(candidates_path, 'w') as file:
+            file.write('\n'.join(transcripts[candidates]) + '\n')
+        dataset['universe'].append(universe_path)
+        dataset['candidates'].append(candidates_path)
+
+    with open(config_path, 'w') as file:
+        json.dump(dataset, file, indent=2)
+    return dataset
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic ontology, eggNOG-mapper annotation, universes and candidates')
+    parser.add_argument('output_folder', help='Folder where the dataset is written')
+    parser.add_argument('--transcripts', type=int, default=10000, help='Number of transcripts. By default, 10000.')
+    parser.add_argument('--terms', type=int, default=5000, help='Number of GO terms. By default, 5000.')
+    parser.add_argument('--density', type=float, default=4.0, help='Mean number of GO terms per annotated transcript. By default, 4.')
+    parser.add_argument('--annotated', type=float, default=0.6, help='Fraction of annotated transcripts. By default, 0.6.')
+    parser.add_argument('--groups', type=int, default=4, help='Number of groups. By default, 4.')
+    parser.add_argument('--candidate-fraction', type=float, default=0.02, help='Size of the candidate sets relative to the universe. By default, 0.02.')
+    parser.add_argument('--compress', choices=['gz', 'zst'], default=None, help='Compress the annotation file')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed. By default, 1.')
+    args = parser.parse_args()
+    generate_dataset(args.output_folder, args.transcripts, args.terms, args.density, args.annotated, n_groups=args.groups,
+                     candidate_fraction=args.candidate_fraction, compress=args.compress, seed=args.seed)
+    sys.exit(0)
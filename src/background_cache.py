@@ -0,0 +1,466 @@
+import os
+import csv
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from eggnog_to_gsc import VOCABULARIES, process_eggnog
+import profiling
+
+CACHE_FOLDER = 'data/annotation/cache'
+# Maximum number of backgrounds kept in the cache, the least recently used ones are evicted first
+MAX_ENTRIES = 8
+
+# Serializes the manifest updates of the backgrounds loaded concurrently by the same process
+MANIFEST_LOCK = threading.Lock()
+
+MAGIC = b'NMGOBGC1'
+ALIGNMENT = 64
+# Arrays are written in slices of this size, so memory-mapped (spilled) arrays are never loaded at once
+WRITE_BLOCK = 1 << 24
+# Approximate memory used by every annotation pair while the background is built in chunks: the pandas
+# parser buffers of the line and the codes, global codes and sort keys derived from it
+PAIR_BYTES = 160
+
+
+def write_arrays(file_path, arrays):
+    '''
+    Function to write several numpy arrays into a single memory-mappable binary file.
+
+    The file starts with a magic string, the length of a JSON header and the header itself, which stores
+    the dtype, shape and offset of every array. Arrays are aligned to 64 bytes and written in slices, so
+    memory-mapped arrays are copied without loading them. The file is written to a temporary path first and
+    then moved into place, so readers never see a partial file.
+
+    Args:
+    - file_path: Path to the output file
+    - arrays: Dictionary with array names as keys and numpy arrays as values
+    '''
+    header = {}
+    offset = 0
+    for name, array in arrays.items():
+        header[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(len(header_bytes).to_bytes(8, 'little'))
+        file.write(header_bytes)
+        for name, array in arrays.items():
+            file.seek(data_start + header[name]['offset'])
+            flat = array.reshape(-1)
+            step = max(WRITE_BLOCK // max(array.itemsize, 1), 1)
+            for start in range(0, len(flat), step):
+                file.write(np.ascontiguousarray(flat[start:start + step]).tobytes())
+        file.truncate(data_start + offset)
+    os.replace(tmp_path, file_path)
+
+
+def read_arrays(file_path):
+    '''
+    Function to memory-map the arrays of a file written by write_arrays.
+
+    Args:
+    - file_path: Path to the binary file
+
+    Returns:
+    - arrays: Dictionary with array names as keys and read-only memory-mapped arrays as values
+    '''
+    with open(file_path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file_path} is not a background cache file")
+        header_length = int.from_bytes(file.read(8), 'little')
+        header = json.loads(file.read(header_length))
+    data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+    arrays = {}
+    for name, info in header.items():
+        shape = tuple(info['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=info['dtype'])
+        else:
+            arrays[name] = np.memmap(file_path, dtype=info['dtype'], mode='r', offset=data_start + info['offset'], shape=shape)
+    return arrays
+
+
+def file_digest(file_path, manifest=None):
+    '''
+    Function to compute the SHA-256 digest of a file. If the file size and modification time match the
+    ones recorded in the manifest, the recorded digest is reused instead of reading the file again.
+
+    Args:
+    - file_path: Path to the file
+    - manifest: Dictionary with the cache manifest, as read by read_manifest
+
+    Returns:
+    - digest: Hexadecimal SHA-256 digest of the file content
+    '''
+    stat = os.stat(file_path)
+    known = (manifest or {}).get('sources', {}).get(os.path.abspath(file_path))
+    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+        return known['digest']
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    profiling.count('hashed_bytes', stat.st_size)
+    return sha.hexdigest()
+
+
+def read_manifest(cache_folder):
+    manifest_path = os.path.join(cache_folder, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as file:
+            return json.load(file)
+    return {'sources': {}}
+
+
+def write_manifest(cache_folder, manifest):
+    manifest_path = os.path.join(cache_folder, 'manifest.json')
+    tmp_path = f"{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def compact_annotation(transcripts, terms, rows, columns):
+    '''
+    Function to encode (transcript, term) pairs as a compact background: the annotated transcripts and
+    their terms are interned as sorted fixed-width byte arrays, and the annotation is stored as CSR arrays,
+    where the term codes of transcript i are indices[indptr[i]:indptr[i + 1]]. Repeated pairs are removed.
+
+    Args:
+    - transcripts: Array of transcript IDs
+    - terms: Array of term IDs
+    - rows: Array with the position in transcripts of every pair
+    - columns: Array with the position in terms of every pair
+
+    Returns:
+    - background: Dictionary with 'transcripts', 'terms', 'indptr' and 'indices' arrays
+    '''
+    # Intern the IDs in sorted order so that they can be looked up with a binary search
+    used_transcripts, used_terms = np.unique(rows), np.unique(columns)
+    transcript_order = used_transcripts[np.argsort(transcripts[used_transcripts])]
+    term_order = used_terms[np.argsort(terms[used_terms])]
+    transcript_rank = np.empty(len(transcripts), dtype=np.int64)
+    transcript_rank[transcript_order] = np.arange(len(transcript_order))
+    term_rank = np.empty(len(terms), dtype=np.int32)
+    term_rank[term_order] = np.arange(len(term_order))
+
+    rows, columns = transcript_rank[rows], term_rank[columns]
+    order = np.lexsort((columns, rows))
+    rows, columns = rows[order], columns[order]
+    keep = np.ones(len(rows), dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
+    rows, columns = rows[keep], columns[keep]
+
+    indptr = np.zeros(len(transcript_order) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(transcript_order)), out=indptr[1:])
+    return {'transcripts': np.char.encode(transcripts[transcript_order]) if len(transcript_order) else np.zeros(0, dtype='S1'),
+            'terms': np.char.encode(terms[term_order]) if len(term_order) else np.zeros(0, dtype='S1'),
+            'indptr': indptr,
+            'indices': columns.astype(np.int32)}
+
+
+def budget_rows(memory_budget, bytes_per_row):
+    '''
+    Function to get the number of rows (e.g. annotation pairs) processed at once within a memory budget.
+
+    Args:
+    - memory_budget: Memory budget in MB
+    - bytes_per_row: Approximate memory used by every row
+
+    Returns:
+    - rows: Number of rows, at least 1024
+    '''
+    return max(int(memory_budget * (1 << 20) // bytes_per_row), 1024)
+
+
+def spill_annotation(background_txt, spill_folder, chunk_rows):
+    '''
+    Function to build the compact backgrounds of every vocabulary of a background file (see compact_annotation)
+    with bounded memory, giving the same arrays as build_background.
+
+    The file is read in chunks of chunk_rows pairs with categorical columns, and the integer codes of the pairs
+    of every chunk are spilled to disk, one file per vocabulary. The pairs of each vocabulary are then
+    distributed into buckets of consecutive transcripts with about chunk_rows pairs, and every bucket is sorted
+    and deduplicated on its own. Only one chunk or bucket is in memory at a time, besides the sorted tables of
+    transcript and term IDs and the number of pairs of every transcript.
+
+    Args:
+    - background_txt: Background file written by eggnog_to_gsc.process_eggnog
+    - spill_folder: Folder of the temporary files
+    - chunk_rows: Number of pairs processed at once
+
+    Returns:
+    - arrays: Dictionary with the arrays of build_background, where the indices are memory-mapped from files of
+      spill_folder
+    '''
+    vocabularies = list(VOCABULARIES)
+    chunk_files, transcript_tables, term_tables = [], [], []
+    reader = pd.read_csv(background_txt, sep='\t', header=None, usecols=[0, 2, 3], names=['Term', 'Transcript', 'Vocabulary'],
+                         dtype='category', na_filter=False, quoting=csv.QUOTE_NONE, chunksize=chunk_rows)
+    for number, pairs in enumerate(reader):
+        vocabulary_codes = np.array([vocabularies.index(vocabulary) for vocabulary in pairs['Vocabulary'].cat.categories], dtype=np.int8)
+        chunk = {'transcripts': np.char.encode(pairs['Transcript'].cat.categories.to_numpy(dtype=str)),
+                 'terms': np.char.encode(pairs['Term'].cat.categories.to_numpy(dtype=str)),
+                 'rows': pairs['Transcript'].cat.codes.to_numpy().astype(np.int32),
+                 'columns': pairs['Term'].cat.codes.to_numpy().astype(np.int32),
+                 'vocabularies': vocabulary_codes[pairs['Vocabulary'].cat.codes.to_numpy()]}
+        chunk_files.append(os.path.join(spill_folder, f'chunk_{number}.bgc'))
+        write_arrays(chunk_files[-1], chunk)
+        transcript_tables.append(chunk['transcripts'])
+        term_tables.append(chunk['terms'])
+        del pairs, chunk
+    transcripts = np.unique(np.concatenate(transcript_tables)) if transcript_tables else np.zeros(0, dtype='S1')
+    terms = np.unique(np.concatenate(term_tables)) if term_tables else np.zeros(0, dtype='S1')
+    del transcript_tables, term_tables
+
+    # Global codes of the pairs of every vocabulary, and the number of pairs of every transcript
+    row_counts = np.zeros((len(vocabularies), len(transcripts)), dtype=np.int32)
+    used_terms = np.zeros((len(vocabularies), len(terms)), dtype=bool)
+    for chunk_file in chunk_files:
+        chunk = read_arrays(chunk_file)
+        rows = np.searchsorted(transcripts, chunk['transcripts']).astype(np.int32)[chunk['rows']]
+        columns = np.searchsorted(terms, chunk['terms']).astype(np.int32)[chunk['columns']]
+        for code, vocabulary in enumerate(vocabularies):
+            selected = np.asarray(chunk['vocabularies']) == code
+            if not selected.any():
+                continue
+            chunk_rows_found, counts = np.unique(rows[selected], return_counts=True)
+            row_counts[code, chunk_rows_found] += counts.astype(np.int32)
+            used_terms[code, columns[selected]] = True
+            with open(os.path.join(spill_folder, f'{vocabulary}.pairs'), 'ab') as file:
+                file.write(np.stack([rows[selected], columns[selected]], axis=1).tobytes())
+        del chunk
+        os.remove(chunk_file)
+
+    arrays = {}
+    for code, vocabulary in enumerate(vocabularies):
+        prefix = '' if vocabulary == 'GO' else f'{vocabulary}/'
+        pairs_file = os.path.join(spill_folder, f'{vocabulary}.pairs')
+        vocabulary_rows = np.flatnonzero(row_counts[code])
+        vocabulary_terms = np.flatnonzero(used_terms[code])
+        if len(vocabulary_rows) == 0:
+            arrays.update({prefix + 'transcripts': np.zeros(0, dtype='S1'), prefix + 'terms': np.zeros(0, dtype='S1'),
+                           prefix + 'indptr': np.zeros(1, dtype=np.int64), prefix + 'indices': np.zeros(0, dtype=np.int32)})
+            continue
+
+        # Buckets of consecutive transcripts with about chunk_rows pairs
+        cumulative = np.cumsum(row_counts[code, vocabulary_rows], dtype=np.int64)
+        bounds = np.unique(np.concatenate([[0], np.searchsorted(cumulative, np.arange(chunk_rows, cumulative[-1], chunk_rows), side='right'),
+                                           [len(vocabulary_rows)]]))
+        pairs = np.memmap(pairs_file, dtype=np.int32, mode='r').reshape(-1, 2)
+        for start in range(0, len(pairs), chunk_rows):
+            block = np.asarray(pairs[start:start + chunk_rows])
+            block = np.stack([np.searchsorted(vocabulary_rows, block[:, 0]), np.searchsorted(vocabulary_terms, block[:, 1])],
+                             axis=1).astype(np.int32)
+            buckets = np.searchsorted(bounds, block[:, 0], side='right') - 1
+            order = np.argsort(buckets, kind='stable')
+            block, buckets = block[order], buckets[order]
+            edges = np.searchsorted(buckets, np.arange(len(bounds)))
+            for bucket in np.unique(buckets):
+                with open(os.path.join(spill_folder, f'{vocabulary}_{bucket}.pairs'), 'ab') as file:
+                    file.write(block[edges[bucket]:edges[bucket + 1]].tobytes())
+        del pairs
+        os.remove(pairs_file)
+
+        indices_file = os.path.join(spill_folder, f'{vocabulary}.indices')
+        row_nnz = np.zeros(len(vocabulary_rows), dtype=np.int64)
+        with open(indices_file, 'wb') as indices:
+            for bucket in range(len(bounds) - 1):
+                bucket_file = os.path.join(spill_folder, f'{vocabulary}_{bucket}.pairs')
+                block = np.fromfile(bucket_file, dtype=np.int32).reshape(-1, 2)
+                os.remove(bucket_file)
+                rows, columns = block[:, 0], block[:, 1]
+                order = np.lexsort((columns, rows))
+                rows, columns = rows[order], columns[order]
+                keep = np.ones(len(rows), dtype=bool)
+                keep[1:] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
+                indices.write(columns[keep].tobytes())
+                row_nnz[bounds[bucket]:bounds[bucket + 1]] = np.bincount(rows[keep] - bounds[bucket], minlength=bounds[bucket + 1] - bounds[bucket])
+
+        indptr = np.zeros(len(vocabulary_rows) + 1, dtype=np.int64)
+        np.cumsum(row_nnz, out=indptr[1:])
+        # The IDs of a vocabulary are stored with their own width, as in compact_annotation
+        vocabulary_ids = [table[used].astype(f'S{max(int(np.char.str_len(table[used]).max()), 1)}')
+                          for table, used in ((transcripts, vocabulary_rows), (terms, vocabulary_terms))]
+        arrays.update({prefix + 'transcripts': vocabulary_ids[0], prefix + 'terms': vocabulary_ids[1],
+                       prefix + 'indptr': indptr, prefix + 'indices': np.memmap(indices_file, dtype=np.int32, mode='r')})
+    return arrays
+
+
+def build_background(annotation_file, cache_file, memory_budget=None):
+    '''
+    Function to parse an eggNOG-mapper file and store its background in the binary cache format.
+
+    Every vocabulary of eggnog_to_gsc.VOCABULARIES is read in the same pass and stored as its own compact
+    background (see compact_annotation), so one cache entry serves the enrichment of all of them. The GO
+    arrays are stored with their plain names, and the arrays of the other vocabularies are prefixed with
+    the vocabulary name (e.g. 'KEGG_Pathway/indptr').
+
+    Args:
+    - annotation_file: Path to the eggNOG-mapper file
+    - cache_file: Path to the cache file to create
+    - memory_budget: Memory budget in MB. If given, the annotation pairs are processed in chunks spilled to
+      the cache folder (see spill_annotation), so the memory does not depend on the size of the annotation
+      file. By default, None (all the pairs are loaded at once).
+    '''
+    cache_folder = os.path.dirname(cache_file)
+    fd, background_txt = tempfile.mkstemp(suffix='.background.txt', dir=cache_folder)
+    os.close(fd)
+    spill_folder, arrays = None, None
+    try:
+        # In a pipeline run, the parser uses the free processes of the worker budget (see eggnog_to_gsc.process_eggnog)
+        with profiling.stage('parse_annotation', file=os.path.basename(annotation_file)) as metrics:
+            if memory_budget:
+                # Blocks of the parser in flight (two per worker, at most one worker per CPU) and their output
+                # stay within the budget
+                chunk_size = min(32 << 20, max(int(memory_budget * (1 << 20)) // (8 * (os.cpu_count() or 1)), 1 << 20))
+                metrics['items'] = process_eggnog(annotation_file, background_txt, chunk_size=chunk_size)['rows']
+            else:
+                metrics['items'] = process_eggnog(annotation_file, background_txt)['rows']
+        if os.path.getsize(background_txt) == 0:
+            raise ValueError(f"No GO annotations found in {annotation_file}")
+        if memory_budget:
+            spill_folder = tempfile.mkdtemp(suffix='.spill', dir=cache_folder)
+            with profiling.stage('spill_annotation', file=os.path.basename(annotation_file)):
+                arrays = spill_annotation(background_txt, spill_folder, budget_rows(memory_budget, PAIR_BYTES))
+        else:
+            # Term IDs such as Pfam names are read as they are, without NA values or quotes
+            pairs = pd.read_csv(background_txt, sep='\t', header=None, usecols=[0, 2, 3], names=['Term', 'Transcript', 'Vocabulary'],
+                                dtype='category', na_filter=False, quoting=csv.QUOTE_NONE)
+    finally:
+        os.remove(background_txt)
+
+    try:
+        if arrays is None:
+            transcripts = pairs['Transcript'].cat.categories.to_numpy(dtype=str)
+            terms = pairs['Term'].cat.categories.to_numpy(dtype=str)
+            rows, columns = pairs['Transcript'].cat.codes.to_numpy(), pairs['Term'].cat.codes.to_numpy()
+            vocabularies = pairs['Vocabulary'].cat.codes.to_numpy()
+            arrays = {}
+            for vocabulary in VOCABULARIES:
+                code = pairs['Vocabulary'].cat.categories.get_indexer([vocabulary])[0]
+                selected = vocabularies == code
+                prefix = '' if vocabulary == 'GO' else f'{vocabulary}/'
+                for name, array in compact_annotation(transcripts, terms, rows[selected], columns[selected]).items():
+                    arrays[prefix + name] = array
+        if len(arrays['indices']) == 0:
+            raise ValueError(f"No GO annotations found in {annotation_file}")
+        write_arrays(cache_file, arrays)
+    finally:
+        if spill_folder is not None:
+            # The spilled indices are memory-mapped until the entry is written
+            arrays = None
+            shutil.rmtree(spill_folder, ignore_errors=True)
+
+
+def load_background(annotation_file, cache_folder=CACHE_FOLDER, max_entries=MAX_ENTRIES, vocabulary='GO', read_only=False,
+                    memory_budget=None):
+    '''
+    Function to load the background of an eggNOG-mapper file from the content-addressed cache,
+    building the cache entry first if the file has not been processed before.
+
+    Entries are named after the SHA-256 digest of the annotation file. When an annotation file changes,
+    the entry of its previous content is evicted, and only the max_entries most recently used entries are kept.
+    Several backgrounds can be loaded at the same time from different threads.
+
+    Args:
+    - annotation_file: Path to the eggNOG-mapper file
+    - cache_folder: Folder where the cache entries are stored. By default, 'data/annotation/cache'.
+    - max_entries: Maximum number of entries kept in the cache. By default, 8.
+    - vocabulary: Vocabulary of the background, one of eggnog_to_gsc.VOCABULARIES. By default, 'GO'.
+    - read_only: Whether to leave the manifest and the other entries untouched, e.g. when many nodes share
+      the cache folder (see shards.py). A missing entry is still built, since entries are written
+      atomically. By default, False.
+    - memory_budget: Memory budget in MB used to build a missing entry (see build_background). By default, None.
+
+    Returns:
+    - background: Dictionary with memory-mapped arrays 'transcripts' and 'terms' (sorted byte strings),
+      'indptr' and 'indices' (CSR transcript-to-term annotation)
+    '''
+    if vocabulary not in VOCABULARIES:
+        raise ValueError(f"Unknown annotation vocabulary {vocabulary}, expected one of {', '.join(VOCABULARIES)}")
+    os.makedirs(cache_folder, exist_ok=True)
+    manifest = read_manifest(cache_folder)
+    digest = file_digest(annotation_file, manifest)
+    cache_file = os.path.join(cache_folder, f"{digest}.bgc")
+
+    # Entries written before the other vocabularies were extracted only have the GO arrays
+    if os.path.exists(cache_file) and all(f'{name}/indptr' in read_arrays(cache_file) for name in VOCABULARIES if name != 'GO'):
+        print(f"Loading cached background for {annotation_file}...")
+        if not read_only:
+            os.utime(cache_file)
+    else:
+        print(f"Performing Background Filtering from {annotation_file}...")
+        build_background(annotation_file, cache_file, memory_budget)
+
+    # The entry is mapped before the manifest update, so an eviction by another thread cannot remove it first
+    arrays = read_arrays(cache_file)
+    prefix = '' if vocabulary == 'GO' else f'{vocabulary}/'
+    background = {name: arrays[prefix + name] for name in ['transcripts', 'terms', 'indptr', 'indices']}
+    if not read_only:
+        stat = os.stat(annotation_file)
+        source = os.path.abspath(annotation_file)
+        with MANIFEST_LOCK:
+            manifest = read_manifest(cache_folder)
+            previous = manifest['sources'].get(source, {}).get('digest')
+            manifest['sources'][source] = {'digest': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            evict_entries(cache_folder, manifest, max_entries, stale=previous if previous != digest else None)
+            write_manifest(cache_folder, manifest)
+
+    if len(background['indices']) == 0:
+        raise ValueError(f"No {vocabulary} annotations found in {annotation_file}")
+    return background
+
+
+def evict_entries(cache_folder, manifest, max_entries, stale=None):
+    '''
+    Function to remove outdated cache entries: the entry of a digest that no source file has anymore,
+    and the least recently used entries beyond max_entries.
+
+    Args:
+    - cache_folder: Folder with the cache entries
+    - manifest: Dictionary with the cache manifest, updated in place
+    - max_entries: Maximum number of entries kept in the cache
+    - stale: Digest of an entry whose source file has changed
+    '''
+    in_use = {source['digest'] for source in manifest['sources'].values()}
+    if stale and stale not in in_use:
+        stale_file = os.path.join(cache_folder, f"{stale}.bgc")
+        if os.path.exists(stale_file):
+            print(f"Evicting stale background cache entry {stale}")
+            os.remove(stale_file)
+
+    entries = sorted((entry for entry in os.listdir(cache_folder) if entry.endswith('.bgc')),
+                     key=lambda entry: os.path.getmtime(os.path.join(cache_folder, entry)), reverse=True)
+    for entry in entries[max_entries:]:
+        os.remove(os.path.join(cache_folder, entry))
+    kept = {entry[:-len('.bgc')] for entry in entries[:max_entries]}
+    manifest['sources'] = {path: source for path, source in manifest['sources'].items() if source['digest'] in kept}
+
+
+def lookup_ids(sorted_ids, ids):
+    '''
+    Function to find the codes of IDs in a sorted byte-string array with a binary search.
+
+    Args:
+    - sorted_ids: Sorted byte-string array, e.g. background['transcripts']
+    - ids: List of string IDs
+
+    Returns:
+    - codes: Array with the position of each ID in sorted_ids, or -1 if the ID is not present
+    '''
+    keys = np.array([i.encode() for i in ids], dtype=bytes) if len(ids) else np.zeros(0, dtype=sorted_ids.dtype)
+    if len(sorted_ids) == 0:
+        return np.full(len(keys), -1, dtype=np.int64)
+    codes = np.minimum(np.searchsorted(sorted_ids, keys), len(sorted_ids) - 1)
+    return np.where(sorted_ids[codes] == keys, codes, -1)
@@ -1,8 +1,26 @@
 import os
+import json
+import glob
+import argparse
+import importlib
+import threading
+import multiprocessing
 import pandas as pd
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
 import plotly.graph_objs as go
 import plotly.io as pio
+from plotly.offline import get_plotlyjs
+import profiling
+from worker_budget import pool_workers
+
+COLORS = {'BP': 'skyblue', 'MF': 'lightcoral', 'CC': 'lightgreen'}
+
+# Name of the plotly.js bundle shared by all the HTML plots of an output folder
+PLOTLYJS_FILE = 'plotly.min.js'
+# Name of the file where the PNG plots whose rendering was deferred are queued
+DEFERRED_FILE = 'deferred_plots.json'
 
 def wrap_labels(label, max_words=4):
     words = label.split()
@@ -10,43 +28,82 @@ def wrap_labels(label, max_words=4):
         label = "\n".join([" ".join(words[i:i+max_words]) for i in range(0, len(words), max_words)])
     return label
 
-def create_individual_barplot(df, title, filename, color):
-    df['WrappedName'] = df['Name'].apply(wrap_labels)
-    df_sorted = df.sort_values(by='Value', key=abs)
+def plotlyjs_reference(html_file, plotlyjs_folder=None):
+    '''
+    Function to get the relative path from an HTML plot to the shared plotly.js bundle, writing the bundle
+    the first time it is needed. HTML plots reference the bundle instead of embedding a copy of plotly.js.
+
+    Args:
+    - html_file: Path to the HTML plot
+    - plotlyjs_folder: Folder of the bundle. By default, the folder of the HTML plot.
+
+    Returns:
+    - reference: Relative path to the bundle, used as the src of the plotly.js script
+    '''
+    folder = plotlyjs_folder or os.path.dirname(html_file)
+    bundle = os.path.join(folder, PLOTLYJS_FILE)
+    if not os.path.exists(bundle):
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{bundle}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(get_plotlyjs())
+        os.replace(tmp_path, bundle)
+    return os.path.relpath(os.path.abspath(bundle), os.path.dirname(os.path.abspath(html_file))).replace(os.sep, '/')
 
-    # Create the static plot with matplotlib
-    plt.figure(figsize=(14, 12))
-    bars = plt.barh(df_sorted['WrappedName'], abs(df_sorted['Value']), color=color, height=0.6)
-    for bar in bars:
-        width = bar.get_width()
-        plt.text(width + 0.5 if width > 0 else width - 0.5, 
-                 bar.get_y() + bar.get_height() / 2, 
-                 f'{width:.2f}', 
-                 va='center', 
-                 ha='right' if width > 0 else 'left', 
-                 fontsize=8)
-    plt.xlabel('Value')
-    plt.title(title)
-    plt.yticks(fontsize=6)
-    plt.xticks(fontsize=10)
-    plt.grid(True, linestyle='--', alpha=0.7)
-    plt.tight_layout()
-    plt.savefig(filename)
-    plt.close()
-
-    # Create an interactive plot with plotly
+def save_barplot_png(names, values, colors, title, filename, legend=None):
+    '''
+    Function to render a horizontal bar plot with matplotlib. The value labels of all bars are added at once
+    with bar_label, and the figure is created without pyplot so that plots can be rendered concurrently.
+
+    Args:
+    - names: Labels of the bars
+    - values: Lengths of the bars
+    - colors: Color of the bars, or list with one color per bar
+    - title: Title of the plot
+    - filename: Path to the PNG file
+    - legend: Optional dictionary with the legend labels as keys and their colors as values
+    '''
+    fig = Figure(figsize=(14, 12))
+    ax = fig.subplots()
+    bars = ax.barh(names, values, color=colors, height=0.6)
+    ax.bar_label(bars, labels=[f'{value:.2f}' for value in values], padding=3, fontsize=8)
+    if legend:
+        handles = [Line2D([0], [0], color=color, lw=4) for color in legend.values()]
+        ax.legend(handles, list(legend), title='Ontology', title_fontsize='13', fontsize='11', loc='best')
+    ax.set_xlabel('Value')
+    ax.set_title(title)
+    ax.tick_params(axis='y', labelsize=6)
+    ax.tick_params(axis='x', labelsize=10)
+    ax.grid(True, linestyle='--', alpha=0.7)
+    fig.tight_layout()
+    fig.savefig(filename)
+
+def save_barplot_html(names, values, colors, hover_names, title, filename, plotlyjs_folder=None, **layout):
+    '''
+    Function to save an interactive horizontal bar plot with plotly, referencing the shared plotly.js bundle.
+
+    Args:
+    - names: Labels of the bars
+    - values: Lengths of the bars
+    - colors: Color of the bars, or list with one color per bar
+    - hover_names: Names shown when hovering the bars
+    - title: Title of the plot
+    - filename: Path to the HTML file
+    - plotlyjs_folder: Folder of the plotly.js bundle. By default, the folder of the HTML file.
+    - layout: Extra layout options
+    '''
     fig = go.Figure()
 
     fig.add_trace(go.Bar(
-        y=df_sorted['WrappedName'],
-        x=abs(df_sorted['Value']),
+        y=names,
+        x=values,
         orientation='h',
-        marker=dict(color=color),
-        text=abs(df_sorted['Value']),
+        marker=dict(color=colors),
+        text=values,
         textposition='outside',
         hoverinfo='text',
         hovertemplate='<b>%{text:.2f}</b><br>GO Term: %{customdata}<extra></extra>',
-        customdata=df_sorted['Name']
+        customdata=hover_names
     ))
 
     fig.update_layout(
@@ -62,7 +119,7 @@ def create_individual_barplot(df, title, filename, color):
             font_size=14,
             font_family="Arial",
         ),
-        barmode='overlay'
+        **layout
     )
 
     # Hide other bars on hover
@@ -78,14 +135,50 @@ def create_individual_barplot(df, title, filename, color):
         hovertemplate='<b>%{customdata}</b><br>Value: %{x:.2f}<extra></extra>'
     )
 
-    # Save as interactive HTML
+    pio.write_html(fig, file=filename, include_plotlyjs=plotlyjs_reference(filename, plotlyjs_folder))
+
+def create_individual_barplot(df, title, filename, color, plotlyjs_folder=None, render_png=True, render_html=True):
+    '''
+    Function to create the static (PNG) and interactive (HTML) bar plots of the terms of one ontology.
+
+    Args:
+    - df: DataFrame with the 'Name' and 'Value' columns of a REVIGO table
+    - title: Title of the plot
+    - filename: Path to the PNG file, the HTML file has the same name with the .html extension
+    - color: Color of the bars
+    - plotlyjs_folder: Folder of the shared plotly.js bundle. By default, the folder of the plot.
+    - render_png, render_html: Whether to render each of the outputs. By default, True.
+
+    Returns:
+    - outputs: List of paths of the files written
+    '''
+    df_sorted = df.sort_values(by='Value', key=abs)
+    names = df_sorted['Name'].apply(wrap_labels)
+    values = abs(df_sorted['Value']).tolist()
     interactive_filename = filename.replace('.png', '.html')
-    pio.write_html(fig, file=interactive_filename)
 
-    return interactive_filename
+    outputs = []
+    if render_png:
+        save_barplot_png(names, values, color, title, filename)
+        outputs.append(filename)
+    if render_html:
+        save_barplot_html(names, values, color, df_sorted['Name'], title, interactive_filename, plotlyjs_folder, barmode='overlay')
+        outputs.append(interactive_filename)
+    return outputs
+
+def create_combined_barplot(dataframes, output_folder, plotlyjs_folder=None, render_png=True, render_html=True):
+    '''
+    Function to create the static (PNG) and interactive (HTML) bar plots of the terms of the three ontologies.
 
-def create_combined_barplot(dataframes, output_folder):
-    colors = {'BP': 'skyblue', 'MF': 'lightcoral', 'CC': 'lightgreen'}
+    Args:
+    - dataframes: Dictionary with the ontologies (BP, MF, CC) as keys and DataFrames with 'Name' and 'Value' columns as values
+    - output_folder: Folder where combined_barplot.png and combined_barplot.html are written
+    - plotlyjs_folder: Folder of the shared plotly.js bundle. By default, output_folder.
+    - render_png, render_html: Whether to render each of the outputs. By default, True.
+
+    Returns:
+    - outputs: List of paths of the files written
+    '''
     combined_df = pd.concat([
         dataframes['BP'].assign(Ontology='BP'),
         dataframes['MF'].assign(Ontology='MF'),
@@ -95,89 +188,29 @@ def create_combined_barplot(dataframes, output_folder):
     ontology_order = {'BP': 1, 'MF': 2, 'CC': 3}
     combined_df['OntologyOrder'] = combined_df['Ontology'].map(ontology_order)
     combined_df = combined_df.reset_index(drop=True)
-    combined_df['WrappedName'] = combined_df['Name'].apply(wrap_labels)
     combined_df_sorted = combined_df.sort_values(by=['OntologyOrder', 'Value'], key=abs)
+    names = combined_df_sorted['Name'].apply(wrap_labels)
+    values = abs(combined_df_sorted['Value']).tolist()
+    colors = combined_df_sorted['Ontology'].map(COLORS).tolist()
 
-    # Static plot with matplotlib
-    plt.figure(figsize=(14, 12))
-    bars = plt.barh(combined_df_sorted['WrappedName'], abs(combined_df_sorted['Value']),
-                    color=combined_df_sorted['Ontology'].map(colors), height=0.6)
-    for bar in bars:
-        width = bar.get_width()
-        plt.text(width + 0.5 if width > 0 else width - 0.5, 
-                 bar.get_y() + bar.get_height() / 2, 
-                 f'{width:.2f}', 
-                 va='center', 
-                 ha='right' if width > 0 else 'left', 
-                 fontsize=8)
-
-    handles = [plt.Line2D([0], [0], color=colors[ont], lw=4) for ont in ['BP', 'MF', 'CC']]
-    labels = ['BP', 'MF', 'CC']
-    plt.legend(handles, labels, title='Ontology', title_fontsize='13', fontsize='11', loc='best')
-
-    plt.xlabel('Value')
-    plt.title('GO Terms Bar Plot - Combined')
-    plt.yticks(fontsize=6)
-    plt.xticks(fontsize=10)
-    plt.grid(True, linestyle='--', alpha=0.7)
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_folder, 'combined_barplot.png'))
-    plt.close()
-
-    # Interactive plot with plotly
-    fig = go.Figure()
-
-    fig.add_trace(go.Bar(
-        y=combined_df_sorted['WrappedName'],
-        x=abs(combined_df_sorted['Value']),
-        orientation='h',
-        marker=dict(color=combined_df_sorted['Ontology'].map(colors)),
-        text=abs(combined_df_sorted['Value']),
-        textposition='outside',
-        hoverinfo='text',
-        hovertemplate='<b>%{text:.2f}</b><br>GO Term: %{customdata}<extra></extra>',
-        customdata=combined_df_sorted['Name']
-    ))
-
-    fig.update_layout(
-        title='GO Terms Bar Plot - Combined',
-        xaxis_title='Value',
-        yaxis_title='GO Terms',
-        yaxis=dict(tickfont=dict(size=10)),
-        xaxis=dict(tickfont=dict(size=10)),
-        template="plotly_white",
-        hovermode="closest",
-        hoverlabel=dict(
-            bgcolor="white",
-            font_size=14,
-            font_family="Arial",
-        )
-    )
-
-    # Hide other bars on hover
-    fig.update_traces(
-        marker=dict(opacity=0.3),
-        selector=dict(type='bar')
-    )
+    outputs = []
+    if render_png:
+        filename = os.path.join(output_folder, 'combined_barplot.png')
+        save_barplot_png(names, values, colors, 'GO Terms Bar Plot - Combined', filename,
+                         legend={ontology: COLORS[ontology] for ontology in ['BP', 'MF', 'CC']})
+        outputs.append(filename)
+    if render_html:
+        interactive_filename = os.path.join(output_folder, 'combined_barplot.html')
+        save_barplot_html(names, values, colors, combined_df_sorted['Name'], 'GO Terms Bar Plot - Combined',
+                          interactive_filename, plotlyjs_folder)
+        outputs.append(interactive_filename)
+    return outputs
 
-    # Make hovered bar full opacity
-    fig.update_traces(
-        marker=dict(opacity=1),
-        hoverinfo='text+name',
-        hovertemplate='<b>%{customdata}</b><br>Value: %{x:.2f}<extra></extra>'
-    )
-
-    # Save as interactive HTML
-    interactive_filename = os.path.join(output_folder, 'combined_barplot.html')
-    pio.write_html(fig, file=interactive_filename)
-
-    return interactive_filename
-
-def process_and_plot(bp_path, mf_path, cc_path, output_folder):
+def process_and_plot(bp_path, mf_path, cc_path, output_folder, plotlyjs_folder=None, render_png=True, render_html=True):
     os.makedirs(output_folder, exist_ok=True)
 
     dataframes = {'BP': pd.DataFrame(), 'MF': pd.DataFrame(), 'CC': pd.DataFrame()}
-    colors = {'BP': 'skyblue', 'MF': 'lightcoral', 'CC': 'lightgreen'}
+    outputs = []
 
     # Process and create individual bar plots
     for ontology, path in {'BP': bp_path, 'MF': mf_path, 'CC': cc_path}.items():
@@ -185,12 +218,137 @@ def process_and_plot(bp_path, mf_path, cc_path, output_folder):
         if all(col in df.columns for col in ['Name', 'Value']):
             dataframes[ontology] = df[['Name', 'Value']]
             output_file = os.path.join(output_folder, f'{ontology}_barplot.png')
-            create_individual_barplot(df[['Name', 'Value']], f'GO Terms Bar Plot - {ontology}', output_file, colors[ontology])
+            outputs += create_individual_barplot(df[['Name', 'Value']], f'GO Terms Bar Plot - {ontology}', output_file, COLORS[ontology],
+                                                 plotlyjs_folder, render_png, render_html)
         else:
             raise ValueError(f"The file {path} does not contain the required columns.")
 
     # Create combined bar plot
-    create_combined_barplot(dataframes, output_folder)
+    outputs += create_combined_barplot(dataframes, output_folder, plotlyjs_folder, render_png, render_html)
+    return outputs
+
+def table_barplot(table_path, title, filename, color, plotlyjs_folder=None, render_png=True, render_html=True):
+    '''
+    Function to create the bar plots of a REVIGO table file, see create_individual_barplot.
+    '''
+    return create_individual_barplot(pd.read_csv(table_path, sep='\t'), title, filename, color, plotlyjs_folder, render_png, render_html)
+
+def create_scatterplot(scatterplot_path, title, filename, plotlyjs_folder=None, render_png=True, render_html=True):
+    '''
+    Function to plot the semantic space of the terms of a REVIGO scatterPlot file.
+
+    Returns:
+    - outputs: List of paths of the files written
+    '''
+    if not render_png:
+        return []
+    # Terms without coordinates (the redundant ones) have null values
+    scatterplot_data = pd.read_csv(scatterplot_path, sep='\t', na_values=['null']).dropna(subset=['PC_0', 'PC_1'])
+    if scatterplot_data.empty:
+        print(f"No terms to plot in {scatterplot_path}")
+        return []
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.scatter(scatterplot_data['PC_0'], scatterplot_data['PC_1'], s=abs(scatterplot_data['LogSize']*30), c='blue',
+               edgecolors='black', alpha=0.6, linewidth=0.5)
+    ax.set_xlabel('Semantic Space X')
+    ax.set_ylabel('Semantic Space Y')
+    ax.set_title(title)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    fig.savefig(filename)
+    return [filename]
+
+# Plot functions that can be run as jobs (module and function names), they only take paths and plain values as arguments
+PLOT_JOBS = {'barplot': ('barplot_generator', 'table_barplot'),
+             'combined': ('barplot_generator', 'process_and_plot'),
+             'scatter': ('barplot_generator', 'create_scatterplot'),
+             'treemap': ('treemap_generator', 'create_treemap')}
+
+def plot_job(kind, **kwargs):
+    '''
+    Function to describe a plot as a job that can be sent to another process or queued in a file.
+
+    Args:
+    - kind: Type of plot, one of the keys of PLOT_JOBS
+    - kwargs: Arguments of the plot function
+
+    Returns:
+    - job: Dictionary with the 'kind' and 'kwargs' of the plot
+    '''
+    return {'kind': kind, 'kwargs': kwargs}
+
+def render_job(job, render_png=True, render_html=True):
+    module, function = PLOT_JOBS[job['kind']]
+    return getattr(importlib.import_module(module), function)(**job['kwargs'], render_png=render_png, render_html=render_html)
+
+def plot_executor(workers=None):
+    '''
+    Function to create the process pool used to render the plots. Worker processes are started with 'spawn',
+    so that they can be created safely while other threads of the pipeline are running.
+    '''
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, mp_context=multiprocessing.get_context('spawn'))
+
+def render_jobs(jobs, executor=None, workers=None, deferred_file=None, group=None):
+    '''
+    Function to render a list of plot jobs in a process pool.
+
+    Args:
+    - jobs: List of jobs as returned by plot_job
+    - executor: Process pool as returned by plot_executor. By default, a new pool is created for these jobs.
+    - workers: Number of processes of the new pool. By default, the number of CPUs, or in a pipeline run the
+      slot of the task and the free processes of its worker budget (see worker_budget.pool_workers).
+    - deferred_file: If given, only the HTML plots are rendered and the PNG plots are queued in this file,
+      to be rendered later with render_deferred.
+    - group: Name of the group of the plots, used in the profile. By default, None.
+
+    Returns:
+    - outputs: List of paths of the files written, including deferred_file
+    '''
+    if not jobs:
+        return []
+    render_png = deferred_file is None
+    if executor is None:
+        with pool_workers(min(workers or os.cpu_count() or 1, len(jobs))) as workers, plot_executor(workers) as own_executor:
+            return render_jobs(jobs, own_executor, deferred_file=deferred_file, group=group)
+
+    with profiling.stage('render_plots', group=group, png=render_png) as metrics:
+        futures = [executor.submit(render_job, job, render_png) for job in jobs]
+        outputs = [path for future in futures for path in future.result()]
+        metrics['items'] = len(jobs)
+    if not render_png:
+        os.makedirs(os.path.dirname(deferred_file) or '.', exist_ok=True)
+        with open(deferred_file, 'w') as file:
+            json.dump(jobs, file, indent=2)
+        outputs.append(deferred_file)
+    return outputs
+
+def render_deferred(output_folder, workers=None):
+    '''
+    Function to render the PNG plots queued by render_jobs in all the deferred plot files of an output folder.
+    Every deferred plot file is removed once its plots are rendered, so they are only rendered once.
+
+    Args:
+    - output_folder: Output folder of the analysis
+    - workers: Number of processes. By default, the number of CPUs.
+
+    Returns:
+    - outputs: List of paths of the PNG files written
+    '''
+    queues = []
+    for deferred_file in sorted(glob.glob(os.path.join(output_folder, '**', DEFERRED_FILE), recursive=True)):
+        with open(deferred_file, 'r') as file:
+            queues.append((deferred_file, json.load(file)))
+    n_jobs = sum(len(jobs) for _, jobs in queues)
+    outputs = []
+    if n_jobs:
+        print(f"Rendering {n_jobs} deferred plot(s)...")
+        with plot_executor(min(workers or os.cpu_count() or 1, n_jobs)) as executor:
+            futures = [(deferred_file, [executor.submit(render_job, job, True, False) for job in jobs]) for deferred_file, jobs in queues]
+            for deferred_file, file_futures in futures:
+                outputs += [path for future in file_futures for path in future.result()]
+                os.remove(deferred_file)
+    return outputs
 
 # Example usage
 bp_path = 'examples/output/aa/aa.candidates/results_revigo/aa.candidates_0.01_IDs_Pvalues_BP_table.tsv'
@@ -199,3 +357,10 @@ cc_path = 'examples/output/aa/aa.candidates/results_revigo/aa.candidates_0.01_ID
 output_folder = 'examples/output/ccc'
 
 #process_and_plot(bp_path, mf_path, cc_path, output_folder)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render the PNG plots whose rendering was deferred')
+    parser.add_argument('output_folder', help='Output folder of the analysis')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes. By default, the number of CPUs.')
+    args = parser.parse_args()
+    print(f"{len(render_deferred(args.output_folder, args.workers))} PNG file(s) written")
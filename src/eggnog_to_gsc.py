@@ -1,41 +1,222 @@
-def process_eggnog(file_path, output_file):
+import os
+import io
+import gzip
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from worker_budget import pool_workers
+
+# Annotation vocabularies extracted from eggNOG-mapper files, with the column names used by the different
+# eggNOG-mapper versions and the position of the column in eggNOG-mapper v2 output when the '#query' header is missing
+VOCABULARIES = {'GO': (('GOs', 'GO_terms'), 9),
+                'EC': (('EC',), 10),
+                'KEGG_ko': (('KEGG_ko',), 11),
+                'KEGG_Pathway': (('KEGG_Pathway',), 12),
+                'PFAMs': (('PFAMs',), 20)}
+
+
+def open_annotation(file_path):
+    '''
+    Function to open a plain, gzip (.gz) or zstandard (.zst) compressed eggNOG-mapper file as a binary stream.
+
+    Args:
+    - file_path: Path to the eggNOG-mapper file
+
+    Returns:
+    - stream: Binary file object with the decompressed content
+    '''
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    if file_path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading .zst annotation files requires the 'zstandard' package (pip install zstandard)")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True))
+    return open(file_path, 'rb')
+
+
+def find_columns(file_path):
+    '''
+    Function to locate the annotation columns from the '#query' header of an eggNOG-mapper file.
+
+    Args:
+    - file_path: Path to the eggNOG-mapper file
+
+    Returns:
+    - columns: Dictionary with the vocabularies of VOCABULARIES found in the file as keys and the index of
+      their column as values. The GO column is required.
+    '''
+    with open_annotation(file_path) as stream:
+        for line in stream:
+            if not line.startswith(b'#'):
+                break
+            if line.startswith(b'#query'):
+                header = line.decode().rstrip('\r\n').lstrip('#').split('\t')
+                columns = {}
+                for vocabulary, (names, _) in VOCABULARIES.items():
+                    found = [name for name in names if name in header]
+                    if found:
+                        columns[vocabulary] = header.index(found[0])
+                if 'GO' not in columns:
+                    raise ValueError(f"No GO column found in the header of {file_path}")
+                return columns
+    print(f"No '#query' header found in {file_path}, using the eggNOG-mapper v2 columns")
+    return {vocabulary: column for vocabulary, (_, column) in VOCABULARIES.items()}
+
+
+def split_terms(vocabulary, field):
+    '''
+    Function to split the comma-separated terms of an annotation field, with the same IDs in every
+    eggNOG-mapper version: the 'ko:' prefix of KEGG orthologs is removed, and the 'ko' and 'map' copies of
+    a KEGG pathway are both reported as the 'map' pathway (the repetition is removed with the background).
+    '''
+    terms = [term.strip() for term in field.split(b',')]
+    if vocabulary == 'KEGG_ko':
+        return [term[3:] if term.startswith(b'ko:') else term for term in terms]
+    if vocabulary == 'KEGG_Pathway':
+        return [b'map' + term[2:] if term.startswith(b'ko') else term for term in terms]
+    return terms
+
+
+def parse_block(data, columns):
+    '''
+    Function to convert a block of eggNOG-mapper lines into background lines.
+
+    Args:
+    - data: Bytes with complete eggNOG-mapper lines
+    - columns: Dictionary with the vocabularies as keys and the index of their column as values, as returned
+      by find_columns
+
+    Returns:
+    - output: Bytes with one 'term\tIEA\ttranscript\tvocabulary' line per annotation term
+    - rows: Number of annotation rows in the block
+    '''
+    out = []
+    rows = 0
+    last_column = max(columns.values())
+    # Vocabulary names are written as the last field of every line, once per block
+    fields = [(vocabulary, column, b'\t' + vocabulary.encode() + b'\n') for vocabulary, column in columns.items()]
+    for line in data.split(b'\n'):
+        if not line or line.startswith(b'#'):
+            continue    # Skip header and metadata
+        rows += 1
+        parts = line.rstrip(b'\r').split(b'\t', last_column + 1)
+        for vocabulary, column, name in fields:
+            if len(parts) <= column or parts[column] in (b'-', b''):
+                continue
+            # In the case of using electronic evidence, use IEA as evidence code
+            suffix = b'\tIEA\t' + parts[0] + name
+            out.append(suffix.join(split_terms(vocabulary, parts[column])) + suffix)
+    return b''.join(out), rows
+
+
+def parse_range(file_path, start, end, columns):
+    '''
+    Function to parse the byte range [start, end) of an uncompressed eggNOG-mapper file. Used by the worker processes.
+    '''
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        return parse_block(file.read(end - start), columns)
+
+
+def byte_ranges(file_path, chunk_size):
+    '''
+    Function to split an uncompressed file into byte ranges of about chunk_size bytes that end at line boundaries.
+
+    Args:
+    - file_path: Path to the file
+    - chunk_size: Approximate size of each range in bytes
+
+    Returns:
+    - ranges: List of (start, end) tuples
+    '''
+    file_size = os.path.getsize(file_path)
+    ranges = []
+    start = 0
+    with open(file_path, 'rb') as file:
+        while start < file_size:
+            file.seek(min(start + chunk_size, file_size))
+            file.readline()
+            end = min(file.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def text_blocks(file_path, chunk_size):
+    '''
+    Function to stream a (possibly compressed) file as blocks of about chunk_size bytes of complete lines.
+    '''
+    with open_annotation(file_path) as stream:
+        while True:
+            lines = stream.readlines(chunk_size)
+            if not lines:
+                break
+            yield b''.join(lines)
+
+
+def process_eggnog(file_path, output_file, workers=None, chunk_size=32 << 20):
     '''
     Function to process the Eggnog output file to extract an annotation file
     that can be used in the enrichment analysis.
 
+    Every vocabulary of VOCABULARIES (GO terms, EC numbers, KEGG orthologs and pathways and Pfam domains)
+    is extracted in the same pass, and each output line is tagged with its vocabulary.
+
+    The file is streamed in blocks, so memory depends on chunk_size and workers and not on the input size.
+    Uncompressed files are split into byte ranges read directly by the worker processes, while compressed
+    files (.gz, .zst) are decompressed sequentially and their blocks parsed in parallel.
+
     Args:
-    - file_path: Path to the Eggnog output file
-    - output_file: Path to the annotation file in tab-separated format
-    '''
-    import os
-    
-    with open(file_path, 'r') as file:
-        # Skip the first 4 lines of metadata or header
-        for _ in range(4):
-            next(file)
-        
-
-        lines = file.readlines()
-    
-    with open(output_file, 'w') as out_file:
-
-        for line in lines:
-            if line.startswith('#'):
-                continue    # Skip header   
-            parts = line.strip().split('\t')  
-            if len(parts) < 2:
-                continue  
-            
-            transcript_id = parts[0]
-            go_terms = parts[9]
-            
-
-            if go_terms != '-':
-                go_terms_list = go_terms.split(',') 
-                
-                # In the case of using electronic evidence, use IEA as evidence code
-                for go_term in go_terms_list:
-                    out_file.write(f'{go_term.strip()}\tIEA\t{transcript_id}\n')
-    
+    - file_path: Path to the Eggnog output file (plain, .gz or .zst)
+    - output_file: Path to the annotation file in tab-separated format (term, evidence code, transcript and
+      vocabulary columns)
+    - workers: Number of worker processes. By default, the number of CPUs, or in a pipeline run the free
+      processes of its worker budget (see worker_budget.pool_workers).
+    - chunk_size: Approximate size in bytes of the blocks parsed by each worker. By default, 32 MB.
+
+    Returns:
+    - stats: Dictionary with the number of annotation 'rows', the elapsed 'seconds' and the 'rows_per_second'
+    '''
+    start_time = time.perf_counter()
+    columns = find_columns(file_path)
+    compressed = file_path.endswith(('.gz', '.zst'))
+    rows = 0
+
+    with open(output_file, 'wb') as out_file, pool_workers(workers) as workers:
+        if workers == 1 or (not compressed and os.path.getsize(file_path) <= chunk_size):
+            for block in text_blocks(file_path, chunk_size):
+                output, block_rows = parse_block(block, columns)
+                out_file.write(output)
+                rows += block_rows
+        else:
+            # Worker processes are started with 'spawn', as in barplot_generator.plot_executor, since several
+            # backgrounds can be parsed at the same time by the threads of a pipeline run
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                if compressed:
+                    jobs = ((parse_block, block, columns) for block in text_blocks(file_path, chunk_size))
+                else:
+                    jobs = ((parse_range, file_path, start, end, columns) for start, end in byte_ranges(file_path, chunk_size))
+
+                # Keep a bounded window of blocks in flight and write them back in file order
+                pending = deque()
+                for job in jobs:
+                    pending.append(executor.submit(*job))
+                    if len(pending) >= 2 * workers:
+                        output, block_rows = pending.popleft().result()
+                        out_file.write(output)
+                        rows += block_rows
+                while pending:
+                    output, block_rows = pending.popleft().result()
+                    out_file.write(output)
+                    rows += block_rows
+
+    seconds = time.perf_counter() - start_time
+    rows_per_second = rows / seconds if seconds > 0 else float('inf')
+    print(f"Processed {rows} annotation rows from {file_path} in {seconds:.2f} s ({rows_per_second:,.0f} rows/s)")
+    return {'rows': rows, 'seconds': seconds, 'rows_per_second': rows_per_second}
+
 
 #Example of usage: process_eggnog('sample_examples\eggnog_annotation_example.emapper.annotation', 'sample_examples\example_annot.txt')
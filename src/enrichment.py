@@ -1,10 +1,15 @@
 import os
-import pandas as pd
-from eggnog_to_gsc import process_eggnog
+from background_cache import load_background
+from go_ontology import load_go_ontology
+from go_enrichment import build_annotation_index, build_vocabulary_index, enrich_batch, missing_ids, read_ids, write_results, write_tests
+from gene_mapping import load_gene_map
+from ranked_enrichment import read_ranked, ranked_enrichment
 from tkinter import Tk, filedialog
 import shutil
 import glob
 import json
+import fnmatch
+import profiling
 
 def select_files():
     '''
@@ -15,10 +20,11 @@ def select_files():
 
     - grouped_files: Dictionary with basenames as keys and sub-dictionaries as values. 
       Each sub-dictionary contains paths for 'candidates' and 'universe' files.
-    - background: DataFrame with the background transcripts 
+    - annotation_file: Path to the eggNOG-mapper file with the transcripts annotation, used by the groups
+      without a background in the 'backgrounds' registry of params.json (see select_backgrounds)
     '''
     grouped_files = {}
-    background = pd.DataFrame()
+    annotation_file = None
 
     # Ensure the 'data' directory exists
     if not os.path.exists('data'):
@@ -27,9 +33,10 @@ def select_files():
     if os.path.exists('data') and len(os.listdir('data')) != 0:
         candidate_files = glob.glob('data/candidates/*.candidates.txt')
         universe_files = glob.glob('data/universe/*.universe.txt')
-        annotation_files = glob.glob('data/annotation/*.annotation*')
+        annotation_files = sorted(glob.glob('data/annotation/*.annotation*'))
 
-        if candidate_files and universe_files and annotation_files:
+        # Ranked lists (see select_ranked_files) are enough to run the analysis without candidates files
+        if (candidate_files and universe_files or select_ranked_files()) and annotation_files:
             for file in candidate_files:
                 basename = os.path.basename(file).replace('.candidates.txt', '')
                 if basename not in grouped_files:
@@ -42,12 +49,7 @@ def select_files():
                     grouped_files[basename] = {'candidates': [], 'universe': []}
                 grouped_files[basename]['universe'].append(file)
 
-            # Process the annotation file
-            print(f"Performing Background Filtering from {annotation_files[0]}...")
-            process_eggnog(annotation_files[0], 'data/annotation/background.txt')
-            background = pd.read_csv('data/annotation/background.txt', sep='\t', header=None, names=['GO', 'Evidence', 'Transcript'])
-            
-            return grouped_files, background
+            return grouped_files, annotation_files[0]
         
 
     # If the files are not found, open file dialog for user to select the files
@@ -68,13 +70,251 @@ def select_files():
     annotation_file = filedialog.askopenfilename(title="Select annotation file", filetypes=[("Annotation files", "*.annotation")])
     if annotation_file:
         shutil.copy(annotation_file, 'data/annotation/') 
-        print(f"Performing Background Filtering from {annotation_file}...")
-        process_eggnog(annotation_file, 'data/annotation/background.txt')
-        background = pd.read_csv('data/annotation/background.txt', sep='\t', header=None, names=['GO', 'Evidence', 'Transcript'])
 
     group_file["selected"] = {'candidates': [candidate_file], 'universe': [universe_file]}
 
-    return group_file, background
+    return group_file, annotation_file
+
+def select_backgrounds(groups, annotation_file, parameters):
+    '''
+    Function to assign a background to every group, so that groups of several species or assemblies are
+    analysed in one run. The 'backgrounds' registry of params.json maps background names to an eggNOG-mapper
+    file, the groups that use it (names or patterns such as "liver_*") and, optionally, its own gene map:
+
+        "backgrounds": {"species_a": {"annotation": "data/annotation/species_a.emapper.annotations",
+                                      "groups": ["aa", "ab*"], "gene_map": "trinity"}}
+
+    The outputs of the groups of a registered background are written to a subfolder of the output folder
+    named after it, so the results of different backgrounds never share files. The groups that are not in
+    the registry use annotation_file and the output folder itself.
+
+    Args:
+    - groups: List of group names
+    - annotation_file: Path to the default eggNOG-mapper file, as returned by select_files
+    - parameters: Dictionary with the parameters of params.json
+
+    Returns:
+    - backgrounds: Dictionary with the background names (None for the default one) as keys and, as values,
+      dictionaries with the 'annotation' file, its 'groups' and the 'parameters' of its groups (the
+      parameters of params.json with the output folder and gene map of the background)
+    '''
+    registry = parameters.get('backgrounds') or {}
+    assigned = {}
+    for name, entry in registry.items():
+        if 'annotation' not in entry:
+            raise ValueError(f"Background {name} of params.json has no 'annotation' file")
+        for group in groups:
+            if group not in assigned and any(fnmatch.fnmatchcase(group, pattern) for pattern in entry.get('groups', [])):
+                assigned[group] = name
+
+    backgrounds = {}
+    for name, entry in registry.items():
+        members = [group for group in groups if assigned.get(group) == name]
+        if not members:
+            continue
+        if not os.path.exists(entry['annotation']):
+            raise FileNotFoundError(f"Annotation file {entry['annotation']} of background {name} not found")
+        backgrounds[name] = {'annotation': entry['annotation'], 'groups': members,
+                             'parameters': dict(parameters, output_folder=os.path.join(parameters['output_folder'], name),
+                                                gene_map=entry.get('gene_map', parameters.get('gene_map')))}
+    unassigned = [group for group in groups if group not in assigned]
+    if unassigned:
+        backgrounds[None] = {'annotation': annotation_file, 'groups': unassigned, 'parameters': parameters}
+    return backgrounds
+
+def select_ranked_files():
+    '''
+    Function to find the ranked lists of transcripts for the threshold-free enrichment, named
+    data/ranked/<group>.ranked.txt (see ranked_enrichment.read_ranked). If data/universe/<group>.universe.txt
+    exists, the ranked list is restricted to that universe.
+
+    Returns:
+    - ranked_files: Dictionary with group names as keys and lists of ranked files as values
+    '''
+    ranked_files = {}
+    for file in sorted(glob.glob('data/ranked/*.ranked.txt')):
+        ranked_files.setdefault(os.path.basename(file).replace('.ranked.txt', ''), []).append(file)
+    return ranked_files
+
+def load_annotation_index(annotation_file, parameters, vocabulary='GO'):
+    '''
+    Function to load the background of an annotation file and the GO ontology, and build the annotation index
+    used by the enrichment and the local term clustering.
+
+    Args:
+    - annotation_file: Path to the eggNOG-mapper file
+    - parameters: Dictionary with the parameters of params.json
+    - vocabulary: Vocabulary to test, 'GO' or another vocabulary of eggnog_to_gsc.VOCABULARIES (e.g.
+      'KEGG_Pathway'), which is tested without the GO ontology. By default, 'GO'.
+
+    Returns:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index (or
+      go_enrichment.build_vocabulary_index). If 'gene_map' is set in the parameters ('trinity' or the path to
+      a gene_trans_map file), the transcripts are collapsed into genes. If 'memory_budget' (MB) is set, the
+      background cache and the index are built out of core, with temporary files in 'spill_folder'.
+    '''
+    if vocabulary == 'GO':
+        with profiling.stage('load_ontology') as metrics:
+            terms, alt_ids = load_go_ontology(parameters.get('go_obo', 'data/ontology/go-basic.obo'), parameters.get('go_release'))
+            metrics['items'] = len(terms)
+    with profiling.stage('load_background', file=os.path.basename(annotation_file), vocabulary=vocabulary) as metrics:
+        background = load_background(annotation_file, vocabulary=vocabulary, read_only=parameters.get('cache_read_only', False),
+                                     memory_budget=parameters.get('memory_budget'))
+        metrics['items'] = len(background['transcripts'])
+    with profiling.stage('build_index', vocabulary=vocabulary) as metrics:
+        gene_map = load_gene_map(parameters.get('gene_map'))
+        if vocabulary == 'GO':
+            index = build_annotation_index(background, terms, alt_ids, gene_map, parameters.get('memory_budget'),
+                                           parameters.get('spill_folder'))
+        else:
+            index = build_vocabulary_index(background, vocabulary, gene_map, parameters.get('memory_budget'),
+                                           parameters.get('spill_folder'))
+        metrics['items'] = len(index['terms'])
+    if index['gene_map'] is not None:
+        print(f"{len(background['transcripts'])} background transcripts collapsed into {len(index['transcripts'])} genes")
+    return index
+
+def group_folder(parameters, group, index):
+    '''
+    Function to get the output folder of a group. The results of the vocabularies other than GO are written
+    to a subfolder named after the vocabulary, e.g. output_folder/aa/KEGG_Pathway.
+
+    Args:
+    - parameters: Dictionary with the parameters of params.json
+    - group: Name of the group
+    - index: Annotation index of the vocabulary tested
+
+    Returns:
+    - output_folder: Path to the output folder
+    '''
+    output_folder = os.path.join(parameters["output_folder"], group) #The output folder will be named after the group name. E.g., the example candidates filename is 'aa.candidates.txt', so the output folder will be 'aa'
+    if index['vocabulary'] != 'GO':
+        output_folder = os.path.join(output_folder, index['vocabulary'])
+    return output_folder
+
+def report_missing_ids(index, ids, file_path, output_folder):
+    '''
+    Function to report the IDs of a candidates or ranked file that are not in the background. Their number
+    is printed and the IDs are written to <name>_missing_IDs.txt in the output folder of the file.
+
+    Args:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index
+    - ids: List of IDs of the file
+    - file_path: Path to the candidates or ranked file
+    - output_folder: Group output folder
+
+    Returns:
+    - missing_file: Path to the file written, or None if every ID is in the background
+    '''
+    missing = missing_ids(index, ids)
+    if not missing:
+        return None
+    print(f"{len(missing)} of {len(ids)} IDs of {file_path} are not in the background (e.g. {', '.join(missing[:3])})")
+    output_name = os.path.splitext(os.path.basename(file_path))[0]
+    output_dir = os.path.join(output_folder, output_name)
+    os.makedirs(output_dir, exist_ok=True)
+    missing_file = os.path.join(output_dir, f"{output_name}_missing_IDs.txt")
+    with open(missing_file, 'w') as file:
+        file.write('\n'.join(missing) + '\n')
+    return missing_file
+
+def universe_batches(grouped_files):
+    '''
+    Function to group the candidate files that share the same universe, so that they are tested together in one sparse batch.
+
+    Args:
+    - grouped_files: Dictionary as returned by select_files
+
+    Returns:
+    - batches: List of (universe, batch) tuples, where universe is the frozenset of universe IDs and batch is
+      a list of (group, candidate_file, universe_file) tuples
+    '''
+    batches = {}
+    for group, files in grouped_files.items():
+        for candidate_file, universe_file in zip(files['candidates'], files['universe']):
+            universe = frozenset(read_ids(universe_file))
+            batches.setdefault(universe, []).append((group, candidate_file, universe_file))
+    return list(batches.items())
+
+def enrich_files(index, universe, batch, parameters):
+    '''
+    Function to perform the enrichment analysis of the candidate files of a batch and write their results.
+
+    Args:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index
+    - universe: Collection of universe IDs shared by the batch
+    - batch: List of (group, candidate_file, universe_file) tuples, as returned by universe_batches
+    - parameters: Dictionary with the parameters of params.json
+
+    Returns:
+    - results: Dictionary with the groups as keys and the results DataFrames as values
+    - outputs: List of paths of the files written
+    '''
+    print(f"Performing {index['vocabulary']} enrichment analysis for {len(batch)} candidate file(s) sharing a universe of {len(universe)} transcripts...")
+    with profiling.stage('enrichment', universe=os.path.basename(batch[0][2])) as metrics:
+        candidate_sets = {candidate_file: read_ids(candidate_file) for _, candidate_file, _ in batch}
+        batch_results = enrich_batch(index, candidate_sets, universe, parameters['pvalue_cutoff'], parameters['category_size'],
+                                     parameters.get('conditional', True), parameters.get('permutations', 0),
+                                     parameters.get('permutation_seed', 0), parameters.get('permutation_workers'))
+        metrics['items'] = len(candidate_sets)
+    n_missing = len(missing_ids(index, universe))
+    if n_missing:
+        print(f"{n_missing} of {len(universe)} universe IDs are not in the background")
+
+    results = {}
+    outputs = []
+    for group, candidate_file, _ in batch:
+        output_folder = group_folder(parameters, group, index)
+        os.makedirs(output_folder, exist_ok=True)
+        missing_file = report_missing_ids(index, candidate_sets[candidate_file], candidate_file, output_folder)
+        if missing_file is not None:
+            outputs.append(missing_file)
+        with profiling.stage('write_results', group=group) as metrics:
+            output_txt = write_results(batch_results[candidate_file], candidate_file, output_folder, parameters['pvalue_cutoff'])
+            outputs.append(write_tests(batch_results[candidate_file], candidate_file, output_folder, parameters['pvalue_cutoff']))
+            metrics['items'] = len(batch_results[candidate_file])
+        if output_txt is not None:
+            outputs += [output_txt, output_txt.replace('_IDs_Pvalues.txt', '.txt'), output_txt.replace('_IDs_Pvalues.txt', '.png')]
+        results[group] = batch_results[candidate_file]
+    return results, outputs
+
+def enrich_ranked_file(index, group, ranked_file, parameters):
+    '''
+    Function to perform the threshold-free enrichment of a ranked list of transcripts and write its results
+    with the same layout as the candidates files, so that the terms are summarized and plotted in the same way.
+
+    Args:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index
+    - group: Name of the group, used as output folder
+    - ranked_file: Path to the ranked file
+    - parameters: Dictionary with the parameters of params.json. 'ranked_max_cutoff' limits the cutoffs to
+      the top-ranked transcripts and 'running_sum' adds the GSEA enrichment score of every term.
+
+    Returns:
+    - results: Results DataFrame, see ranked_enrichment.ranked_enrichment
+    - outputs: List of paths of the files written
+    '''
+    ranked_ids, scores = read_ranked(ranked_file)
+    universe_file = os.path.join('data', 'universe', f"{group}.universe.txt")
+    universe = read_ids(universe_file) if os.path.exists(universe_file) else None
+    print(f"Performing ranked {index['vocabulary']} enrichment analysis of {len(ranked_ids)} transcripts from {ranked_file}...")
+    with profiling.stage('ranked_enrichment', group=group) as metrics:
+        results = ranked_enrichment(index, ranked_ids, scores, universe, parameters['pvalue_cutoff'], parameters['category_size'],
+                                    parameters.get('ranked_max_cutoff'), parameters.get('running_sum', False))
+        metrics['items'] = len(ranked_ids)
+
+    output_folder = group_folder(parameters, group, index)
+    os.makedirs(output_folder, exist_ok=True)
+    with profiling.stage('write_results', group=group) as metrics:
+        output_txt = write_results(results, ranked_file, output_folder, parameters['pvalue_cutoff'])
+        metrics['items'] = len(results)
+    outputs = [write_tests(results, ranked_file, output_folder, parameters['pvalue_cutoff'])]
+    missing_file = report_missing_ids(index, ranked_ids, ranked_file, output_folder)
+    if missing_file is not None:
+        outputs.append(missing_file)
+    if output_txt is not None:
+        outputs += [output_txt, output_txt.replace('_IDs_Pvalues.txt', '.txt'), output_txt.replace('_IDs_Pvalues.txt', '.png')]
+    return results, outputs
 
 def enrichment_analysis():
     '''
@@ -88,22 +328,26 @@ def enrichment_analysis():
 
     Returns:
 
-    - results: DataFrame with the results of the enrichment analysis.
+    - results: Dictionary with the vocabularies of the 'vocabularies' parameter (by default, only 'GO') as keys
+      and, as values, dictionaries with the groups as keys and the DataFrames with their results as values.
     '''
-    # Assuming select_files() returns the file paths for candidates, universe, and background
-    grouped_files, background = select_files()
+    # Assuming select_files() returns the file paths for candidates, universe, and annotation
+    grouped_files, annotation_file = select_files()
 
     parameters = {}
     with open('params.json', 'r') as file:
         parameters = json.load(file)
 
-        
-    for group, files in grouped_files.items():
-        for candidate_file, universe_file in zip(files['candidates'], files['universe']):
-            output_folder = os.path.join(parameters["output_folder"], group) #The output folder will be named after the group name. E.g., the example candidates filename is 'aa.candidates.txt', so the output folder will be 'aa'
-            os.makedirs(output_folder, exist_ok=True)
-            print(f"Performing enrichment analysis for {group} with candidates {candidate_file} and universe {universe_file}...")
-            background = r"data/annotation/background.txt"
+    # Every background is loaded and propagated once per vocabulary, then shared by all its groups
+    results = {}
+    for background in select_backgrounds(list(grouped_files), annotation_file, parameters).values():
+        for vocabulary in parameters.get('vocabularies', ['GO']):
+            index = load_annotation_index(background['annotation'], background['parameters'], vocabulary)
 
-            os.system(f"Rscript src/R_enrichment.R --candidates_ids {candidate_file} --universe_ids {universe_file} --output_folder {output_folder} --annotation_df {background} --pvalue_cutoff {parameters['pvalue_cutoff']} --category_size {parameters['category_size']}")
+            # Groups that share the same universe are tested together in one sparse batch
+            background_files = {group: grouped_files[group] for group in background['groups']}
+            for universe, batch in universe_batches(background_files):
+                batch_results, _ = enrich_files(index, universe, batch, background['parameters'])
+                results.setdefault(vocabulary, {}).update(batch_results)
 
+    return results
@@ -0,0 +1,366 @@
+import os
+import json
+import glob
+import time
+import socket
+import hashlib
+import argparse
+import threading
+import socketserver
+import http.client
+from collections import OrderedDict, Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import numpy as np
+import pandas as pd
+from background_cache import load_background
+from go_ontology import load_go_ontology
+from go_enrichment import build_annotation_index, enrich_batch, universe_view, ONTOLOGIES
+from gene_mapping import load_gene_map
+
+# Number of universes kept restricted in memory, per service
+MAX_UNIVERSES = 8
+DEFAULT_PORT = 8100
+
+
+def load_indexes(backgrounds, go_obo, gene_map=None, memory_budget=None, spill_folder=None, go_release=None):
+    '''
+    Function to load the GO ontology once and the annotation index of every background.
+
+    Args:
+    - backgrounds: Dictionary with background names as keys and eggNOG-mapper file paths as values
+    - go_obo: Path to the GO OBO file
+    - gene_map: 'trinity' or path to a transcript-to-gene map, to collapse the transcripts into genes (see
+      gene_mapping.load_gene_map). By default, None.
+    - memory_budget: Memory budget in MB to build the caches and indexes out of core (see
+      go_enrichment.build_annotation_index). By default, None.
+    - spill_folder: Folder of the temporary files of the out-of-core indexes. By default, the temporary folder
+      of the system.
+    - go_release: GO release to use (see go_ontology.load_go_ontology). By default, None.
+
+    Returns:
+    - indexes: Dictionary with the background names as keys and annotation indexes (see
+      go_enrichment.build_annotation_index) as values
+    '''
+    terms, alt_ids = load_go_ontology(go_obo, go_release)
+    gene_map = load_gene_map(gene_map)
+    indexes = {}
+    for name, annotation_file in backgrounds.items():
+        print(f"Loading background {name} from {annotation_file}...")
+        background = load_background(annotation_file, memory_budget=memory_budget)
+        indexes[name] = build_annotation_index(background, terms, alt_ids, gene_map, memory_budget, spill_folder)
+    return indexes
+
+
+def service_state(indexes, parameters=None, max_universes=MAX_UNIVERSES):
+    '''
+    Function to create the state shared by the threads of an enrichment service.
+
+    Args:
+    - indexes: Dictionary as returned by load_indexes
+    - parameters: Dictionary with the default 'pvalue_cutoff', 'category_size' and 'conditional' of the
+      requests, as in params.json. By default, 0.01, 5 and True.
+    - max_universes: Number of universes kept in the LRU cache. By default, 8.
+
+    Returns:
+    - service: Dictionary with the indexes, the parameters, the cache of universes, request counters and a lock
+    '''
+    return {'indexes': indexes, 'parameters': parameters or {}, 'max_universes': max_universes,
+            'universes': OrderedDict(), 'counts': Counter(), 'lock': threading.Lock()}
+
+
+def universe_digest(universe):
+    return hashlib.sha256('\n'.join(sorted(set(universe))).encode()).hexdigest()
+
+
+def get_universe(service, background, universe=None, universe_id=None):
+    '''
+    Function to get the view of a universe (see go_enrichment.universe_view) from the LRU cache of the
+    service. On a miss the index is restricted to the universe and the least recently used universe is
+    evicted if the cache is full.
+
+    Args:
+    - service: Dictionary as returned by service_state
+    - background: Name of the background
+    - universe: List of universe transcript IDs. Either universe or universe_id must be given.
+    - universe_id: Digest of a universe sent in a previous request
+
+    Returns:
+    - universe_id: Digest of the universe
+    - view: View of the universe
+    - cached: Whether the view was in the cache
+    '''
+    if universe is not None:
+        universe_id = universe_digest(universe)
+    key = (background, universe_id)
+    with service['lock']:
+        view = service['universes'].get(key)
+        if view is not None:
+            service['universes'].move_to_end(key)
+            service['counts']['universe_hits'] += 1
+            return universe_id, view, True
+    if universe is None:
+        raise KeyError(f"Unknown universe {universe_id}, send its transcript IDs again")
+
+    # Concurrent misses of the same universe compute it twice, but requests for other universes are not blocked
+    view = universe_view(service['indexes'][background], universe)
+    with service['lock']:
+        service['counts']['universe_misses'] += 1
+        service['universes'][key] = view
+        while len(service['universes']) > service['max_universes']:
+            service['universes'].popitem(last=False)
+    return universe_id, view, False
+
+
+def format_results(results):
+    '''
+    Function to convert the results of a candidate list into JSON records, with the GO ID of every
+    ontology in a single 'GO' field. Infinite odds ratios are written as 'Inf', as in the results files.
+    '''
+    go_ids = results[[f'GO{ontology}ID' for ontology in ONTOLOGIES]].bfill(axis=1).iloc[:, 0]
+    records = pd.DataFrame({'Ontology': results['Ontology'], 'GO': go_ids, 'Term': results['Term'],
+                            'Pvalue': results['Pvalue'], 'OddsRatio': results['OddsRatio'], 'ExpCount': results['ExpCount'],
+                            'Count': results['Count'], 'Size': results['Size']}).to_dict('records')
+    for record in records:
+        odds_ratio = record['OddsRatio']
+        record['OddsRatio'] = 'Inf' if np.isinf(odds_ratio) else None if np.isnan(odds_ratio) else odds_ratio
+    return records
+
+
+def enrichment_request(service, request):
+    '''
+    Function to answer an enrichment request.
+
+    Args:
+    - service: Dictionary as returned by service_state
+    - request: Dictionary with:
+      - 'candidates': List of candidate transcript IDs, or 'candidate_sets': dictionary with names as keys
+        and lists of candidate IDs as values, tested together in one batch
+      - 'universe': List of universe transcript IDs, or 'universe_id': the 'universe_id' returned by a
+        previous request, to avoid sending the same universe again
+      - 'background': Name of the background. Optional if the service has only one.
+      - 'pvalue_cutoff', 'category_size' and 'conditional': Optional, the defaults of the service are used
+
+    Returns:
+    - response: Dictionary with the 'background', the 'universe_id', the 'universe_size' (universe
+      transcripts found in the background), whether the universe was 'cached', the 'results' of every
+      candidate list (see format_results) and the 'seconds' spent
+    '''
+    start = time.perf_counter()
+    if not isinstance(request, dict):
+        raise ValueError("The request must be a JSON object")
+    indexes = service['indexes']
+    background = request.get('background', next(iter(indexes)) if len(indexes) == 1 else None)
+    if background not in indexes:
+        raise KeyError(f"Unknown background {background}, the service has: {', '.join(indexes)}")
+
+    if 'candidate_sets' in request:
+        candidate_sets = request['candidate_sets']
+    elif 'candidates' in request:
+        candidate_sets = {'candidates': request['candidates']}
+    else:
+        raise ValueError("The request must have 'candidates' or 'candidate_sets'")
+    if not isinstance(candidate_sets, dict) or not all(isinstance(ids, list) for ids in candidate_sets.values()):
+        raise ValueError("'candidate_sets' must map names to lists of transcript IDs")
+    if not isinstance(request.get('universe', []), list):
+        raise ValueError("'universe' must be a list of transcript IDs")
+    if request.get('universe') is None and request.get('universe_id') is None:
+        raise ValueError("The request must have 'universe' or 'universe_id'")
+
+    parameters = service['parameters']
+    pvalue_cutoff = float(request.get('pvalue_cutoff', parameters.get('pvalue_cutoff', 0.01)))
+    category_size = int(request.get('category_size', parameters.get('category_size', 5)))
+    conditional = bool(request.get('conditional', parameters.get('conditional', True)))
+
+    universe_id, view, cached = get_universe(service, background, request.get('universe'), request.get('universe_id'))
+    batch_results = enrich_batch(indexes[background], candidate_sets, view, pvalue_cutoff, category_size, conditional)
+    return {'background': background, 'universe_id': universe_id, 'universe_size': view['size'], 'cached': cached,
+            'results': {name: format_results(results) for name, results in batch_results.items()},
+            'seconds': time.perf_counter() - start}
+
+
+def service_status(service):
+    with service['lock']:
+        return {'backgrounds': {name: {'transcripts': len(index['transcripts']), 'terms': len(index['terms'])}
+                                for name, index in service['indexes'].items()},
+                'universes': len(service['universes']), 'max_universes': service['max_universes'],
+                'counts': dict(service['counts'])}
+
+
+class EnrichmentHandler(BaseHTTPRequestHandler):
+    # Connections are kept open between requests, so clients calling the service in a loop do not reconnect
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, content, status=200):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/status':
+            return self.send_json({'error': 'Not Found'}, 404)
+        self.send_json(service_status(self.server.service))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if urlparse(self.path).path != '/enrich':
+            return self.send_json({'error': 'Not Found'}, 404)
+
+        service = self.server.service
+        with service['lock']:
+            service['counts']['requests'] += 1
+        try:
+            response = enrichment_request(service, json.loads(body))
+        except KeyError as e:
+            return self.send_json({'error': e.args[0]}, 404)
+        except (ValueError, TypeError) as e:
+            return self.send_json({'error': str(e)}, 400)
+        self.send_json(response)
+
+
+class EnrichmentServer(ThreadingHTTPServer):
+    '''
+    Enrichment service over HTTP. Requests are answered in parallel threads that share the loaded backgrounds.
+
+    Args:
+    - address: (host, port) tuple. Port 0 picks a free port.
+    - indexes: Dictionary as returned by load_indexes
+    - parameters: Default parameters of the requests, see service_state
+    - max_universes: Number of universes kept in the LRU cache. By default, 8.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, indexes, parameters=None, max_universes=MAX_UNIVERSES):
+        super().__init__(address, EnrichmentHandler)
+        self.service = service_state(indexes, parameters, max_universes)
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+class UnixEnrichmentServer(socketserver.ThreadingUnixStreamServer):
+    '''
+    Enrichment service over a Unix socket, with the same API as EnrichmentServer. Only local processes with
+    access to the socket file can use it.
+
+    Args:
+    - path: Path to the socket file. An existing file is replaced.
+    - indexes, parameters, max_universes: See EnrichmentServer
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, indexes, parameters=None, max_universes=MAX_UNIVERSES):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, EnrichmentHandler)
+        self.service = service_state(indexes, parameters, max_universes)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def service_connection(address, timeout=None):
+    '''
+    Function to open a connection to an enrichment service, to be reused by several query_service calls.
+
+    Args:
+    - address: 'host:port' of an HTTP service, or path to the socket file of a Unix socket service
+    - timeout: Timeout in seconds. By default, None.
+
+    Returns:
+    - connection: http.client connection
+    '''
+    if ':' in address and not os.path.exists(address):
+        host, port = address.rsplit(':', 1)
+        return http.client.HTTPConnection(host, int(port), timeout=timeout)
+    return UnixHTTPConnection(address, timeout)
+
+
+def query_service(connection, request):
+    '''
+    Function to send an enrichment request to a service (see enrichment_request for its fields).
+
+    Args:
+    - connection: Connection as returned by service_connection
+    - request: Dictionary with the request
+
+    Returns:
+    - response: Dictionary with the response. An error answer raises a RuntimeError.
+    '''
+    connection.request('POST', '/enrich', body=json.dumps(request), headers={'Content-Type': 'application/json'})
+    answer = connection.getresponse()
+    response = json.loads(answer.read())
+    if answer.status != 200:
+        raise RuntimeError(f"Enrichment service error {answer.status}: {response.get('error')}")
+    return response
+
+
+def parse_backgrounds(values):
+    '''
+    Function to parse the backgrounds given in the command line as NAME=PATH or PATH (named after the file).
+    By default, every annotation file of data/annotation is used.
+    '''
+    backgrounds = {}
+    for value in values or sorted(glob.glob('data/annotation/*.annotation*')):
+        name, _, path = value.rpartition('=')
+        backgrounds[name or os.path.basename(path).split('.')[0]] = path
+    return backgrounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resident enrichment service that keeps the backgrounds loaded in memory')
+    parser.add_argument('backgrounds', nargs='*', help='eggNOG-mapper files, as PATH or NAME=PATH. By default, the files of data/annotation.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--socket', default=None, help='Listen on this Unix socket file instead of a TCP port')
+    parser.add_argument('--universes', type=int, default=MAX_UNIVERSES, help='Number of universes kept in memory. By default, 8.')
+    parser.add_argument('--params', default='params.json', help='Parameters file with the default request parameters and go_obo')
+    args = parser.parse_args()
+
+    parameters = {}
+    if os.path.exists(args.params):
+        with open(args.params, 'r') as file:
+            parameters = json.load(file)
+    backgrounds = parse_backgrounds(args.backgrounds)
+    if not backgrounds:
+        parser.error("No annotation file found in data/annotation, give the backgrounds as arguments")
+    indexes = load_indexes(backgrounds, parameters.get('go_obo', 'data/ontology/go-basic.obo'), parameters.get('gene_map'),
+                           parameters.get('memory_budget'), parameters.get('spill_folder'), parameters.get('go_release'))
+
+    if args.socket:
+        server = UnixEnrichmentServer(args.socket, indexes, parameters, args.universes)
+        print(f"Enrichment service listening on {args.socket}")
+    else:
+        server = EnrichmentServer((args.host, args.port), indexes, parameters, args.universes)
+        print(f"Enrichment service listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
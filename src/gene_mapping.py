@@ -0,0 +1,103 @@
+import re
+import numpy as np
+from scipy import sparse
+from background_cache import lookup_ids
+
+# Isoform suffix of Trinity transcript IDs, e.g. TRINITY_DN1000_c0_g1_i2 is an isoform of TRINITY_DN1000_c0_g1
+TRINITY_ISOFORM = re.compile(r'_i\d+$')
+
+
+def read_gene_map(file_path):
+    '''
+    Function to read a transcript-to-gene map with one tab-separated gene ID and transcript ID per line, as
+    the gene_trans_map file written by Trinity.
+
+    Args:
+    - file_path: Path to the map file
+
+    Returns:
+    - gene_map: Dictionary with 'transcripts' (sorted byte-string array of transcript IDs) and 'genes'
+      (byte-string array with the gene of each transcript)
+    '''
+    genes, transcripts = [], []
+    with open(file_path, 'r') as file:
+        for number, line in enumerate(file):
+            fields = line.strip().split('\t')
+            if not fields[0]:
+                continue
+            if len(fields) < 2:
+                raise ValueError(f"Line {number + 1} of {file_path} must have a gene ID and a transcript ID")
+            genes.append(fields[0])
+            transcripts.append(fields[1])
+
+    transcripts = np.char.encode(np.array(transcripts, dtype=str)) if transcripts else np.zeros(0, dtype=bytes)
+    genes = np.char.encode(np.array(genes, dtype=str)) if genes else np.zeros(0, dtype=bytes)
+    order = np.argsort(transcripts, kind='stable')
+    return {'transcripts': transcripts[order], 'genes': genes[order]}
+
+
+def load_gene_map(gene_map):
+    '''
+    Function to load the transcript-to-gene map given in params.json.
+
+    Args:
+    - gene_map: 'trinity' to remove the isoform suffix of Trinity transcript IDs, the path to a map file (see
+      read_gene_map) or None
+
+    Returns:
+    - gene_map: Dictionary as returned by read_gene_map, {'rule': 'trinity'} or None
+    '''
+    if not gene_map:
+        return None
+    if gene_map == 'trinity':
+        return {'rule': 'trinity'}
+    return read_gene_map(gene_map)
+
+
+def gene_ids(gene_map, ids):
+    '''
+    Function to translate transcript IDs to gene IDs. IDs that are not in the map (e.g. gene IDs) are kept.
+
+    Args:
+    - gene_map: Dictionary as returned by load_gene_map
+    - ids: List of transcript IDs
+
+    Returns:
+    - genes: List of gene IDs, in the same order as ids
+    '''
+    ids = list(ids)
+    if gene_map.get('rule') == 'trinity':
+        return [TRINITY_ISOFORM.sub('', transcript) for transcript in ids]
+    codes = lookup_ids(gene_map['transcripts'], ids)
+    mapped = np.char.decode(gene_map['genes'][np.maximum(codes, 0)]).tolist() if len(gene_map['genes']) else [''] * len(ids)
+    return [gene if code >= 0 else transcript for transcript, gene, code in zip(ids, mapped, codes)]
+
+
+def collapse_background(background, gene_map):
+    '''
+    Function to collapse the transcripts of a background into genes. The annotation of a gene is the union
+    of the annotations of its transcripts, so every isoform counts once in the enrichment.
+
+    Args:
+    - background: Background as returned by background_cache.load_background
+    - gene_map: Dictionary as returned by load_gene_map
+
+    Returns:
+    - background: Background with the same arrays, where 'transcripts' are the sorted gene IDs, plus
+      'isoforms' (number of background transcripts of each gene)
+    '''
+    genes = np.array(gene_ids(gene_map, np.char.decode(background['transcripts'])), dtype=str)
+    unique_genes, codes = np.unique(genes, return_inverse=True)
+    n_transcripts, n_terms = len(genes), len(background['terms'])
+    annotation = sparse.csr_matrix((np.ones(len(background['indices']), dtype=np.int32), background['indices'], background['indptr']),
+                                   shape=(n_transcripts, n_terms))
+    collapse = sparse.csr_matrix((np.ones(n_transcripts, dtype=np.int32), (codes.ravel(), np.arange(n_transcripts))),
+                                 shape=(len(unique_genes), n_transcripts))
+    merged = (collapse @ annotation).tocsr()
+    merged.sort_indices()
+
+    return {'transcripts': np.char.encode(unique_genes) if len(unique_genes) else np.zeros(0, dtype=bytes),
+            'terms': background['terms'],
+            'indptr': merged.indptr.astype(np.int64),
+            'indices': merged.indices.astype(np.int32),
+            'isoforms': np.bincount(codes.ravel(), minlength=len(unique_genes))}
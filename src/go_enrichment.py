@@ -0,0 +1,749 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.special import gammaln
+from matplotlib.figure import Figure
+from go_ontology import ancestor_matrix, build_go_dag, closure_matrix
+from background_cache import budget_rows, lookup_ids
+from gene_mapping import collapse_background, gene_ids
+
+# Same ontology order as the former R_enrichment.R output
+ONTOLOGIES = ['BP', 'MF', 'CC']
+# Approximate memory used by every non-zero of the incidence matrices while a block of rows is processed out
+# of core: the sparse products, their sorted copies and the masks of the ontologies
+NONZERO_BYTES = 48
+
+
+def read_ids(file_path):
+    '''
+    Function to read a candidates or universe file with one transcript ID per line.
+
+    Args:
+    - file_path: Path to the IDs file
+
+    Returns:
+    - ids: List of unique, non-empty IDs in file order
+    '''
+    with open(file_path, 'r') as file:
+        ids = [line.strip() for line in file]
+    return list(dict.fromkeys(i for i in ids if i))
+
+
+def hypergeometric_sf(count, total, size, selected, chunk_size=1 << 22):
+    '''
+    Function to compute the upper tail P(X >= count) of the hypergeometric distribution for many tests at once.
+
+    Identical (count, size, selected) triples are computed only once, and each tail is summed in log space
+    relative to its first term, so very small p-values keep their precision.
+
+    Args:
+    - count: Array with the observed number of selected transcripts in each term
+    - total: Number of transcripts in the universe
+    - size: Array with the number of universe transcripts in each term
+    - selected: Array (or scalar) with the number of selected transcripts
+    - chunk_size: Maximum number of tail terms evaluated at once, to keep memory bounded
+
+    Returns:
+    - pvalues: Array of p-values with the same length as count
+    '''
+    count, size, selected = np.broadcast_arrays(np.asarray(count, dtype=np.int64), np.asarray(size, dtype=np.int64),
+                                                np.asarray(selected, dtype=np.int64))
+    if count.size == 0:
+        return np.zeros(0)
+
+    # Deduplicate the tests through integer keys, which is much cheaper than np.unique(axis=...)
+    _, pair_inverse = np.unique(size * (total + 1) + selected, return_inverse=True)
+    keys, first, inverse = np.unique(pair_inverse.ravel() * (int(count.max()) + 1) + count,
+                                     return_index=True, return_inverse=True)
+    count, size, selected = count[first], size[first], selected[first]
+
+    log_factorial = gammaln(np.arange(total + 1) + 1)
+
+    def log_comb(n, k):
+        return log_factorial[n] - log_factorial[k] - log_factorial[n - k]
+
+    lowest = np.maximum(size + selected - total, 0)
+    count = np.maximum(count, lowest)
+
+    # The hypergeometric distribution is log-concave, so away from the mode the terms of a tail decrease at
+    # least geometrically, with the ratio of its first two terms. Tails are cut once the remaining terms are
+    # below the float precision of the sum, which keeps long tails (large terms and lists) cheap. Counts
+    # below the mode are computed as one minus the lower tail, which decreases from count - 1 downwards.
+    upper_ratio = (size - count) * (selected - count) / ((count + 1.0) * (total - size - selected + count + 1.0))
+    lower = (upper_ratio >= 1) & (count > lowest)
+    first_term = np.where(lower, count - 1, count)
+    step = np.where(lower, -1, 1)
+    lengths = np.where(lower, count - lowest, np.maximum(np.minimum(size, selected) - count + 1, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(lower, first_term * (total - size - selected + first_term) / ((size - first_term + 1.0) * (selected - first_term + 1.0)),
+                         upper_ratio)
+        needed = np.ceil((37 - np.log1p(-ratio)) / -np.log(ratio)) + 1
+    decaying = (ratio > 0) & (ratio < 1)
+    lengths[decaying] = np.minimum(lengths[decaying], needed[decaying])
+    # At or below the lowest possible count, the tail is the whole distribution
+    certain = count <= lowest
+    lengths[certain] = 0
+    pvalues = np.zeros(len(count))
+
+    start = 0
+    while start < len(count):
+        stop = start + max(1, int(np.searchsorted(np.cumsum(lengths[start:]), chunk_size, side='right')))
+        chunk = np.arange(start, stop)
+        chunk = chunk[lengths[chunk] > 0]
+        lens = lengths[chunk]
+        if len(chunk):
+            offsets = np.cumsum(lens) - lens
+            x = np.repeat(first_term[chunk], lens) + np.repeat(step[chunk], lens) * (np.arange(lens.sum()) - np.repeat(offsets, lens))
+            s = np.repeat(size[chunk], lens)
+            k = np.repeat(selected[chunk], lens)
+            log_pmf = log_comb(s, x) + log_comb(total - s, k - x) - log_comb(total, k)
+            head = log_pmf[offsets]
+            tail = np.add.reduceat(np.exp(log_pmf - np.repeat(head, lens)), offsets)
+            pvalues[chunk] = np.exp(head + np.log(tail))
+        start = stop
+    pvalues[lower] = 1 - pvalues[lower]
+    pvalues[certain] = 1
+
+    return np.minimum(pvalues, 1.0)[inverse.ravel()]
+
+
+def row_blocks(indptr, max_nonzeros):
+    '''
+    Function to split the rows of a CSR matrix into blocks of consecutive rows with about max_nonzeros
+    non-zero values each (a longer row is a block of its own).
+
+    Args:
+    - indptr: Index pointer array of the CSR matrix (or any cumulative count of the rows)
+    - max_nonzeros: Number of non-zero values of every block
+
+    Returns:
+    - bounds: Array with the first row of every block, followed by the number of rows
+    '''
+    n_rows = len(indptr) - 1
+    targets = np.arange(max_nonzeros, int(indptr[-1]), max_nonzeros)
+    return np.unique(np.concatenate([[0], np.searchsorted(indptr, targets, side='right') - 1, [n_rows]])).astype(np.int64)
+
+
+def spill_incidence(background, closure, namespaces, memory_budget, spill_folder=None):
+    '''
+    Function to build the incidence matrices of an annotation index out of core, for backgrounds too large to
+    be propagated in memory. The background is propagated in blocks of transcripts within the memory budget,
+    and the columns of every ontology are spilled to disk and memory-mapped, so the matrices are read from the
+    page cache when they are used instead of being held in memory.
+
+    Args:
+    - background: Background as returned by background_cache.load_background
+    - closure: Closure matrix of the background terms (see go_ontology.closure_matrix), or None to keep the
+      terms of the background as they are
+    - namespaces: Dictionary with the ontologies as keys and, as values, boolean arrays marking their terms
+    - memory_budget: Memory budget in MB
+    - spill_folder: Folder of the temporary files. By default, the temporary folder of the system.
+
+    Returns:
+    - incidence: Dictionary with the CSR transcript-by-term incidence matrix of every ontology, with
+      memory-mapped indices and data
+    - term_size: Array with the number of transcripts annotated to every term
+    '''
+    indptr, indices = background['indptr'], background['indices']
+    n_rows = len(indptr) - 1
+    n_terms = len(background['terms']) if closure is None else closure.shape[1]
+    max_nonzeros = budget_rows(memory_budget, NONZERO_BYTES)
+
+    # Upper bound of the propagated non-zeros of every transcript, so the blocks are cut before propagating them
+    bound = np.zeros(n_rows + 1, dtype=np.int64)
+    term_bound = np.ones(len(background['terms']), dtype=np.int64) if closure is None else np.diff(closure.indptr)
+    bounds = row_blocks(indptr, max_nonzeros)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        first = indptr[start]
+        cumulative = np.concatenate([[0], np.cumsum(term_bound[indices[first:indptr[end]]])])
+        bound[start + 1:end + 1] = bound[start] + cumulative[np.asarray(indptr[start + 1:end + 1]) - first]
+    bounds = row_blocks(bound, max_nonzeros)
+
+    if spill_folder:
+        os.makedirs(spill_folder, exist_ok=True)
+    folder = tempfile.mkdtemp(suffix='.spill', dir=spill_folder)
+    try:
+        row_nnz = {ontology: np.zeros(n_rows, dtype=np.int64) for ontology in namespaces}
+        term_size = np.zeros(n_terms, dtype=np.int64)
+        files = {ontology: open(os.path.join(folder, f'{ontology}.indices'), 'wb') for ontology in namespaces}
+        try:
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                first, last = indptr[start], indptr[end]
+                block = sparse.csr_matrix((np.ones(last - first, dtype=np.int32), np.asarray(indices[first:last]),
+                                           np.asarray(indptr[start:end + 1]) - first), shape=(end - start, len(background['terms'])))
+                if closure is not None:
+                    block = (block @ closure).tocsr()
+                block.sum_duplicates()
+                term_size += np.bincount(block.indices, minlength=n_terms)
+                for ontology, is_ontology in namespaces.items():
+                    keep = is_ontology[block.indices]
+                    kept = np.concatenate([[0], np.cumsum(keep)])[block.indptr]
+                    row_nnz[ontology][start:end] = np.diff(kept)
+                    files[ontology].write(block.indices[keep].astype(np.int32).tobytes())
+                del block
+        finally:
+            for file in files.values():
+                file.close()
+
+        # The data of all the matrices are ones, read from a single file
+        n_nonzeros = {ontology: int(row_nnz[ontology].sum()) for ontology in namespaces}
+        ones_file = os.path.join(folder, 'ones')
+        total = max(n_nonzeros.values())
+        ones = np.ones(max(min(total, max_nonzeros), 1), dtype=np.int32)
+        with open(ones_file, 'wb') as file:
+            for start in range(0, total, len(ones)):
+                file.write(ones[:total - start].tobytes())
+
+        incidence = {}
+        for ontology in namespaces:
+            # 32-bit index arrays are used as they are by scipy, without loading them
+            index_dtype = np.int32 if n_nonzeros[ontology] < np.iinfo(np.int32).max else np.int64
+            ontology_indptr = np.zeros(n_rows + 1, dtype=index_dtype)
+            np.cumsum(row_nnz[ontology], out=ontology_indptr[1:])
+            if n_nonzeros[ontology]:
+                ontology_indices = np.memmap(os.path.join(folder, f'{ontology}.indices'), dtype=np.int32, mode='r').astype(index_dtype, copy=False)
+                data = np.memmap(ones_file, dtype=np.int32, mode='r', shape=(n_nonzeros[ontology],))
+            else:
+                ontology_indices, data = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+            incidence[ontology] = sparse.csr_matrix((data, ontology_indices, ontology_indptr), shape=(n_rows, n_terms))
+    finally:
+        # The memory maps keep the data of the removed files until they are closed
+        shutil.rmtree(folder, ignore_errors=True)
+    return incidence, term_size
+
+
+def build_annotation_index(background, terms, alt_ids, gene_map=None, memory_budget=None, spill_folder=None):
+    '''
+    Function to propagate the background to all ancestor GO terms and encode it as sparse transcript-by-GO
+    matrices so that every group can be tested with array operations only.
+
+    Args:
+    - background: Background as returned by background_cache.load_background
+    - terms: Dictionary of GO terms as returned by go_ontology.parse_obo
+    - alt_ids: Dictionary mapping secondary GO IDs to their primary GO ID
+    - gene_map: Transcript-to-gene map as returned by gene_mapping.load_gene_map. If given, the transcripts
+      are collapsed into genes (see gene_mapping.collapse_background), and the IDs of the candidates and
+      universes are translated to genes when they are looked up (see index_codes). By default, None.
+    - memory_budget: Memory budget in MB. If given, the index is built out of core (see spill_incidence), and
+      the universes are restricted and tested in blocks of transcripts within the budget (see universe_blocks).
+      By default, None (in memory).
+    - spill_folder: Folder of the temporary files of the out-of-core index. By default, the temporary folder
+      of the system.
+
+    Returns:
+    - index: Dictionary with 'transcripts' (sorted byte-string array of transcript IDs), 'terms' (Index of
+      GO IDs), 'names' (array of term names), 'dag' (GO DAG of the background terms, see
+      go_ontology.build_go_dag), 'ancestors' (CSR term-by-strict-ancestor matrix), 'term_size' (number of
+      background transcripts annotated to each term), 'ontology_size' (number of annotated background
+      transcripts per ontology) and, for each ontology, a CSR transcript-by-GO incidence matrix with the
+      propagated annotations. With a gene map, 'transcripts' are gene IDs and 'gene_map' is the map.
+      'vocabulary' is 'GO', 'ontologies' the list of ontologies tested (ONTOLOGIES) and 'memory_budget'
+      the memory budget.
+    '''
+    if gene_map is not None:
+        background = collapse_background(background, gene_map)
+    n_transcripts = len(background['transcripts'])
+    go_ids = np.char.decode(background['terms'])
+    dag = build_go_dag(terms, alt_ids, go_ids)
+
+    index = {'transcripts': background['transcripts'],
+             'terms': pd.Index(dag['ids']),
+             'names': dag['names'],
+             'dag': dag,
+             'ancestors': ancestor_matrix(dag, include_self=False),
+             'ontology_size': {},
+             'gene_map': gene_map,
+             'vocabulary': 'GO',
+             'ontologies': ONTOLOGIES,
+             'memory_budget': memory_budget}
+    if memory_budget:
+        namespaces = {ont: dag['namespace'] == ont for ont in ONTOLOGIES}
+        incidence, index['term_size'] = spill_incidence(background, closure_matrix(go_ids, dag), namespaces, memory_budget, spill_folder)
+        for ont in ONTOLOGIES:
+            index[ont] = incidence[ont]
+            index['ontology_size'][ont] = int((np.diff(index[ont].indptr) > 0).sum())
+        return index
+
+    annotation = sparse.csr_matrix((np.ones(len(background['indices']), dtype=np.int32), background['indices'], background['indptr']),
+                                   shape=(n_transcripts, len(background['terms'])))
+    propagated = (annotation @ closure_matrix(go_ids, dag)).tocsr()
+    propagated.data[:] = 1
+    index['term_size'] = np.asarray(propagated.sum(axis=0)).ravel()
+    for ont in ONTOLOGIES:
+        ontology_annotation = propagated @ sparse.diags((dag['namespace'] == ont).astype(np.int32), dtype=np.int32)
+        ontology_annotation.eliminate_zeros()
+        index[ont] = ontology_annotation.tocsr()
+        index['ontology_size'][ont] = int((index[ont].getnnz(axis=1) > 0).sum())
+    return index
+
+
+def build_vocabulary_index(background, vocabulary, gene_map=None, memory_budget=None, spill_folder=None):
+    '''
+    Function to encode the background of a flat vocabulary (KEGG orthologs or pathways, Pfam domains or EC
+    numbers, see eggnog_to_gsc.VOCABULARIES) as an annotation index with the same layout as
+    build_annotation_index, so it is tested by the same functions as the GO ontologies. The vocabulary is
+    tested as a single ontology named after it, and its terms have no hierarchy to propagate.
+
+    Args:
+    - background: Background as returned by background_cache.load_background for the vocabulary
+    - vocabulary: Name of the vocabulary
+    - gene_map: Transcript-to-gene map as returned by gene_mapping.load_gene_map. By default, None.
+    - memory_budget: Memory budget in MB of the out-of-core index (see build_annotation_index). By default, None.
+    - spill_folder: Folder of the temporary files of the out-of-core index. By default, the temporary folder
+      of the system.
+
+    Returns:
+    - index: Dictionary as returned by build_annotation_index, where 'dag' and 'ancestors' are None, the
+      term names are their IDs, and the incidence matrix is stored under the vocabulary name
+    '''
+    if gene_map is not None:
+        background = collapse_background(background, gene_map)
+    n_transcripts = len(background['transcripts'])
+    term_ids = np.char.decode(background['terms']).astype(object)
+    if memory_budget:
+        incidence, term_size = spill_incidence(background, None, {vocabulary: np.ones(len(term_ids), dtype=bool)}, memory_budget, spill_folder)
+        annotation = incidence[vocabulary]
+    else:
+        annotation = sparse.csr_matrix((np.ones(len(background['indices']), dtype=np.int32), background['indices'], background['indptr']),
+                                       shape=(n_transcripts, len(term_ids)))
+        term_size = np.asarray(annotation.sum(axis=0)).ravel()
+
+    return {'transcripts': background['transcripts'],
+            'terms': pd.Index(term_ids),
+            'names': term_ids,
+            'dag': None,
+            'ancestors': None,
+            'term_size': term_size,
+            'ontology_size': {vocabulary: int((np.diff(annotation.indptr) > 0).sum())},
+            'gene_map': gene_map,
+            'vocabulary': vocabulary,
+            'ontologies': [vocabulary],
+            'memory_budget': memory_budget,
+            vocabulary: annotation}
+
+
+def id_column(ontology):
+    '''
+    Function to name the ID column of the results of an ontology, e.g. GOBPID for BP (as in R_enrichment.R)
+    and KEGG_PathwayID for the KEGG_Pathway vocabulary.
+    '''
+    return f'GO{ontology}ID' if ontology in ONTOLOGIES else f'{ontology}ID'
+
+
+def index_codes(index, ids):
+    '''
+    Function to find the rows of a list of transcript IDs in the annotation index. If the index was built
+    with a gene map, the IDs are translated to their genes first, so the isoforms of a gene share its row.
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - ids: List of transcript IDs
+
+    Returns:
+    - codes: Array with the row of each ID, or -1 if it is not in the background
+    '''
+    ids = list(ids)
+    if index.get('gene_map') is not None:
+        ids = gene_ids(index['gene_map'], ids)
+    return lookup_ids(index['transcripts'], ids)
+
+
+def missing_ids(index, ids):
+    '''
+    Function to find the IDs of a list that are not in the background, i.e. without GO annotation or not
+    named as in the eggNOG-mapper file.
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - ids: List of transcript IDs
+
+    Returns:
+    - missing: List of the IDs that are not in the background
+    '''
+    ids = list(ids)
+    return [transcript for transcript, code in zip(ids, index_codes(index, ids)) if code < 0]
+
+
+def universe_mask(index, universe):
+    '''
+    Function to mark the universe transcripts in the annotation index.
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - universe: List of universe transcript IDs
+
+    Returns:
+    - is_universe: Boolean array over index['transcripts']
+    '''
+    codes = index_codes(index, universe)
+    is_universe = np.zeros(len(index['transcripts']), dtype=bool)
+    is_universe[codes[codes >= 0]] = True
+    return is_universe
+
+
+def universe_blocks(index, ontology, is_universe):
+    '''
+    Function to iterate over the incidence matrix of the universe transcripts in an ontology, in blocks of
+    consecutive transcripts within the memory budget of the index (a single block without memory budget).
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - ontology: Ontology of the incidence matrix
+    - is_universe: Boolean array over index['transcripts'] marking the universe transcripts
+
+    Yields:
+    - start: First transcript of the block
+    - block: CSR incidence matrix of the transcripts of the block, where the transcripts outside the universe
+      have empty rows
+    '''
+    matrix = index[ontology]
+    if index.get('memory_budget'):
+        bounds = row_blocks(matrix.indptr, budget_rows(index['memory_budget'], NONZERO_BYTES))
+    else:
+        bounds = [0, matrix.shape[0]]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        block = sparse.diags(is_universe[start:end].astype(np.int32), dtype=np.int32) @ matrix[start:end]
+        yield start, block.tocsr()
+
+
+def universe_annotation(index, ontology, is_universe):
+    '''
+    Function to restrict the incidence matrix of an ontology to the universe transcripts. Out of core, the
+    rows of the universe are read block by block (see universe_blocks), so only they are loaded in memory.
+
+    Returns:
+    - annotation: CSR incidence matrix, where the transcripts outside the universe have empty rows
+    '''
+    blocks = [block for _, block in universe_blocks(index, ontology, is_universe)]
+    return blocks[0] if len(blocks) == 1 else sparse.vstack(blocks, format='csr')
+
+
+def universe_view(index, universe):
+    '''
+    Function to restrict the annotation index to a universe, so that the restriction can be reused by every
+    batch tested against the same universe.
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - universe: List of universe transcript IDs
+
+    Returns:
+    - view: Dictionary with 'is_universe' (see universe_mask), 'size' (number of universe transcripts found
+      in the background), 'sizes' (number of universe transcripts annotated to every term, per ontology) and,
+      for each ontology of the index, the CSR incidence matrix of the universe transcripts. Out of core (see
+      build_annotation_index), the incidence matrices are None and are read in blocks when they are tested.
+    '''
+    is_universe = universe_mask(index, universe)
+    view = {'is_universe': is_universe, 'size': int(is_universe.sum()), 'sizes': {}}
+    for ontology in index['ontologies']:
+        if index.get('memory_budget'):
+            view[ontology] = None
+            view['sizes'][ontology] = np.zeros(len(index['terms']), dtype=np.int64)
+            for _, block in universe_blocks(index, ontology, is_universe):
+                view['sizes'][ontology] += np.asarray(block.sum(axis=0)).ravel()
+        else:
+            view[ontology] = universe_annotation(index, ontology, is_universe)
+            view['sizes'][ontology] = np.asarray(view[ontology].sum(axis=0)).ravel()
+    return view
+
+
+def membership_matrix(index, candidate_sets, is_universe):
+    '''
+    Function to encode several candidate lists as one sparse set-by-transcript matrix.
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - candidate_sets: List of candidate transcript ID lists
+    - is_universe: Boolean array over index['transcripts'] marking the universe transcripts
+
+    Returns:
+    - membership: CSR matrix with one row per candidate list. Candidates outside the universe or
+      without annotation are left out.
+    '''
+    ids = [transcript for candidates in candidate_sets for transcript in candidates]
+    rows = np.repeat(np.arange(len(candidate_sets)), [len(candidates) for candidates in candidate_sets])
+    columns = index_codes(index, ids)
+    keep = columns >= 0
+    rows, columns = rows[keep], columns[keep]
+    keep = is_universe[columns]
+    membership = sparse.csr_matrix((np.ones(keep.sum(), dtype=np.int32), (rows[keep], columns[keep])),
+                                   shape=(len(candidate_sets), len(index['transcripts'])))
+    membership.data[:] = 1  # Duplicated IDs are summed by the constructor
+    return membership
+
+
+def hypergeometric_test(index, ontology, membership, is_universe, annotation=None):
+    '''
+    Function to run the one-sided (over-representation) hypergeometric test for every candidate list
+    and every term of an ontology at once.
+
+    The overlap counts of all (list, term) pairs come from a single sparse product, so the cost grows
+    with the number of non-zero overlaps instead of lists times terms.
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - ontology: Ontology to test ('BP', 'CC' or 'MF')
+    - membership: Set-by-transcript matrix as returned by membership_matrix
+    - is_universe: Boolean array over index['transcripts'] marking the universe transcripts
+    - annotation: Incidence matrix of the universe transcripts in the ontology, as in universe_view.
+      By default (and out of core), it is read in blocks from is_universe.
+
+    Returns:
+    - results: DataFrame with Set (row of membership), GO, Pvalue, OddsRatio, ExpCount, Count, Size and
+      Term columns for every pair with at least one candidate transcript in the term
+    '''
+    # Only universe transcripts annotated in this ontology take part in the test. Without the incidence matrix
+    # of the universe, the counts are summed over blocks of transcripts (see universe_blocks).
+    blocks = [(0, annotation)] if annotation is not None else universe_blocks(index, ontology, is_universe)
+    columns = membership.tocsc() if annotation is None and index.get('memory_budget') else membership
+    n_universe, n_selected, size, overlap = 0, 0, 0, 0
+    for start, block in blocks:
+        selection = membership if block.shape[0] == membership.shape[1] else columns[:, start:start + block.shape[0]]
+        annotated = (block.getnnz(axis=1) > 0).astype(np.int32)
+        n_universe += int(annotated.sum())
+        n_selected = n_selected + selection @ annotated
+        size = size + np.asarray(block.sum(axis=0)).ravel()
+        overlap = overlap + selection @ block
+    overlap = overlap.tocoo()
+    sets, term_codes, count = overlap.row, overlap.col, overlap.data.astype(np.int64)
+    size, n_selected = size[term_codes], n_selected[sets]
+
+    return test_results(index, sets, term_codes, count, size, n_selected, n_universe)
+
+
+def test_results(index, sets, term_codes, count, size, n_selected, n_universe):
+    '''
+    Function to compute the p-values, expected counts and odds ratios of a list of (set, term) tests.
+
+    Returns:
+    - results: DataFrame with Set, GO, Pvalue, OddsRatio, ExpCount, Count, Size and Term columns
+    '''
+    pvalues = hypergeometric_sf(count, n_universe, size, n_selected)
+    expected = size * n_selected / max(n_universe, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        odds_ratio = (count * (n_universe - size - n_selected + count)) / ((size - count) * (n_selected - count))
+
+    return pd.DataFrame({'Set': sets, 'GO': index['terms'][term_codes], 'Pvalue': pvalues, 'OddsRatio': odds_ratio,
+                         'ExpCount': expected, 'Count': count, 'Size': size, 'Term': index['names'][term_codes]})
+
+
+def conditional_test(index, ontology, membership, is_universe, pvalue_cutoff, annotation=None):
+    '''
+    Function to run the conditional (elim) hypergeometric test, which decorrelates parent and child terms.
+
+    Terms are tested from the leaves to the roots, one height level of the DAG at a time. When a term is
+    significant, its transcripts are removed from all its ancestors before they are tested, so a parent is
+    only reported if it is enriched beyond its significant children. Each level is tested with sparse array
+    operations and the removals are propagated through the precomputed ancestor matrix, so every term is
+    visited once per candidate list.
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - ontology: Ontology to test ('BP', 'CC' or 'MF')
+    - membership: Set-by-transcript matrix as returned by membership_matrix
+    - is_universe: Boolean array over index['transcripts'] marking the universe transcripts
+    - pvalue_cutoff: P-value threshold used to decide which terms are significant
+    - annotation: Incidence matrix of the universe transcripts in the ontology, as in universe_view.
+      By default, it is computed from is_universe.
+
+    Returns:
+    - results: DataFrame with the same columns as hypergeometric_test, computed on the conditional counts
+    '''
+    if annotation is None:
+        annotation = universe_annotation(index, ontology, is_universe)
+    annotation = annotation.tocsc()
+    annotated = annotation.getnnz(axis=1) > 0
+    n_universe = int(annotated.sum())
+    dag = index['dag']
+    ontology_terms = np.flatnonzero(dag['namespace'] == ontology)
+    heights = dag['height'][ontology_terms]
+    levels = [ontology_terms[heights == height] for height in np.unique(heights)]
+
+    results_list = []
+    for row in range(membership.shape[0]):
+        selected = (membership[row].toarray().ravel() > 0) & annotated
+        n_selected = int(selected.sum())
+        if n_selected == 0:
+            continue
+        removed = sparse.csc_matrix(annotation.shape, dtype=np.int32)
+
+        for level in levels:
+            block = annotation[:, level]
+            removed_block = removed[:, level]
+            if removed_block.nnz:
+                block = block - block.multiply(removed_block > 0)
+                block.eliminate_zeros()
+            count = np.asarray(block.T @ selected.astype(np.int32)).ravel()
+            tested = np.flatnonzero(count > 0)
+            if len(tested) == 0:
+                continue
+            size = block.getnnz(axis=0)[tested]
+            results = test_results(index, np.full(len(tested), row), level[tested], count[tested], size, n_selected, n_universe)
+            results_list.append(results)
+
+            significant = level[tested[results['Pvalue'].to_numpy() < pvalue_cutoff]]
+            if len(significant):
+                removed = (removed + annotation[:, significant] @ index['ancestors'][significant]).tocsc()
+
+    if not results_list:
+        return test_results(index, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                            np.zeros(0, dtype=np.int64), 0, n_universe)
+    return pd.concat(results_list, ignore_index=True)
+
+
+def enrich_batch(index, candidate_sets, universe, pvalue_cutoff=0.01, category_size=5, conditional=False,
+                 permutations=0, seed=0, workers=None):
+    '''
+    Function to perform the BP, MF and CC enrichment of many candidate lists that share one universe, or the
+    enrichment of the terms of another vocabulary if the index was built by build_vocabulary_index.
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - candidate_sets: Dictionary with names as keys and lists of candidate transcript IDs as values
+    - universe: List of universe transcript IDs, or a view of the universe as returned by universe_view
+    - pvalue_cutoff: P-value threshold to report a term. By default, 0.01.
+    - category_size: Minimum number of universe transcripts annotated to a term. By default, 5.
+    - conditional: Whether to use the conditional (elim) test instead of the classic one. By default, False.
+    - permutations: Number of random candidate sets used to add the EmpiricalPvalue and Qvalue columns (see
+      permutation_test.empirical_test). They are computed from the classic counts, also in the conditional
+      test. By default, 0 (no empirical p-values).
+    - seed: Random seed of the permutations. By default, 0.
+    - workers: Number of processes of the permutations. By default, the number of CPUs.
+
+    Returns:
+    - batch_results: Dictionary with the same keys as candidate_sets and, as values, DataFrames in the
+      layout of the former R_enrichment.R summary, with one GO<ontology>ID column per ontology (see id_column).
+      attrs['tests'] of every DataFrame has the number of terms tested in each ontology (see write_tests).
+    '''
+    names = list(candidate_sets)
+    view = universe if isinstance(universe, dict) else universe_view(index, universe)
+    is_universe = view['is_universe']
+    membership = membership_matrix(index, [candidate_sets[name] for name in names], is_universe)
+    if permutations:
+        from permutation_test import empirical_test
+        empirical = empirical_test(index, view, membership, permutations, category_size, seed, workers)
+
+    results_list = []
+    for ontology in index['ontologies']:
+        # Without a hierarchy (e.g. KEGG pathways), the conditional test is the classic one
+        if conditional and index['dag'] is not None:
+            results = conditional_test(index, ontology, membership, is_universe, pvalue_cutoff, view[ontology])
+        else:
+            results = hypergeometric_test(index, ontology, membership, is_universe, view[ontology])
+        results = results[(results['Pvalue'] < pvalue_cutoff) & (results['Size'] >= category_size)]
+        if permutations:
+            results = results.merge(empirical[empirical['Ontology'] == ontology].drop(columns='Ontology'),
+                                    on=['Set', 'GO'], how='left')
+        results = results.sort_values(['Set', 'Pvalue'], kind='stable').rename(columns={'GO': id_column(ontology)})
+        results.insert(0, 'Ontology', ontology)
+        results_list.append(results)
+
+    combined = pd.concat(results_list, ignore_index=True, sort=False)
+    combined = combined.sort_values('Set', kind='stable').reset_index(drop=True)
+    bounds = np.searchsorted(combined['Set'].to_numpy(), np.arange(len(names) + 1))
+    combined = combined.drop(columns='Set')
+    # Number of terms tested in every ontology, needed to correct the p-values of several files together
+    tests = {ontology: int((view['sizes'][ontology] >= category_size).sum()) for ontology in index['ontologies']}
+    batch_results = {}
+    for i, name in enumerate(names):
+        batch_results[name] = combined.iloc[bounds[i]:bounds[i + 1]].reset_index(drop=True)
+        batch_results[name].attrs['tests'] = dict(tests)
+    return batch_results
+
+
+def enrich_group(index, candidates, universe, pvalue_cutoff=0.01, category_size=5, conditional=False):
+    '''
+    Function to perform the BP, MF and CC enrichment of a candidate list against its universe.
+
+    Args:
+    - index: Annotation index as returned by build_annotation_index
+    - candidates: List of candidate transcript IDs
+    - universe: List of universe transcript IDs
+    - pvalue_cutoff: P-value threshold to report a term. By default, 0.01.
+    - category_size: Minimum number of universe transcripts annotated to a term. By default, 5.
+    - conditional: Whether to use the conditional (elim) test instead of the classic one. By default, False.
+
+    Returns:
+    - combined_results: DataFrame in the layout of the former R_enrichment.R summary, with one
+      GO<ontology>ID column per ontology
+    '''
+    return enrich_batch(index, {'candidates': candidates}, universe, pvalue_cutoff, category_size, conditional)['candidates']
+
+
+def write_tests(combined_results, candidates_file, output_folder, pvalue_cutoff):
+    '''
+    Function to write the number of terms tested in every ontology for a candidates file, next to its results.
+    Only the terms below the p-value cutoff are written to the results, so these numbers are needed to
+    correct the p-values of many files together (see shards.merge_shards).
+
+    Args:
+    - combined_results: DataFrame as returned by enrich_batch, with the numbers in attrs['tests']
+    - candidates_file: Path to the candidates file, used to name the output
+    - output_folder: Group output folder
+    - pvalue_cutoff: P-value threshold used in the analysis
+
+    Returns:
+    - tests_file: Path to the <name>_<pvalue_cutoff>_tests.json file
+    '''
+    output_name = os.path.splitext(os.path.basename(candidates_file))[0]
+    output_dir = os.path.join(output_folder, output_name)
+    os.makedirs(output_dir, exist_ok=True)
+    tests_file = os.path.join(output_dir, f"{output_name}_{pvalue_cutoff}_tests.json")
+    with open(tests_file, 'w') as file:
+        json.dump(combined_results.attrs.get('tests', {}), file)
+    return tests_file
+
+
+def write_results(combined_results, candidates_file, output_folder, pvalue_cutoff):
+    '''
+    Function to write the enrichment results with the same names and layout as R_enrichment.R.
+
+    Args:
+    - combined_results: DataFrame as returned by enrich_group
+    - candidates_file: Path to the candidates file, used to name the outputs
+    - output_folder: Group output folder
+    - pvalue_cutoff: P-value threshold used in the analysis
+
+    Returns:
+    - output_txt: Path to the *_IDs_Pvalues.txt file, or None if no term was enriched. In that case, the
+      results, plots and REVIGO folder of a previous run are removed, so they are not summarized or stored again.
+    '''
+    output_name = os.path.splitext(os.path.basename(candidates_file))[0]
+    output_dir = os.path.join(output_folder, output_name)
+    if combined_results.empty:
+        print(f"No enriched terms found for {candidates_file}")
+        for suffix in ['.txt', '_IDs_Pvalues.txt', '.png']:
+            stale_file = os.path.join(output_dir, f"{output_name}_{pvalue_cutoff}{suffix}")
+            if os.path.exists(stale_file):
+                os.remove(stale_file)
+        shutil.rmtree(os.path.join(output_dir, 'results_revigo'), ignore_errors=True)
+        return None
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    combined_output = os.path.join(output_dir, f"{output_name}_{pvalue_cutoff}.txt")
+    formatted = combined_results.copy()
+    formatted['OddsRatio'] = formatted['OddsRatio'].map(lambda value: 'Inf' if np.isinf(value) else '%.15g' % value)
+    formatted.to_csv(combined_output, sep='\t', index=False, na_rep='NA', float_format='%.15g')
+
+    id_columns = [id_column(ontology) for ontology in combined_results['Ontology'].unique()]
+    output_df = pd.DataFrame({'GOs': combined_results[id_columns].bfill(axis=1).iloc[:, 0],
+                              'Pvalues': combined_results['Pvalue']})
+    output_txt = os.path.join(output_dir, f"{output_name}_{pvalue_cutoff}_IDs_Pvalues.txt")
+    output_df.to_csv(output_txt, sep='\t', index=False, float_format='%.15g')
+
+    # The figure is created without pyplot so that groups can be written from several threads
+    fig = Figure(figsize=(8, 6))
+    ax = fig.subplots()
+    ax.hist(combined_results['Pvalue'], bins=np.arange(0, float(pvalue_cutoff) * 1.01, float(pvalue_cutoff) / 20),
+            color='skyblue', edgecolor='black')
+    ax.set_title(f"Histogram of p-values (pvalue = {pvalue_cutoff} )")
+    ax.set_xlabel('P-value')
+    ax.set_ylabel('Frequency')
+    fig.savefig(os.path.join(output_dir, f"{output_name}_{pvalue_cutoff}.png"), dpi=300)
+
+    return output_txt
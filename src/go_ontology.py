@@ -0,0 +1,287 @@
+import os
+import tempfile
+import requests
+import numpy as np
+from scipy import sparse
+
+GO_OBO_URL = "http://purl.obolibrary.org/obo/go/go-basic.obo"
+# go-basic.obo of a given GO release (e.g. 2024-01-17), from the archive of the GO Consortium
+GO_RELEASE_URL = "https://release.geneontology.org/{release}/ontology/go-basic.obo"
+# Seconds to connect to the server and between two blocks of the download
+DOWNLOAD_TIMEOUT = 60
+
+NAMESPACES = {'biological_process': 'BP', 'cellular_component': 'CC', 'molecular_function': 'MF'}
+
+# Relationships followed when propagating annotations to ancestor terms
+PROPAGATION_RELATIONSHIPS = ('is_a', 'part_of')
+
+
+def download_obo(obo_path, release=None, timeout=DOWNLOAD_TIMEOUT):
+    '''
+    Function to download the go-basic.obo release used to resolve GO terms offline. The file is downloaded to
+    a temporary path and moved into place once complete, so an interrupted download never leaves a partial
+    ontology, and several processes downloading it at the same time do not corrupt it.
+
+    Args:
+    - obo_path: Path where the ontology file will be saved
+    - release: Date of the GO release to download (e.g. '2024-01-17'). By default, None (the current release).
+    - timeout: Seconds to wait for the server to connect or send data. By default, 60.
+    '''
+    url = GO_RELEASE_URL.format(release=release) if release else GO_OBO_URL
+    os.makedirs(os.path.dirname(obo_path) or '.', exist_ok=True)
+    print(f"Downloading GO ontology from {url}...")
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(obo_path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f, requests.get(url, stream=True, timeout=timeout) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+            expected = r.headers.get('Content-Length')
+            if expected is not None and r.raw.tell() != int(expected):
+                raise IOError(f"Incomplete download of {url}: {r.raw.tell()} of {expected} bytes")
+        os.replace(tmp_path, obo_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def obo_release(obo_path):
+    '''
+    Function to read the release of an OBO file from the data-version line of its header.
+
+    Args:
+    - obo_path: Path to the go-basic.obo file
+
+    Returns:
+    - release: Release date, e.g. '2024-01-17' (or the data-version as written), or None if the file has none
+    '''
+    with open(obo_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.startswith('['):
+                break
+            if line.startswith('data-version:'):
+                return line.split(':', 1)[1].strip().replace('releases/', '')
+    return None
+
+
+def parse_obo(obo_path):
+    '''
+    Function to parse an OBO file into a dictionary of GO terms.
+
+    Args:
+    - obo_path: Path to the go-basic.obo file
+
+    Returns:
+    - terms: Dictionary with GO IDs as keys and sub-dictionaries with 'name', 'namespace' (BP, CC or MF)
+      and 'parents' (list of parent GO IDs) as values. Obsolete terms are skipped.
+    - alt_ids: Dictionary mapping secondary GO IDs to their primary GO ID
+    '''
+    terms = {}
+    alt_ids = {}
+    current = None
+
+    def store(term):
+        if term is not None and 'id' in term and not term.get('obsolete', False):
+            terms[term['id']] = {'name': term.get('name', ''),
+                                 'namespace': NAMESPACES.get(term.get('namespace')),
+                                 'parents': term['parents']}
+            for alt_id in term['alt_ids']:
+                alt_ids[alt_id] = term['id']
+
+    with open(obo_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith('['):
+                store(current)
+                current = {'parents': [], 'alt_ids': []} if line == '[Term]' else None
+                continue
+            if current is None or ': ' not in line:
+                continue
+            key, value = line.split(': ', 1)
+            if key == 'id':
+                current['id'] = value
+            elif key == 'name':
+                current['name'] = value
+            elif key == 'namespace':
+                current['namespace'] = value
+            elif key == 'alt_id':
+                current['alt_ids'].append(value)
+            elif key == 'is_obsolete':
+                current['obsolete'] = value == 'true'
+            elif key == 'is_a' and 'is_a' in PROPAGATION_RELATIONSHIPS:
+                current['parents'].append(value.split()[0])
+            elif key == 'relationship':
+                fields = value.split()
+                if fields[0] in PROPAGATION_RELATIONSHIPS:
+                    current['parents'].append(fields[1])
+        store(current)
+
+    return terms, alt_ids
+
+
+def load_go_ontology(obo_path, release=None):
+    '''
+    Function to load the GO ontology, downloading go-basic.obo first if it is not available locally.
+
+    Args:
+    - obo_path: Path to the go-basic.obo file
+    - release: Date of the GO release to use (e.g. '2024-01-17'), so the same inputs always give the same
+      results. It is downloaded if obo_path is missing, and an existing file of another release is an error.
+      By default, None (the file found, or the current release).
+
+    Returns:
+    - terms, alt_ids: See parse_obo
+    '''
+    if not os.path.exists(obo_path):
+        download_obo(obo_path, release)
+    found = obo_release(obo_path)
+    if release and found != release:
+        raise ValueError(f"{obo_path} is the GO release {found}, not {release}: remove it to download {release}, "
+                         f"or set go_obo to another path")
+    print(f"Loading GO ontology from {obo_path} (release {found or 'unknown'})...")
+    return parse_obo(obo_path)
+
+
+def build_go_dag(terms, alt_ids, go_ids=None):
+    '''
+    Function to build a compact GO DAG with integer term IDs.
+
+    Terms are numbered 0..n-1 and the parent links (within the same namespace) are stored as integer edge
+    arrays. Depths and heights are computed level by level with array operations, and the ancestors of every
+    term are precomputed as one bitset per term and namespace.
+
+    Args:
+    - terms: Dictionary of GO terms as returned by parse_obo
+    - alt_ids: Dictionary mapping secondary GO IDs to their primary GO ID
+    - go_ids: Optional list of GO IDs (e.g. the ones of a background). If given, the DAG only contains these
+      terms and their ancestors.
+
+    Returns:
+    - dag: Dictionary with 'ids' (list of GO IDs), 'codes' (dictionary GO ID -> integer ID, including alt_ids),
+      'names', 'namespace' (arrays), 'child' and 'parent' (edge arrays), 'depth' (longest path from a root),
+      'height' (longest path to a leaf) and 'bitsets' (dictionary namespace -> (term codes, packed uint64
+      ancestor bitsets, one row per term, bit j set when the j-th term of the namespace is an ancestor or itself))
+    '''
+    if go_ids is None:
+        selected = set(terms)
+    else:
+        selected = set()
+        stack = [alt_ids.get(go_id, go_id) for go_id in go_ids]
+        while stack:
+            go_id = stack.pop()
+            if go_id in terms and go_id not in selected:
+                selected.add(go_id)
+                stack.extend(terms[go_id]['parents'])
+
+    ids = sorted(selected)
+    codes = {go_id: code for code, go_id in enumerate(ids)}
+    namespace = np.array([terms[go_id]['namespace'] for go_id in ids], dtype=object)
+    edges = [(codes[go_id], codes[parent]) for go_id in ids for parent in terms[go_id]['parents']
+             if parent in codes and terms[parent]['namespace'] == terms[go_id]['namespace']]
+    child, parent = (np.array(column, dtype=np.int64) for column in zip(*edges)) if edges else (np.zeros(0, dtype=np.int64),) * 2
+
+    dag = {'ids': ids,
+           'codes': dict(codes, **{alt: codes[primary] for alt, primary in alt_ids.items() if primary in codes}),
+           'names': np.array([terms[go_id]['name'] for go_id in ids], dtype=object),
+           'namespace': namespace,
+           'child': child,
+           'parent': parent,
+           'depth': topological_levels(len(ids), parent, child),
+           'height': topological_levels(len(ids), child, parent)}
+    dag['bitsets'] = ancestor_bitsets(dag)
+    return dag
+
+
+def topological_levels(n_terms, source, target):
+    '''
+    Function to compute the length of the longest path reaching every node of a DAG, one level at a time.
+
+    Args:
+    - n_terms: Number of nodes
+    - source, target: Edge arrays (source -> target)
+
+    Returns:
+    - levels: Array with the level of each node (0 for nodes without incoming edges)
+    '''
+    levels = np.zeros(n_terms, dtype=np.int64)
+    remaining = np.bincount(target, minlength=n_terms)
+    frontier = np.flatnonzero(remaining == 0)
+    level = 0
+    while len(frontier):
+        levels[frontier] = level
+        outgoing = np.isin(source, frontier)
+        np.subtract.at(remaining, target[outgoing], 1)
+        reached = np.unique(target[outgoing])
+        frontier = reached[remaining[reached] == 0]
+        level += 1
+    return levels
+
+
+def ancestor_bitsets(dag):
+    '''
+    Function to compute the ancestor bitsets of every namespace, propagating the bits from the roots down one
+    depth level at a time.
+    '''
+    bitsets = {}
+    for ns in NAMESPACES.values():
+        ns_codes = np.flatnonzero(dag['namespace'] == ns)
+        local = np.full(len(dag['ids']), -1, dtype=np.int64)
+        local[ns_codes] = np.arange(len(ns_codes))
+        bits = np.zeros((len(ns_codes), -(-len(ns_codes) // 64)), dtype='<u8')
+        positions = np.arange(len(ns_codes))
+        bits[positions, positions // 64] = np.left_shift(np.uint64(1), (positions % 64).astype(np.uint64))
+
+        in_ns = local[dag['child']] >= 0
+        child, parent = local[dag['child'][in_ns]], local[dag['parent'][in_ns]]
+        child_depth = dag['depth'][ns_codes][child]
+        for depth in range(1, int(child_depth.max()) + 1 if len(child_depth) else 1):
+            at_depth = child_depth == depth
+            np.bitwise_or.at(bits, child[at_depth], bits[parent[at_depth]])
+        bitsets[ns] = (ns_codes, bits)
+    return bitsets
+
+
+def ancestor_matrix(dag, include_self=True):
+    '''
+    Function to expand the ancestor bitsets into a sparse term-by-ancestor matrix.
+
+    Args:
+    - dag: GO DAG as returned by build_go_dag
+    - include_self: Whether each term is listed as its own ancestor. By default, True.
+
+    Returns:
+    - ancestors: CSR matrix of shape (n_terms, n_terms) with a 1 at (term, ancestor)
+    '''
+    rows, cols = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for ns_codes, bits in dag['bitsets'].values():
+        # Only the non-zero 64-bit words are unpacked, the bitsets are very sparse
+        word_row, word_col = np.nonzero(bits)
+        unpacked = np.unpackbits(bits[word_row, word_col].view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+        position, bit = np.nonzero(unpacked)
+        rows.append(ns_codes[word_row[position]])
+        cols.append(ns_codes[word_col[position] * 64 + bit])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    if not include_self:
+        rows, cols = rows[rows != cols], cols[rows != cols]
+    n_terms = len(dag['ids'])
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(n_terms, n_terms))
+
+
+def closure_matrix(go_ids, dag):
+    '''
+    Function to build the sparse matrix that propagates annotations to all ancestor GO terms (true path rule),
+    so that a whole background is propagated with a single sparse product.
+
+    Args:
+    - go_ids: List of GO IDs as found in the background
+    - dag: GO DAG as returned by build_go_dag
+
+    Returns:
+    - closure: CSR matrix of shape (len(go_ids), n_terms) with a 1 where the DAG term (or the term itself)
+      applies to the background GO ID. GO IDs not present in the ontology have empty rows.
+    '''
+    codes = np.array([dag['codes'].get(go_id, -1) for go_id in go_ids], dtype=np.int64)
+    known = np.flatnonzero(codes >= 0)
+    selection = sparse.csr_matrix((np.ones(len(known), dtype=np.int32), (known, codes[known])),
+                                  shape=(len(go_ids), len(dag['ids'])))
+    return (selection @ ancestor_matrix(dag)).tocsr()
@@ -1,10 +1,28 @@
-from revigo_plotting import main as revigo_main
-from enrichment import enrichment_analysis
-import os
+from pipeline import run_pipeline
+from shards import parse_shard, merge_shards
+import argparse
+import json
 
 def main():
-    enrichment_analysis()
-    revigo_main()
-    os.system(f"Rscript src/3D_treemap.R")
+    parser = argparse.ArgumentParser(description='Run the enrichment analysis, the GO term summarization and the plots')
+    parser.add_argument('--force', action='store_true', help='Run every stage again, even the ones that are up to date')
+    parser.add_argument('--profile', action='store_true', help='Record the time, CPU, memory and I/O of every stage')
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='K/N',
+                        help='Only analyse the groups of the K-th of N shards, e.g. one shard per node')
+    parser.add_argument('--merge', action='store_true', help='Merge the shards of the output folder')
+    args = parser.parse_args()
 
-main()
\ No newline at end of file
+    with open('params.json', 'r') as file:
+        parameters = json.load(file)
+    if args.profile:
+        parameters['profile'] = True
+
+    if args.merge:
+        merge_shards(parameters)
+        return
+
+    # Stages are only rerun when their inputs, parameters or outputs changed since the last run
+    run_pipeline(parameters, args.force, args.shard)
+
+if __name__ == "__main__":
+    main()
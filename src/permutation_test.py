@@ -0,0 +1,186 @@
+import os
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from worker_budget import pool_workers
+
+# Number of random candidate sets drawn by each job. The random sets only depend on the seed and this size,
+# so the results do not change with the number of processes.
+BATCH_SIZE = 250
+
+# State of the worker processes, set once by init_worker
+_STATE = {}
+
+
+def benjamini_hochberg(pvalues, n_tests=None):
+    '''
+    Function to compute the Benjamini-Hochberg q-values (false discovery rate) of a family of p-values.
+
+    Args:
+    - pvalues: Array of p-values
+    - n_tests: Number of tests of the family, when only the lowest p-values are given (e.g. the ones below a
+      cutoff). The q-values are then exact when they are below the largest missing p-value, and an upper bound
+      otherwise. By default, the number of p-values.
+
+    Returns:
+    - qvalues: Array of q-values, in the same order as pvalues
+    '''
+    pvalues = np.asarray(pvalues, dtype=float)
+    n = len(pvalues)
+    qvalues = np.empty(n)
+    if n:
+        order = np.argsort(pvalues, kind='stable')
+        scaled = pvalues[order] * max(n_tests or n, n) / np.arange(1, n + 1)
+        qvalues[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+    return qvalues
+
+
+def random_prefixes(rng, n_items, length, n_draws):
+    '''
+    Function to draw random orderings of n_items items, truncated to their first items. Every prefix of a
+    row is a uniform random subset of its length, so the same draws serve candidate sets of any size.
+
+    Args:
+    - rng: numpy random Generator
+    - n_items: Number of items to choose from
+    - length: Number of items of each row
+    - n_draws: Number of rows
+
+    Returns:
+    - draws: Array of n_draws x length item indices, without repetitions within a row
+    '''
+    if length * 2 > n_items:
+        return rng.permuted(np.tile(np.arange(n_items), (n_draws, 1)), axis=1)[:, :length]
+
+    # Repeated items are drawn again until every row is a sample without replacement, then shuffled
+    draws = rng.integers(n_items, size=(n_draws, length))
+    while True:
+        draws.sort(axis=1)
+        repeated = np.zeros(draws.shape, dtype=bool)
+        repeated[:, 1:] = draws[:, 1:] == draws[:, :-1]
+        n_repeated = int(repeated.sum())
+        if n_repeated == 0:
+            break
+        draws[repeated] = rng.integers(n_items, size=n_repeated)
+    return rng.permuted(draws, axis=1)
+
+
+def count_exceedances(state, seed, n_draws):
+    '''
+    Function to count, for every tested (set, term) pair of an ontology, how many random candidate sets of
+    the same size have at least as many transcripts annotated to the term as the observed set.
+
+    The random sets are the prefixes of the same random orderings of the universe, taken in increasing order
+    of size, so the counts of all the sizes are updated incrementally with one sparse product per size.
+
+    Args:
+    - state: Dictionary with the 'annotation' matrix (annotated universe transcripts by tested terms) and the
+      'terms', 'counts' and 'sizes' (number of annotated candidates of the set) of the pairs, sorted by size
+    - seed: Seed of the random orderings (int or numpy SeedSequence)
+    - n_draws: Number of random sets of each size
+
+    Returns:
+    - exceedances: Array with the number of random sets at least as extreme as every pair
+    '''
+    annotation, terms, counts, sizes = state['annotation'], state['terms'], state['counts'], state['sizes']
+    exceedances = np.zeros(len(terms), dtype=np.int64)
+    if len(terms) == 0:
+        return exceedances
+
+    rng = np.random.default_rng(seed)
+    draws = random_prefixes(rng, annotation.shape[0], int(sizes[-1]), n_draws)
+    random_counts = np.zeros((n_draws, annotation.shape[1]), dtype=np.int32)
+    unique_sizes = np.unique(sizes)
+    bounds = np.searchsorted(sizes, np.append(unique_sizes, sizes[-1] + 1))
+    previous = 0
+    for number, size in enumerate(unique_sizes):
+        block = draws[:, previous:size]
+        selection = sparse.csr_matrix((np.ones(block.size, dtype=np.int32), block.ravel(),
+                                       np.arange(n_draws + 1) * block.shape[1]), shape=(n_draws, annotation.shape[0]))
+        increment = (selection @ annotation).tocoo()
+        random_counts[increment.row, increment.col] += increment.data
+        previous = size
+
+        pairs = slice(bounds[number], bounds[number + 1])
+        exceedances[pairs] += (random_counts[:, terms[pairs]] >= counts[pairs]).sum(axis=0)
+    return exceedances
+
+
+def init_worker(state):
+    _STATE.update(state)
+
+
+def worker_exceedances(ontology, seed, n_draws):
+    return count_exceedances(_STATE[ontology], seed, n_draws)
+
+
+def empirical_test(index, view, membership, n_permutations=1000, category_size=5, seed=0, workers=None):
+    '''
+    Function to compute empirical p-values of the over-representation of every term in many candidate lists
+    that share a universe, by drawing random candidate sets of the same size from the universe.
+
+    As in go_enrichment.hypergeometric_test, only the universe transcripts annotated in each ontology are
+    drawn, and the statistic of a term is the number of candidates annotated to it. The p-value of a pair is
+    (1 + number of random sets with at least the observed count) / (1 + n_permutations), and the q-values
+    control the false discovery rate over all the terms tested in the ontologies of each candidate list,
+    including the terms without candidates (whose p-value is 1). The random sets are
+    drawn in batches of BATCH_SIZE spread over a process pool, with one seed per ontology and batch derived
+    from seed, so the results are reproducible.
+
+    Args:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index
+    - view: View of the universe as returned by go_enrichment.universe_view
+    - membership: Set-by-transcript matrix as returned by go_enrichment.membership_matrix
+    - n_permutations: Number of random sets of each size. By default, 1000.
+    - category_size: Minimum number of universe transcripts annotated to a term. By default, 5.
+    - seed: Random seed. By default, 0.
+    - workers: Number of processes. By default, the number of CPUs, or in a pipeline run the free processes
+      of its worker budget.
+
+    Returns:
+    - results: DataFrame with Set (row of membership), Ontology, GO, EmpiricalPvalue and Qvalue columns for
+      every pair with at least one candidate transcript in the term
+    '''
+    from go_enrichment import universe_annotation
+    state, pairs, n_tests = {}, {}, 0
+    for ontology in index['ontologies']:
+        # Out of core, the view has no incidence matrix and the rows of the universe are loaded here
+        annotation = view[ontology] if view[ontology] is not None else universe_annotation(index, ontology, view['is_universe'])
+        annotated = annotation.getnnz(axis=1) > 0
+        tested = np.flatnonzero(view['sizes'][ontology] >= max(category_size, 1))
+        n_tests += len(tested)
+        n_selected = membership @ annotated.astype(np.int32)
+        overlap = (membership @ annotation[:, tested]).tocoo()
+        order = np.lexsort((overlap.col, n_selected[overlap.row]))
+        state[ontology] = {'annotation': annotation[annotated][:, tested].tocsr(), 'terms': overlap.col[order],
+                           'counts': overlap.data[order], 'sizes': n_selected[overlap.row[order]]}
+        pairs[ontology] = (overlap.row[order], tested[overlap.col[order]])
+
+    jobs = [(ontology, np.random.SeedSequence([seed, number, batch]), min(BATCH_SIZE, n_permutations - start))
+            for number, ontology in enumerate(index['ontologies']) if len(state[ontology]['terms'])
+            for batch, start in enumerate(range(0, n_permutations, BATCH_SIZE))]
+    exceedances = {ontology: np.zeros(len(state[ontology]['terms']), dtype=np.int64) for ontology in index['ontologies']}
+    # In a pipeline run, only the free processes of the worker budget are used (see worker_budget), so
+    # concurrent enrichment tasks do not start a pool of every CPU each
+    with pool_workers(min(workers or os.cpu_count() or 1, max(len(jobs), 1))) as workers:
+        if workers > 1:
+            # Worker processes are started with 'spawn', as in barplot_generator.plot_executor, and receive the
+            # annotation matrices once
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_worker, initargs=(state,)) as executor:
+                futures = [(ontology, executor.submit(worker_exceedances, ontology, job_seed, n_draws))
+                           for ontology, job_seed, n_draws in jobs]
+                for ontology, future in futures:
+                    exceedances[ontology] += future.result()
+        else:
+            for ontology, job_seed, n_draws in jobs:
+                exceedances[ontology] += count_exceedances(state[ontology], job_seed, n_draws)
+
+    results = pd.concat([pd.DataFrame({'Set': pairs[ontology][0], 'Ontology': ontology, 'GO': index['terms'][pairs[ontology][1]],
+                                       'EmpiricalPvalue': (1 + exceedances[ontology]) / (1 + n_permutations)})
+                         for ontology in index['ontologies']], ignore_index=True)
+    # Only the pairs with candidates are in the results, the other tested terms are in the family with p = 1
+    results['Qvalue'] = results.groupby('Set')['EmpiricalPvalue'].transform(lambda pvalues: benjamini_hochberg(pvalues, n_tests))
+    return results
@@ -0,0 +1,421 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from background_cache import file_digest
+from enrichment import (select_files, select_ranked_files, select_backgrounds, load_annotation_index, universe_batches, enrich_files,
+                        enrich_ranked_file)
+from revigo_plotting import process_file, plot_jobs, NAMESPACE_NAMES
+from barplot_generator import render_jobs, DEFERRED_FILE
+import profiling
+from revigo_client import REVIGO_URL
+from results_store import store_path, store_run
+from shards import select_shard, shard_parameters, write_shard_manifest
+from semantic_explorer import EXPLORER_FILE, scatterplot_files, write_explorer
+from worker_budget import idle_slot, start_budget, stop_budget, task_slot
+
+STATE_FILE = '.pipeline_state.json'
+
+
+def make_task(name, run, args=(), inputs=(), deps=(), params=None, group=None, tolerate_failures=False, after=()):
+    '''
+    Function to define a pipeline task.
+
+    Args:
+    - name: Unique name of the task
+    - run: Function executed by the task. It must return the list of paths of the files it writes.
+    - args: Arguments passed to run
+    - inputs: Paths of the input files. The outputs of the dependencies are inputs too.
+    - deps: Names of the tasks that must finish before this one
+    - params: Dictionary with the parameters that change the outputs of the task
+    - group: Group processed by the task, used in the profile. By default, None.
+    - tolerate_failures: Whether to run the task when some of its dependencies failed or were blocked, once
+      the others are finished (e.g. to store the results of the groups that succeeded). run then gets the
+      names of the tasks of the run that failed or were blocked as 'failed' keyword argument. By default, False.
+    - after: Names of the tasks that must finish before this one, like deps, but whose outputs are not inputs
+      of the task, e.g. a task writing the files of several groups of which the task only reads the one given
+      in inputs. By default, none.
+
+    Returns:
+    - task: Dictionary with the task definition
+    '''
+    return {'name': name, 'run': run, 'args': tuple(args), 'inputs': list(inputs), 'deps': list(deps) + list(after),
+            'after': list(after), 'params': params or {}, 'group': group, 'tolerate_failures': tolerate_failures}
+
+
+def read_state(state_file):
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as file:
+            return json.load(file)
+    return {'files': {}, 'tasks': {}}
+
+
+def write_state(state_file, state):
+    os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+    tmp_path = f"{state_file}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file, indent=2)
+    os.replace(tmp_path, state_file)
+
+
+def run_tasks(tasks, state_file, workers=None, force=False):
+    '''
+    Function to run a graph of tasks, skipping the ones that are up to date.
+
+    A task is up to date when the SHA-256 digests of its inputs (including the outputs of its dependencies,
+    except the ones it only runs after, see make_task) and its parameters match the ones of its last successful run, and its outputs still have the recorded
+    digests. File digests are reused while the size and modification time of a file do not change.
+    Ready tasks run concurrently in a single pool of workers, and the tasks that depend on a failed task are
+    not run, unless they tolerate failures (see make_task). The workers are also the budget of the process pools started by the tasks (see worker_budget),
+    so the whole run uses about as many processes. The state is saved after every task, so an interrupted run
+    resumes where it stopped.
+
+    Args:
+    - tasks: List of tasks as returned by make_task
+    - state_file: Path to the JSON file where the state of the tasks is kept
+    - workers: Number of tasks run at the same time, and budget of processes of the run. By default, the number of CPUs.
+    - force: Whether to run every task even if it is up to date. By default, False.
+
+    Returns:
+    - status: Dictionary with the task names as keys and 'done', 'skipped', 'failed' or 'blocked' as values
+    '''
+    by_name = {task['name']: task for task in tasks}
+    dependents = {name: [] for name in by_name}
+    waiting = {}
+    for task in tasks:
+        for dep in task['deps']:
+            if dep not in by_name:
+                raise ValueError(f"Task {task['name']} depends on unknown task {dep}")
+            dependents[dep].append(task['name'])
+        waiting[task['name']] = set(task['deps'])
+
+    state = read_state(state_file)
+    lock = threading.Lock()
+    status = {}
+
+    def digest(path):
+        if not os.path.exists(path):
+            return None
+        with lock:
+            manifest = {'sources': dict(state['files'])}
+        value = file_digest(path, manifest)
+        stat = os.stat(path)
+        with lock:
+            state['files'][os.path.abspath(path)] = {'digest': value, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        return value
+
+    def signature(task):
+        with lock:
+            dep_outputs = {dep: state['tasks'].get(dep, {}).get('outputs', {}) for dep in task['deps'] if dep not in task['after']}
+        content = {'params': task['params'],
+                   'inputs': {path: digest(path) for path in task['inputs']},
+                   'deps': dep_outputs}
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def execute(task):
+        with task_slot(), profiling.stage(f"task:{task['name'].split(':')[0]}", group=task['group'], task=task['name']) as metrics:
+            task_status = run_task(task)
+            metrics['status'] = task_status
+        return task_status
+
+    def run_task(task):
+        task_signature = signature(task)
+        with lock:
+            record = state['tasks'].get(task['name'])
+        if not force and record and record['signature'] == task_signature and \
+                all(digest(path) == value for path, value in record['outputs'].items()):
+            return 'skipped'
+
+        if task['tolerate_failures']:
+            # The tasks that failed or were blocked, so the task only uses the results of the others
+            with lock:
+                failed = sorted(name for name, value in status.items() if value in ('failed', 'blocked'))
+            outputs = task['run'](*task['args'], failed=failed)
+        else:
+            outputs = task['run'](*task['args'])
+        recorded = {path: digest(path) for path in outputs or []}
+        with lock:
+            state['tasks'][task['name']] = {'signature': task_signature,
+                                            'outputs': {path: value for path, value in recorded.items() if value is not None}}
+            write_state(state_file, state)
+        return 'done'
+
+    def release(name, names=None):
+        # Dependents of a finished task (by default, all of them) that have no other dependency left
+        ready = []
+        for dependent in dependents[name] if names is None else names:
+            if name in waiting[dependent]:
+                waiting[dependent].discard(name)
+                if not waiting[dependent] and dependent not in status:
+                    ready.append(dependent)
+        return ready
+
+    def block(name):
+        # Dependents of a failed task are blocked, except the ones that tolerate failures, which are released
+        ready = []
+        for dependent in dependents[name]:
+            if dependent in status:
+                continue
+            if by_name[dependent]['tolerate_failures']:
+                ready += release(name, [dependent])
+                continue
+            status[dependent] = 'blocked'
+            print(f"Task {dependent} not run, a task it depends on failed")
+            ready += block(dependent)
+        return ready
+
+    workers = workers or os.cpu_count() or 1
+    start_budget(workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {executor.submit(execute, by_name[name]): name for name, deps in waiting.items() if not deps}
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except Exception as e:
+                        status[name] = 'failed'
+                        print(f"Task {name} failed: {e!r}")
+                        # Its outputs may have been removed or left incomplete, so its dependents see the change
+                        with lock:
+                            state['tasks'].pop(name, None)
+                        ready = block(name)
+                    else:
+                        if status[name] == 'skipped':
+                            print(f"Task {name} is up to date")
+                        ready = release(name)
+                    for dependent in ready:
+                        running[executor.submit(execute, by_name[dependent])] = dependent
+    finally:
+        stop_budget()
+
+    with lock:
+        write_state(state_file, state)
+    return status
+
+
+def shared_resource(load):
+    '''
+    Function to wrap a loader so that it runs at most once, the first time one of the tasks needs its result.
+    Concurrent callers wait for the first load to finish, without holding their slot of the worker budget.
+    '''
+    lock = threading.Lock()
+    value = []
+
+    def get():
+        # A task waiting for another one to load the resource gives its slot of the worker budget back meanwhile
+        if not lock.acquire(blocking=False):
+            with idle_slot():
+                lock.acquire()
+        try:
+            if not value:
+                value.append(load())
+            return value[0]
+        finally:
+            lock.release()
+    return get
+
+
+def build_tasks(grouped_files, annotation_file, parameters, ranked_files=None):
+    '''
+    Function to build the task graph of the whole analysis: one enrichment task per universe batch and per
+    ranked file, one REVIGO task per candidate (or ranked) file and namespace and one plot task per candidate
+    file (bar plots and treemaps), plus the results store and the semantic space explorer of all
+    the groups (see semantic_explorer.write_explorer, disabled with 'explorer': false). The output paths of every
+    candidate file are derived from its own name, so concurrent groups never write to the same files.
+
+    Every group uses the background assigned by enrichment.select_backgrounds. Each background is loaded once,
+    the first time one of its tasks needs it, so the backgrounds of different groups are loaded concurrently.
+    Every vocabulary of the 'vocabularies' parameter (by default, only 'GO') gets its own enrichment tasks,
+    and the REVIGO and plot tasks are only built for the GO results.
+
+    Args:
+    - grouped_files: Dictionary as returned by enrichment.select_files
+    - annotation_file: Path to the default eggNOG-mapper file
+    - parameters: Dictionary with the parameters of params.json. If 'render_png' is false, only the HTML
+      plots are rendered and the PNG plots are queued (see barplot_generator.render_deferred).
+    - ranked_files: Dictionary as returned by enrichment.select_ranked_files. By default, None.
+
+    Returns:
+    - tasks: List of tasks as returned by make_task
+    '''
+    ranked_files = ranked_files or {}
+    go_obo = parameters.get('go_obo', 'data/ontology/go-basic.obo')
+    local = parameters.get('revigo', 'local') == 'local'
+    cutoff = parameters.get('revigo_cutoff', 0.7)
+    base_url = parameters.get('revigo_url', REVIGO_URL)
+    render_png = parameters.get('render_png', True)
+    vocabularies = parameters.get('vocabularies', ['GO'])
+    backgrounds = select_backgrounds(sorted(set(grouped_files) | set(ranked_files)), annotation_file, parameters)
+    # Backgrounds with the same annotation file and gene map share one loaded index per vocabulary. All the
+    # vocabularies are read from the same cache entry, so the annotation file is parsed once.
+    loaders = {}
+    for background in backgrounds.values():
+        gene_map = background['parameters'].get('gene_map')
+        background['index'], background['inputs'] = {}, {}
+        for vocabulary in vocabularies:
+            key = (os.path.abspath(background['annotation']), gene_map, vocabulary)
+            if key not in loaders:
+                loaders[key] = shared_resource(lambda background=background, vocabulary=vocabulary: load_annotation_index(
+                    background['annotation'], background['parameters'], vocabulary))
+            background['index'][vocabulary] = loaders[key]
+            # The index depends on the gene map, given as a rule or as a file, and the GO index on the ontology
+            background['inputs'][vocabulary] = [background['annotation']] + ([go_obo] if vocabulary == 'GO' else []) + \
+                ([gene_map] if gene_map and gene_map != 'trinity' else [])
+
+    def enrichment_task(background, vocabulary, universe, batch):
+        return enrich_files(background['index'][vocabulary](), universe, batch, background['parameters'])[1]
+
+    def revigo_task(background, file_path, ns):
+        if not os.path.exists(file_path):
+            return []
+        return process_file(file_path, ns, background['index']['GO']() if local else None, cutoff, base_url)
+
+    def plots_task(background, file_path, group):
+        if not os.path.exists(file_path):
+            return []
+        deferred_file = None if render_png else os.path.join(os.path.dirname(file_path), 'results_revigo', DEFERRED_FILE)
+        # HTML plots of every group reference the same plotly.js bundle, at the root of the output folder
+        outputs = render_jobs(plot_jobs(file_path, background['parameters']['output_folder'], parameters.get('scatter_png', False)),
+                              deferred_file=deferred_file, group=group)
+        # The queue of deferred plots is removed once they are rendered (see barplot_generator.render_deferred),
+        # which must not rerun the task
+        return [path for path in outputs if path != deferred_file]
+
+    def ranked_task(background, vocabulary, group, ranked_file):
+        return enrich_ranked_file(background['index'][vocabulary](), group, ranked_file, background['parameters'])[1]
+
+    def succeeded(failed):
+        # Files whose enrichment did not fail, the results of the others may be out of date. A failed REVIGO
+        # task removes its own outputs (see revigo_plotting.process_file), so its file is stored without them.
+        return [entry for entry, name in zip(stored, stored_tasks) if name not in failed]
+
+    def store_task(failed=()):
+        store_run(store_path(parameters), parameters['output_folder'], parameters, succeeded(failed))
+        return []
+
+    def explorer_task(failed=()):
+        explorer_file = write_explorer(scatterplot_files([(group, ids_file) for group, _, _, ids_file, _ in succeeded(failed)]),
+                                       os.path.join(parameters['output_folder'], EXPLORER_FILE), plotlyjs_folder=parameters['output_folder'],
+                                       max_points=parameters.get('explorer_max_points', 20000))
+        return [explorer_file] if explorer_file else []
+
+    tasks = []
+    stored, stored_tasks = [], []
+
+    def summary_tasks(background, vocabulary, group, source_file, enrich_name, kind):
+        # REVIGO and plot tasks of the GO results of a candidates or ranked file. The results of the other
+        # vocabularies are only added to the results store.
+        background_parameters = background['parameters']
+        output_name = os.path.splitext(os.path.basename(source_file))[0]
+        output_folder = os.path.join(background_parameters['output_folder'], group, *([] if vocabulary == 'GO' else [vocabulary]))
+        ids_file = os.path.join(output_folder, output_name, f"{output_name}_{parameters['pvalue_cutoff']}_IDs_Pvalues.txt")
+        stored.append((group, source_file, kind, ids_file, background['annotation']))
+        stored_tasks.append(enrich_name)
+        if vocabulary != 'GO':
+            return
+        names = []
+        for ns, ns_name in NAMESPACE_NAMES.items():
+            names.append(f"revigo:{group}/{output_name}:{ns_name}")
+            # Only the results of its own file are an input, so a change in another group of the batch does
+            # not rerun the task
+            tasks.append(make_task(names[-1], revigo_task, (background, ids_file, ns),
+                                   inputs=[ids_file] + (background['inputs']['GO'] if local else []), after=[enrich_name],
+                                   params={'revigo': parameters.get('revigo', 'local'), 'cutoff': cutoff,
+                                           'url': None if local else base_url,
+                                           'gene_map': background_parameters.get('gene_map') if local else None},
+                                   group=group))
+        tasks.append(make_task(f"plots:{group}/{output_name}", plots_task, (background, ids_file, group), deps=names,
+                               params={'render_png': render_png, 'output_folder': background_parameters['output_folder'],
+                                       'scatter_png': parameters.get('scatter_png', False)},
+                               group=group))
+
+    for background_name, background in backgrounds.items():
+        background_parameters = background['parameters']
+        background_files = {group: grouped_files[group] for group in background['groups'] if group in grouped_files}
+        batches = universe_batches(background_files)
+        for vocabulary in vocabularies:
+            # The GO tasks keep the names they had before the other vocabularies were added
+            prefix = ('' if vocabulary == 'GO' else f"{vocabulary}:") + (f"{background_name}/" if background_name else '')
+            for universe, batch in batches:
+                # Named after the background and the content of the universe, so adding or removing other
+                # groups or backgrounds does not rename (and rerun) the batch
+                universe_digest = hashlib.sha256('\n'.join(sorted(universe)).encode()).hexdigest()[:12]
+                enrich_name = f"enrichment:{prefix}{os.path.basename(batch[0][2])}:{universe_digest}"
+                tasks.append(make_task(enrich_name, enrichment_task, (background, vocabulary, universe, batch),
+                                       inputs=background['inputs'][vocabulary] + [path for _, candidate, universe_file in batch for path in (candidate, universe_file)],
+                                       params={key: background_parameters.get(key) for key in ['pvalue_cutoff', 'category_size', 'conditional', 'permutations',
+                                                                                               'permutation_seed', 'gene_map', 'output_folder']}))
+                for group, candidate_file, _ in batch:
+                    summary_tasks(background, vocabulary, group, candidate_file, enrich_name, 'candidates')
+
+            for group in background['groups']:
+                universe_file = os.path.join('data', 'universe', f"{group}.universe.txt")
+                for ranked_file in ranked_files.get(group, []):
+                    enrich_name = f"ranked:{prefix}{group}/{os.path.basename(ranked_file)}"
+                    tasks.append(make_task(enrich_name, ranked_task, (background, vocabulary, group, ranked_file),
+                                           inputs=background['inputs'][vocabulary] + [ranked_file] + ([universe_file] if os.path.exists(universe_file) else []),
+                                           params={key: background_parameters.get(key) for key in ['pvalue_cutoff', 'category_size', 'ranked_max_cutoff',
+                                                                                                   'running_sum', 'gene_map', 'output_folder']},
+                                           group=group))
+                    summary_tasks(background, vocabulary, group, ranked_file, enrich_name, 'ranked')
+
+    # The results of every file are added to the results store as one run, when any of them changes. A failed
+    # task of some groups does not keep the results of the others out of the store and the explorer.
+    if stored and parameters.get('results_store', True) is not False:
+        tasks.append(make_task('store', store_task, deps=[task['name'] for task in tasks if not task['name'].startswith('plots:')],
+                               params={'store': store_path(parameters)}, tolerate_failures=True))
+    # The semantic space of every group is drawn in one explorer, when the terms of any of them change
+    revigo_names = [task['name'] for task in tasks if task['name'].startswith('revigo:')]
+    if revigo_names and parameters.get('explorer', True):
+        tasks.append(make_task('explorer', explorer_task, deps=revigo_names,
+                               params={'output_folder': parameters['output_folder'],
+                                       'max_points': parameters.get('explorer_max_points', 20000)}, tolerate_failures=True))
+    return tasks
+
+
+def run_pipeline(parameters, force=False, shard=None):
+    '''
+    Function to run the whole analysis as an incremental task graph. Only the tasks whose inputs, parameters
+    or outputs changed since the last run are executed.
+
+    Args:
+    - parameters: Dictionary with the parameters of params.json. 'workers' sets the number of tasks run at
+      the same time and the budget of processes of the run, including the ones that render the plots (by
+      default, the number of CPUs).
+    - force: Whether to run every task even if it is up to date. By default, False.
+    - shard: Tuple (K, N) to only analyse the groups of the K-th of N shards, in its own shard folder (see
+      shards.py), e.g. to run the shards on several nodes and merge them with shards.merge_shards. By
+      default, None (every group).
+
+    If 'profile' is true in parameters, the time, CPU, memory and I/O of every stage are recorded and written
+    to profile_summary.json and profile_trace.json in the output folder (see profiling.write_profile).
+
+    Returns:
+    - status: Dictionary with the status of every task, see run_tasks
+    '''
+    profiling.enable(parameters.get('profile', False))
+    grouped_files, annotation_file = select_files()
+    ranked_files = select_ranked_files()
+    if shard is not None:
+        grouped_files, ranked_files = select_shard(grouped_files, ranked_files, *shard)
+        parameters = shard_parameters(parameters, *shard)
+        groups = set(grouped_files) | set(ranked_files)
+        print(f"Running shard {shard[0]} of {shard[1]}: {len(groups)} groups")
+        write_shard_manifest(parameters['output_folder'], *shard, groups)
+    state_file = os.path.join(parameters['output_folder'], STATE_FILE)
+    tasks = build_tasks(grouped_files, annotation_file, parameters, ranked_files)
+    status = run_tasks(tasks, state_file, parameters.get('workers'), force)
+    if shard is not None:
+        write_shard_manifest(parameters['output_folder'], *shard, groups, status)
+
+    counts = {}
+    for value in status.values():
+        counts[value] = counts.get(value, 0) + 1
+    print(f"Pipeline finished: {', '.join(f'{count} {value}' for value, count in sorted(counts.items()))}")
+    if profiling.is_enabled():
+        profiling.write_profile(parameters['output_folder'])
+    return status
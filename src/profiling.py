@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+from collections import Counter
+try:
+    import resource
+except ImportError:    # Not available on Windows
+    resource = None
+
+SUMMARY_FILE = 'profile_summary.json'
+TRACE_FILE = 'profile_trace.json'
+
+_enabled = False
+_lock = threading.Lock()
+_records = []
+_counters = Counter()
+_origin = time.perf_counter()
+
+# Returned by stage when profiling is off, so that instrumented code only pays for one function call
+_DISABLED = contextlib.nullcontext({})
+
+
+def enable(enabled=True):
+    '''
+    Function to turn the profiling on or off. Turning it on clears the records of previous runs.
+    '''
+    global _enabled, _origin
+    with _lock:
+        _enabled = enabled
+        if enabled:
+            _records.clear()
+            _counters.clear()
+            _origin = time.perf_counter()
+
+
+def is_enabled():
+    return _enabled
+
+
+def io_counters():
+    '''
+    Function to get the bytes read and written by the process so far (Linux only).
+
+    Returns:
+    - counters: (bytes read, bytes written) tuple, or None if they are not available
+    '''
+    try:
+        with open('/proc/self/io', 'r') as file:
+            fields = dict(line.split(': ') for line in file.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def peak_rss():
+    '''
+    Function to get the peak resident set size of the process, in bytes, or None if it is not available.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def stage(name, group=None, **args):
+    '''
+    Function to measure a stage of the pipeline, used as a context manager:
+
+        with profiling.stage('enrichment', group='aa') as metrics:
+            ...
+            metrics['items'] = n_sets
+
+    The wall time, CPU time of the calling thread, peak RSS of the process, bytes read and written by the
+    process during the stage (shared by all the stages running at the same time) and the number of items
+    processed are recorded. When profiling is off nothing is measured.
+
+    Args:
+    - name: Name of the stage
+    - group: Group (or file) processed by the stage. By default, None.
+    - args: Extra values stored with the record
+
+    Returns:
+    - context: Context manager that yields a dictionary where 'items' and other values can be set
+    '''
+    if not _enabled:
+        return _DISABLED
+    return _measure(name, group, args)
+
+
+@contextlib.contextmanager
+def _measure(name, group, args):
+    metrics = dict(args)
+    start_io = io_counters()
+    start_cpu = time.thread_time()
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        end = time.perf_counter()
+        cpu = time.thread_time() - start_cpu
+        end_io = io_counters()
+        record = {'name': name, 'group': group, 'start': start - _origin, 'wall': end - start, 'cpu': cpu,
+                  'peak_rss': peak_rss(), 'items': metrics.pop('items', None),
+                  'bytes_read': end_io[0] - start_io[0] if start_io and end_io else None,
+                  'bytes_written': end_io[1] - start_io[1] if start_io and end_io else None,
+                  'pid': os.getpid(), 'thread': threading.get_ident(), 'thread_name': threading.current_thread().name,
+                  'args': metrics}
+        with _lock:
+            _records.append(record)
+
+
+def count(name, n=1):
+    '''
+    Function to increase a counter (e.g. HTTP requests or poll iterations). Does nothing when profiling is off.
+    '''
+    if _enabled:
+        with _lock:
+            _counters[name] += n
+
+
+def summarize(records):
+    '''
+    Function to aggregate stage records: number of calls, total wall and CPU time, maximum peak RSS and
+    total bytes and items.
+    '''
+    summary = {}
+    for record in records:
+        entry = summary.setdefault(record['name'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': None,
+                                                    'bytes_read': None, 'bytes_written': None, 'items': None})
+        entry['calls'] += 1
+        entry['wall'] += record['wall']
+        entry['cpu'] += record['cpu']
+        for key in ['bytes_read', 'bytes_written', 'items']:
+            if record[key] is not None:
+                entry[key] = (entry[key] or 0) + record[key]
+        if record['peak_rss'] is not None:
+            entry['peak_rss'] = max(entry['peak_rss'] or 0, record['peak_rss'])
+    return summary
+
+
+def write_profile(output_folder):
+    '''
+    Function to write the profile of the run: a JSON summary per stage and per group, and a trace in the
+    Chrome trace event format (open it in chrome://tracing or https://ui.perfetto.dev).
+
+    Args:
+    - output_folder: Folder where profile_summary.json and profile_trace.json are written
+
+    Returns:
+    - paths: (summary path, trace path) tuple
+    '''
+    with _lock:
+        records = list(_records)
+        counters = dict(_counters)
+    os.makedirs(output_folder, exist_ok=True)
+
+    groups = {}
+    for record in records:
+        if record['group'] is not None:
+            groups.setdefault(record['group'], []).append(record)
+    process = {'wall': time.perf_counter() - _origin, 'cpu': time.process_time(), 'peak_rss': peak_rss()}
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        process['children_cpu'] = children.ru_utime + children.ru_stime
+    summary = {'process': process,
+               'counters': counters,
+               'stages': summarize(records),
+               'groups': {group: summarize(group_records) for group, group_records in sorted(groups.items())}}
+    summary_path = os.path.join(output_folder, SUMMARY_FILE)
+    with open(summary_path, 'w') as file:
+        json.dump(summary, file, indent=2)
+
+    events = []
+    for thread, thread_name in {(record['pid'], record['thread']): record['thread_name'] for record in records}.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': thread[0], 'tid': thread[1], 'args': {'name': thread_name}})
+    for record in sorted(records, key=lambda record: record['start']):
+        args = {key: record[key] for key in ['group', 'cpu', 'peak_rss', 'bytes_read', 'bytes_written', 'items'] if record[key] is not None}
+        args.update(record['args'])
+        events.append({'name': record['name'] if record['group'] is None else f"{record['name']} {record['group']}",
+                       'cat': record['name'], 'ph': 'X', 'ts': record['start'] * 1e6, 'dur': record['wall'] * 1e6,
+                       'pid': record['pid'], 'tid': record['thread'], 'args': args})
+    if counters:
+        events.append({'name': 'counters', 'ph': 'C', 'ts': process['wall'] * 1e6, 'pid': os.getpid(), 'args': counters})
+    trace_path = os.path.join(output_folder, TRACE_FILE)
+    with open(trace_path, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+    print(f"Profile written to {summary_path} and {trace_path}")
+    return summary_path, trace_path
@@ -0,0 +1,240 @@
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln
+from go_enrichment import hypergeometric_sf, id_column, index_codes, test_results
+
+
+def read_ranked(file_path):
+    '''
+    Function to read a ranked list of transcripts, from the most to the least relevant (e.g. sorted by
+    differential expression p-value). Each line has a transcript ID and, optionally, a score separated by
+    a tab (e.g. a log fold change), used to weight the running-sum score. A header line is skipped.
+
+    Args:
+    - file_path: Path to the ranked file
+
+    Returns:
+    - ids: List of unique transcript IDs in rank order (repeated IDs keep their first rank)
+    - scores: Array of scores of the IDs, or None if the file has no scores
+    '''
+    ids, scores = [], []
+    with open(file_path, 'r') as file:
+        for number, line in enumerate(file):
+            fields = [field.strip() for field in line.split('\t')]
+            if not fields[0]:
+                continue
+            score = np.nan
+            if len(fields) > 1 and fields[1]:
+                try:
+                    score = float(fields[1])
+                except ValueError:
+                    if not ids:
+                        continue
+                    raise ValueError(f"Invalid score in line {number + 1} of {file_path}: {fields[1]}")
+            ids.append(fields[0])
+            scores.append(score)
+
+    scores = np.asarray(scores, dtype=float)
+    first = np.sort(np.unique(ids, return_index=True)[1]) if ids else np.zeros(0, dtype=np.int64)
+    ids, scores = [ids[i] for i in first], scores[first]
+    if np.isnan(scores).all():
+        return ids, None
+    if np.isnan(scores).any():
+        raise ValueError(f"Some transcripts of {file_path} have no score")
+    return ids, scores
+
+
+def segment_cumsum(values, indptr):
+    '''
+    Function to compute the cumulative sum of values restarting at every segment of indptr (e.g. the columns
+    of a CSC matrix).
+    '''
+    cumulative = np.cumsum(values)
+    starts = indptr[:-1]
+    offsets = np.where(starts > 0, cumulative[np.maximum(starts - 1, 0)], 0)
+    return cumulative - np.repeat(offsets, np.diff(indptr))
+
+
+def hypergeometric_logpmf(count, total, size, selected):
+    '''
+    Function to compute the log probability P(X = count) of the hypergeometric distribution for many tests at once.
+    '''
+    log_factorial = gammaln(np.arange(total + 1) + 1)
+
+    def log_comb(n, k):
+        return log_factorial[n] - log_factorial[k] - log_factorial[n - k]
+
+    return log_comb(size, count) + log_comb(total - size, selected - count) - log_comb(total, selected)
+
+
+def running_sum_score(ranks, indptr, n_ranked, weights=None):
+    '''
+    Function to compute the GSEA enrichment score (Subramanian et al., 2005) of many terms at once. The
+    running sum increases at the ranks of the transcripts of a term (by their weight) and decreases at the
+    other ranks, and the score is its maximum deviation from zero. The extremes are reached at the ranks of
+    the term transcripts, so only those ranks are evaluated.
+
+    Args:
+    - ranks: Array with the 0-based ranks of the transcripts of each term, sorted within each term
+    - indptr: Array with the start of each term in ranks (as in a CSC matrix)
+    - n_ranked: Number of ranked transcripts
+    - weights: Array with the weight of every rank (e.g. the absolute score). By default, all weights are 1
+      (Kolmogorov-Smirnov statistic).
+
+    Returns:
+    - scores: Array with the enrichment score of every term, positive when its transcripts are at the top
+      of the list and negative when they are at the bottom
+    '''
+    sizes = np.diff(indptr)
+    hits = np.ones(len(ranks)) if weights is None else weights[ranks]
+    hit_sum = segment_cumsum(hits, indptr)
+    total = np.repeat(np.add.reduceat(hits, indptr[:-1]) if len(hits) else np.zeros(len(sizes)), sizes)
+    position = np.arange(len(ranks)) - np.repeat(indptr[:-1], sizes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        misses = (ranks - position) / np.repeat(n_ranked - sizes, sizes)
+        after_hit = np.nan_to_num(hit_sum / total) - misses
+        before_hit = np.nan_to_num((hit_sum - hits) / total) - misses
+
+    scores = np.zeros(len(sizes))
+    nonempty = sizes > 0
+    if len(ranks):
+        highest = np.maximum.reduceat(after_hit, indptr[:-1][nonempty])
+        lowest = np.minimum.reduceat(before_hit, indptr[:-1][nonempty])
+        scores[nonempty] = np.where(highest >= -lowest, highest, lowest)
+    return scores
+
+
+def ranked_test(index, ontology, ranked_codes, category_size=5, max_cutoff=None, weights=None):
+    '''
+    Function to compute the minimum-hypergeometric (mHG) statistic of every term of an ontology: the lowest
+    hypergeometric p-value over all the cutoffs of the ranked list, i.e. over every prefix of the list taken
+    as the candidates. The number of term transcripts in every prefix comes from one sweep over the
+    rank-ordered annotation, so all the cutoffs of all the terms are tested at once.
+
+    The minimum is always reached at the rank of a term transcript, and the probability that the k-th of the
+    K term transcripts reaches a p-value below t is at most t, so the p-value of the mHG statistic is
+    bounded by K * mHG (Eden et al., 2007). This bound is reported as the p-value.
+
+    Only the cutoffs that can give the minimum and a bound below 1 are computed exactly: the ones with more
+    term transcripts than expected, a probability P(X = count) below 1 / K, and not above the smallest upper
+    bound of the tail of the term (P(X = count) / (1 - r), where r is the ratio of the next term of the tail).
+    The other cutoffs get a p-value of 1, so mHG is exact whenever it is below 1 / K.
+
+    Args:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index
+    - ontology: Ontology of the index to test (e.g. 'BP')
+    - ranked_codes: Array with the index positions of the ranked transcripts, in rank order
+    - category_size: Minimum number of ranked transcripts annotated to a term. By default, 5.
+    - max_cutoff: Largest cutoff (number of top-ranked transcripts) considered. By default, the whole list.
+    - weights: Array with the weight of every ranked transcript. If given, the GSEA enrichment score is
+      computed too (see running_sum_score).
+
+    Returns:
+    - results: DataFrame with the columns of go_enrichment.hypergeometric_test for the best cutoff of every
+      term, where Pvalue is the bound above, plus 'mHG' (p-value at the best cutoff), 'Cutoff' (number of
+      top-ranked annotated transcripts at the best cutoff) and, if weights are given, 'EnrichmentScore'.
+      attrs['tests'] is the number of terms tested.
+    '''
+    annotation = index[ontology][ranked_codes]
+    annotated = annotation.getnnz(axis=1) > 0
+    annotation = annotation[annotated].tocsc()
+    annotation.sort_indices()
+    n_ranked = annotation.shape[0]
+    sizes = np.diff(annotation.indptr)
+    tested = np.flatnonzero((sizes >= max(category_size, 1)))
+    annotation = annotation[:, tested]
+    sizes = sizes[tested]
+
+    # Each non-zero is the k-th transcript of its term, found at prefix length rank + 1
+    ranks = annotation.indices
+    starts = annotation.indptr[:-1]
+    position = np.arange(len(ranks)) - np.repeat(starts, sizes) + 1
+    limit = n_ranked if max_cutoff is None else min(int(max_cutoff), n_ranked)
+    within = ranks < limit
+    term_size = np.repeat(sizes, sizes)
+    selected = ranks + 1
+
+    log_pmf = hypergeometric_logpmf(position, n_ranked, term_size, selected)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (term_size - position) * (selected - position) / ((position + 1.0) * (n_ranked - term_size - selected + position + 1.0))
+        log_bound = np.where(within & (ratio < 1), np.minimum(log_pmf - np.log1p(-ratio), 0), 0)
+    best_bound = np.minimum.reduceat(log_bound, starts) if len(ranks) else np.zeros(0)
+    columns = np.repeat(np.arange(len(sizes)), sizes)
+    exact = within & ((position * n_ranked > selected * term_size) | (term_size < 2)) & \
+        (log_pmf < -np.log(term_size)) & (log_pmf <= best_bound[columns])
+    tails = np.ones(len(ranks))
+    tails[exact] = hypergeometric_sf(position[exact], n_ranked, term_size[exact], selected[exact])
+
+    # Best cutoff of every term: the first position of its lowest p-value
+    has_cutoff = np.add.reduceat(within, starts) > 0 if len(ranks) else np.zeros(0, dtype=bool)
+    lowest = np.minimum.reduceat(tails, starts) if len(ranks) else np.zeros(0)
+    best = np.flatnonzero(tails == lowest[columns])
+    best = best[np.unique(columns[best], return_index=True)[1]]
+    best, terms = best[has_cutoff], tested[has_cutoff]
+
+    results = test_results(index, np.zeros(len(best), dtype=np.int64), terms, position[best], sizes[has_cutoff],
+                           ranks[best] + 1, n_ranked)
+    results = results.drop(columns='Set')
+    results['mHG'] = results['Pvalue']
+    results['Pvalue'] = np.minimum(results['mHG'] * results['Size'], 1.0)
+    results['Cutoff'] = ranks[best] + 1
+    if weights is not None:
+        scores = running_sum_score(ranks, annotation.indptr, n_ranked, np.asarray(weights, dtype=float)[annotated])
+        results['EnrichmentScore'] = scores[has_cutoff]
+    results.attrs['tests'] = len(tested)
+    return results
+
+
+def ranked_enrichment(index, ranked_ids, scores=None, universe=None, pvalue_cutoff=0.01, category_size=5, max_cutoff=None,
+                      running_sum=False):
+    '''
+    Function to perform the threshold-free BP, MF and CC enrichment (or the enrichment of the vocabulary of
+    the index) of a ranked list of transcripts, which replaces testing one candidates file per differential
+    expression cutoff (see ranked_test).
+
+    Args:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index
+    - ranked_ids: List of transcript IDs, from the most to the least relevant
+    - scores: Array with the score of every ranked ID, used to weight the running-sum score. By default, None.
+    - universe: List of universe transcript IDs. If given, the transcripts of the ranked list outside the
+      universe are left out. By default, the ranked list is the universe.
+    - pvalue_cutoff: P-value threshold to report a term. By default, 0.01.
+    - category_size: Minimum number of ranked transcripts annotated to a term. By default, 5.
+    - max_cutoff: Largest cutoff (number of top-ranked transcripts) considered. By default, the whole list.
+    - running_sum: Whether to add the GSEA enrichment score of every term (weighted by the absolute scores if
+      they are given). By default, False.
+
+    Returns:
+    - combined_results: DataFrame in the layout of go_enrichment.enrich_group, with the mHG, Cutoff and,
+      optionally, EnrichmentScore columns of ranked_test, and the number of terms tested in each ontology in
+      attrs['tests']
+    '''
+    codes = index_codes(index, ranked_ids)
+    found = codes >= 0
+    # With a gene map, a gene takes the rank of its best-ranked transcript
+    first = np.zeros(len(codes), dtype=bool)
+    first[np.unique(codes, return_index=True)[1]] = True
+    found &= first
+    if universe is not None:
+        in_universe = np.zeros(len(index['transcripts']), dtype=bool)
+        universe_codes = index_codes(index, universe)
+        in_universe[universe_codes[universe_codes >= 0]] = True
+        found &= in_universe[np.maximum(codes, 0)]
+    weights = None
+    if running_sum:
+        weights = np.ones(len(codes)) if scores is None else np.abs(np.asarray(scores, dtype=float))
+        weights = weights[found]
+    codes = codes[found]
+
+    results_list = []
+    tests = {}
+    for ontology in index['ontologies']:
+        results = ranked_test(index, ontology, codes, category_size, max_cutoff, weights)
+        tests[ontology] = results.attrs['tests']
+        results = results[results['Pvalue'] < pvalue_cutoff]
+        results = results.sort_values('Pvalue', kind='stable').rename(columns={'GO': id_column(ontology)})
+        results.insert(0, 'Ontology', ontology)
+        results_list.append(results)
+    combined_results = pd.concat(results_list, ignore_index=True, sort=False)
+    combined_results.attrs['tests'] = tests
+    return combined_results
@@ -0,0 +1,356 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+import plotly.io as pio
+from barplot_generator import plotlyjs_reference
+from eggnog_to_gsc import VOCABULARIES
+from go_ontology import obo_release
+
+# Name of the store, at the root of the output folder unless 'results_store' is set in params.json
+STORE_FILE = 'results.sqlite'
+
+# The GO IDs of the results files are split in one column per ontology
+ONTOLOGIES = ['BP', 'MF', 'CC']
+# The terms of the other vocabularies are stored with the vocabulary as their ontology, e.g. KEGG_Pathway
+TERM_ONTOLOGIES = ONTOLOGIES + [vocabulary for vocabulary in VOCABULARIES if vocabulary != 'GO']
+
+ENRICHMENT_COLUMNS = ['Pvalue', 'OddsRatio', 'ExpCount', 'Count', 'Size', 'EmpiricalPvalue', 'Qvalue', 'mHG', 'Cutoff',
+                      'EnrichmentScore', 'GlobalQvalue']
+CLUSTER_COLUMNS = ['Value', 'LogSize', 'Frequency', 'Uniqueness', 'Dispensability', 'PC_0', 'PC_1', 'Representative']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, created TEXT, output_folder TEXT, parameters TEXT);
+CREATE TABLE IF NOT EXISTS groups (group_id INTEGER PRIMARY KEY, run_id INTEGER REFERENCES runs, name TEXT, source TEXT,
+                                   kind TEXT, annotation TEXT, results_file TEXT, tests TEXT);
+CREATE TABLE IF NOT EXISTS terms (GO TEXT PRIMARY KEY, Ontology TEXT, Term TEXT);
+CREATE TABLE IF NOT EXISTS enrichment (group_id INTEGER REFERENCES groups, Ontology TEXT, GO TEXT, Pvalue REAL,
+                                       OddsRatio REAL, ExpCount REAL, Count INTEGER, Size INTEGER, EmpiricalPvalue REAL,
+                                       Qvalue REAL, mHG REAL, Cutoff INTEGER, EnrichmentScore REAL, GlobalQvalue REAL);
+CREATE TABLE IF NOT EXISTS clusters (group_id INTEGER REFERENCES groups, Ontology TEXT, GO TEXT, Value REAL, LogSize REAL,
+                                     Frequency REAL, Uniqueness REAL, Dispensability REAL, PC_0 REAL, PC_1 REAL,
+                                     Representative TEXT);
+CREATE INDEX IF NOT EXISTS runs_folder ON runs (output_folder, run_id);
+CREATE INDEX IF NOT EXISTS groups_run ON groups (run_id, name);
+CREATE INDEX IF NOT EXISTS groups_name ON groups (name);
+CREATE INDEX IF NOT EXISTS enrichment_term ON enrichment (GO, Pvalue);
+CREATE INDEX IF NOT EXISTS enrichment_group ON enrichment (group_id, Ontology, Pvalue);
+CREATE INDEX IF NOT EXISTS clusters_term ON clusters (GO);
+CREATE INDEX IF NOT EXISTS clusters_group ON clusters (group_id, Ontology);
+'''
+# Columns added after the first version of the store, added to older stores when they are opened
+ADDED_COLUMNS = [('groups', 'annotation', 'TEXT'), ('groups', 'tests', 'TEXT'), ('enrichment', 'GlobalQvalue', 'REAL'),
+                 ('runs', 'go_release', 'TEXT')]
+
+
+def store_path(parameters):
+    '''
+    Function to get the path of the results store of params.json: 'results_store', or results.sqlite in the
+    output folder. Several output folders can share one store.
+    '''
+    return parameters.get('results_store') or os.path.join(parameters['output_folder'], STORE_FILE)
+
+
+def open_store(store_file):
+    '''
+    Function to open the results store, creating its tables and indexes if needed.
+
+    Args:
+    - store_file: Path to the SQLite file
+
+    Returns:
+    - connection: sqlite3 connection
+    '''
+    os.makedirs(os.path.dirname(store_file) or '.', exist_ok=True)
+    connection = sqlite3.connect(store_file, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    for table, column, column_type in ADDED_COLUMNS:
+        if column not in [row[1] for row in connection.execute(f'PRAGMA table_info({table})')]:
+            connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+    return connection
+
+
+def read_enrichment(results_file):
+    '''
+    Function to read a results file written by go_enrichment.write_results into the layout of the store, with
+    the GO IDs of the three ontologies (or the term IDs of another vocabulary) in a single GO column.
+    '''
+    results = pd.read_csv(results_file, sep='\t', na_values=['NA'], keep_default_na=False)
+    results['OddsRatio'] = pd.to_numeric(results['OddsRatio'].replace('Inf', np.inf))
+    id_columns = [column for column in results.columns if column.endswith('ID')]
+    results['GO'] = results[id_columns].bfill(axis=1).iloc[:, 0]
+    return results.reindex(columns=['Ontology', 'GO', 'Term'] + ENRICHMENT_COLUMNS)
+
+
+def read_clusters(scatterplot_file, ontology):
+    '''
+    Function to read the REVIGO scatter plot table of an ontology (which has the columns of the REVIGO table
+    and the coordinates of the semantic space) into the layout of the store.
+    '''
+    clusters = pd.read_csv(scatterplot_file, sep='\t', na_values=['null'], keep_default_na=False)
+    clusters = clusters.rename(columns={'TermID': 'GO', 'Name': 'Term'})
+    # REVIGO gives the representative as the number of its GO ID
+    representative = pd.to_numeric(clusters['Representative'], errors='coerce')
+    clusters['Representative'] = [f'GO:{int(value):07d}' if not np.isnan(value) else None for value in representative]
+    clusters.insert(0, 'Ontology', ontology)
+    return clusters.reindex(columns=['Ontology', 'GO', 'Term'] + CLUSTER_COLUMNS)
+
+
+def store_run(store_file, output_folder, parameters, groups):
+    '''
+    Function to add the enrichment and clustering results of a pipeline run to the results store, in a single
+    transaction.
+
+    Args:
+    - store_file: Path to the SQLite file
+    - output_folder: Output folder of the run
+    - parameters: Dictionary with the parameters of params.json
+    - groups: List of (group, source_file, kind, ids_file, annotation_file) tuples, where kind is 'candidates'
+      or 'ranked', ids_file is the *_IDs_Pvalues.txt file of the source file (None if it has no results) and
+      annotation_file the eggNOG-mapper file of its background. The number of terms tested in every ontology
+      is read from the _tests.json file next to ids_file (see go_enrichment.write_tests), or given as a sixth
+      element of the tuple.
+
+    Returns:
+    - run_id: ID of the run in the store
+    '''
+    # Release of the GO ontology the results were computed with, as the current release changes over time
+    obo_path = parameters.get('go_obo', 'data/ontology/go-basic.obo')
+    go_release = obo_release(obo_path) if os.path.exists(obo_path) else None
+    connection = open_store(store_file)
+    try:
+        with connection:
+            cursor = connection.execute('INSERT INTO runs (created, output_folder, parameters, go_release) VALUES (?, ?, ?, ?)',
+                                        (datetime.datetime.now().isoformat(timespec='seconds'), os.path.abspath(output_folder),
+                                         json.dumps(parameters, sort_keys=True, default=str), go_release))
+            run_id = cursor.lastrowid
+            n_rows = 0
+            for group, source_file, kind, ids_file, annotation_file, *tests in groups:
+                results_file = ids_file.replace('_IDs_Pvalues.txt', '.txt') if ids_file else None
+                if results_file is not None and not os.path.exists(results_file):
+                    results_file = None
+                tests_file = ids_file.replace('_IDs_Pvalues.txt', '_tests.json') if ids_file else None
+                if not tests and tests_file and os.path.exists(tests_file):
+                    with open(tests_file, 'r') as file:
+                        tests = [json.load(file)]
+                cursor = connection.execute('''INSERT INTO groups (run_id, name, source, kind, annotation, results_file, tests)
+                                               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                                            (run_id, group, source_file, kind, annotation_file, results_file,
+                                             json.dumps(tests[0]) if tests else None))
+                group_id = cursor.lastrowid
+                if results_file is None:
+                    continue
+
+                results = read_enrichment(results_file)
+                connection.executemany('INSERT OR IGNORE INTO terms (GO, Ontology, Term) VALUES (?, ?, ?)',
+                                       results[['GO', 'Ontology', 'Term']].itertuples(index=False))
+                results = results.drop(columns='Term')
+                results.insert(0, 'group_id', group_id)
+                results.to_sql('enrichment', connection, if_exists='append', index=False)
+                n_rows += len(results)
+
+                revigo_folder = os.path.join(os.path.dirname(ids_file), 'results_revigo')
+                file_name = os.path.splitext(os.path.basename(ids_file))[0]
+                for ontology in ONTOLOGIES:
+                    scatterplot_file = os.path.join(revigo_folder, f"{file_name}_{ontology}_scatterPlot.tsv")
+                    if os.path.exists(scatterplot_file) and os.path.getsize(scatterplot_file):
+                        clusters = read_clusters(scatterplot_file, ontology).drop(columns='Term')
+                        clusters.insert(0, 'group_id', group_id)
+                        clusters.to_sql('clusters', connection, if_exists='append', index=False)
+        print(f"Run {run_id} stored in {store_file}: {len(groups)} files, {n_rows} enriched terms")
+        return run_id
+    finally:
+        connection.close()
+
+
+def latest_runs_filter(run_id=None, all_runs=False):
+    '''
+    Function to build the SQL condition on groups.run_id of the queries: a given run, every run, or by default
+    the latest run of every output folder.
+    '''
+    if run_id is not None:
+        return 'groups.run_id = ?', [int(run_id)]
+    if all_runs:
+        return '1', []
+    return 'groups.run_id IN (SELECT MAX(run_id) FROM runs GROUP BY output_folder)', []
+
+
+def query_enrichment(store_file, go_ids=None, max_pvalue=None, groups=None, ontology=None, run_id=None, all_runs=False):
+    '''
+    Function to find enriched terms across groups and runs, e.g. the groups where a term is enriched below a
+    p-value.
+
+    Args:
+    - store_file: Path to the SQLite file
+    - go_ids: List of GO IDs. By default, every term.
+    - max_pvalue: Largest p-value of the results. By default, no limit.
+    - groups: List of group names. By default, every group.
+    - ontology: Ontology of the terms ('BP', 'MF' or 'CC'). By default, the three.
+    - run_id: Run to search. By default, the latest run of every output folder.
+    - all_runs: Whether to search every run. By default, False.
+
+    Returns:
+    - results: DataFrame with the run, output folder, group, source file and the enrichment columns
+    '''
+    conditions, arguments = [], []
+    run_condition, run_arguments = latest_runs_filter(run_id, all_runs)
+    conditions.append(run_condition)
+    arguments += run_arguments
+    for column, values in [('enrichment.GO', go_ids), ('groups.name', groups)]:
+        if values:
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            arguments += list(values)
+    if max_pvalue is not None:
+        conditions.append('enrichment.Pvalue <= ?')
+        arguments.append(float(max_pvalue))
+    if ontology:
+        conditions.append('enrichment.Ontology = ?')
+        arguments.append(ontology)
+
+    query = f'''SELECT groups.run_id, runs.output_folder, groups.name AS "Group", groups.source, enrichment.Ontology,
+                       enrichment.GO, terms.Term, {', '.join(f'enrichment.{column}' for column in ENRICHMENT_COLUMNS)}
+                FROM enrichment JOIN groups ON groups.group_id = enrichment.group_id
+                JOIN runs ON runs.run_id = groups.run_id LEFT JOIN terms ON terms.GO = enrichment.GO
+                WHERE {' AND '.join(conditions)} ORDER BY enrichment.Pvalue'''
+    connection = open_store(store_file)
+    try:
+        results = pd.read_sql_query(query, connection, params=arguments)
+    finally:
+        connection.close()
+    # Columns of the tests that were not run (e.g. mHG without ranked files) are left out
+    optional = [column for column in ENRICHMENT_COLUMNS[5:] if results[column].isna().all()]
+    return results.drop(columns=optional)
+
+
+def comparison_matrix(store_file, ontology='BP', top=30, max_pvalue=None, groups=None, run_id=None):
+    '''
+    Function to build the group-by-term matrix of -log10 p-values of the terms most often enriched across
+    groups.
+
+    Args:
+    - store_file: Path to the SQLite file
+    - ontology: Ontology of the terms. By default, 'BP'.
+    - top: Number of terms, the ones enriched in most groups (then with the lowest p-value). By default, 30.
+    - max_pvalue, groups, run_id: As in query_enrichment
+
+    Returns:
+    - matrix: DataFrame with one row per group (source file) and one column per term, NaN where the term is
+      not enriched
+    '''
+    results = query_enrichment(store_file, max_pvalue=max_pvalue, groups=groups, ontology=ontology, run_id=run_id)
+    if results.empty:
+        return pd.DataFrame()
+    results['Label'] = results['Group'] + ' (' + results['source'].map(lambda path: os.path.basename(path)) + ')'
+    ranking = results.groupby(['GO', 'Term'], dropna=False).agg(groups=('Label', 'nunique'), best=('Pvalue', 'min'))
+    terms = ranking.sort_values(['groups', 'best'], ascending=[False, True]).head(top).index.get_level_values('GO')
+    selected = results[results['GO'].isin(terms)]
+    matrix = selected.pivot_table(index='Label', columns='GO', values='Pvalue', aggfunc='min')
+    matrix = -np.log10(matrix[list(terms)].clip(lower=1e-300))
+    names = selected.drop_duplicates('GO').set_index('GO')['Term']
+    matrix.columns = [f'{go_id} {names.get(go_id, "")}'.strip() for go_id in matrix.columns]
+    return matrix
+
+
+def plot_comparison(store_file, output_file, ontology='BP', top=30, max_pvalue=None, groups=None, run_id=None,
+                    plotlyjs_folder=None):
+    '''
+    Function to save an interactive heatmap comparing the enrichment of the top terms across groups (see
+    comparison_matrix).
+
+    Returns:
+    - output_file: Path to the HTML file, or None if there are no results
+    '''
+    matrix = comparison_matrix(store_file, ontology, top, max_pvalue, groups, run_id)
+    if matrix.empty:
+        print(f"No enriched {ontology} terms in {store_file}")
+        return None
+    fig = go.Figure(go.Heatmap(z=matrix.to_numpy(), x=list(matrix.columns), y=list(matrix.index), colorscale='Viridis',
+                               colorbar=dict(title='-log10(p)'),
+                               hovertemplate='%{y}<br>%{x}<br>-log10(p): %{z:.2f}<extra></extra>'))
+    fig.update_layout(title=f'{ontology} enrichment across groups', template='plotly_white',
+                      xaxis=dict(tickfont=dict(size=9), tickangle=45), yaxis=dict(tickfont=dict(size=10)),
+                      height=max(400, 25 * len(matrix) + 300))
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    pio.write_html(fig, file=output_file, include_plotlyjs=plotlyjs_reference(output_file, plotlyjs_folder))
+    return output_file
+
+
+def export_parquet(store_file, output_folder):
+    '''
+    Function to export the tables of the results store to Parquet files, e.g. to query them with DuckDB,
+    Spark or Arrow. Requires the optional 'pyarrow' package.
+
+    Returns:
+    - outputs: List of paths of the Parquet files
+    '''
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("Exporting the results store to Parquet requires the 'pyarrow' package (pip install pyarrow)")
+    os.makedirs(output_folder, exist_ok=True)
+    connection = open_store(store_file)
+    outputs = []
+    try:
+        for table in ['runs', 'groups', 'terms', 'enrichment', 'clusters']:
+            output_file = os.path.join(output_folder, f'{table}.parquet')
+            pd.read_sql_query(f'SELECT * FROM {table}', connection).to_parquet(output_file, index=False)
+            outputs.append(output_file)
+    finally:
+        connection.close()
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query the enrichment results of all the runs and groups')
+    parser.add_argument('--store', default=None, help='Results store. By default, the one of params.json.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('runs', help='List the runs of the store')
+    query_parser = subparsers.add_parser('query', help='Find enriched terms across groups')
+    query_parser.add_argument('--go', nargs='+', default=None, help='GO IDs')
+    query_parser.add_argument('--pvalue', type=float, default=None, help='Largest p-value')
+    query_parser.add_argument('--groups', nargs='+', default=None, help='Group names')
+    query_parser.add_argument('--ontology', choices=TERM_ONTOLOGIES, default=None)
+    query_parser.add_argument('--run', type=int, default=None, help='Run ID. By default, the latest run of every output folder.')
+    query_parser.add_argument('--all-runs', action='store_true', help='Search every run')
+    compare_parser = subparsers.add_parser('compare', help='Heatmap of the top terms across groups')
+    compare_parser.add_argument('output_file', help='HTML file')
+    compare_parser.add_argument('--ontology', choices=TERM_ONTOLOGIES, default='BP')
+    compare_parser.add_argument('--top', type=int, default=30, help='Number of terms. By default, 30.')
+    compare_parser.add_argument('--pvalue', type=float, default=None, help='Largest p-value')
+    compare_parser.add_argument('--groups', nargs='+', default=None, help='Group names')
+    compare_parser.add_argument('--run', type=int, default=None, help='Run ID. By default, the latest run of every output folder.')
+    export_parser = subparsers.add_parser('export', help='Export the store to Parquet files (requires pyarrow)')
+    export_parser.add_argument('output_folder', help='Folder of the Parquet files')
+    args = parser.parse_args()
+
+    store_file = args.store
+    if store_file is None:
+        with open('params.json', 'r') as file:
+            store_file = store_path(json.load(file))
+    if not os.path.exists(store_file):
+        parser.error(f"Results store {store_file} not found, run the pipeline first")
+
+    if args.command == 'runs':
+        connection = open_store(store_file)
+        runs = pd.read_sql_query('''SELECT runs.run_id, runs.created, runs.output_folder, runs.go_release, COUNT(groups.group_id) AS files
+                                    FROM runs LEFT JOIN groups ON groups.run_id = runs.run_id
+                                    GROUP BY runs.run_id ORDER BY runs.run_id''', connection)
+        connection.close()
+        print(runs.to_string(index=False))
+    elif args.command == 'query':
+        results = query_enrichment(store_file, args.go, args.pvalue, args.groups, args.ontology, args.run, args.all_runs)
+        results.to_csv(sys.stdout, sep='\t', index=False, na_rep='NA', float_format='%.6g')
+    elif args.command == 'compare':
+        output_file = plot_comparison(store_file, args.output_file, args.ontology, args.top, args.pvalue, args.groups, args.run)
+        if output_file is not None:
+            print(f"Comparison heatmap written to {output_file}")
+    else:
+        for output_file in export_parquet(store_file, args.output_folder):
+            print(f"Table written to {output_file}")
+    sys.exit(0)
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+import profiling
+
+REVIGO_URL = "http://revigo.irb.hr"
+CACHE_FOLDER = 'data/revigo_cache'
+# Timeouts of every request, in seconds: (connection, read)
+REQUEST_TIMEOUT = (10, 120)
+# Answers to a job submission that mean the server did not start the job, so it can be submitted again
+SUBMIT_RETRY_STATUS = [429, 503]
+
+NAMESPACES = [1, 2, 3]
+RESULT_TYPES = ['table', 'scatterPlot', 'TreeMap', 'RTreeMap']
+
+_session = None
+_session_lock = threading.Lock()
+_job_locks = {}
+_job_locks_lock = threading.Lock()
+
+
+def get_session(pool_size=16, retries=5):
+    '''
+    Function to get the HTTP session shared by all REVIGO requests. Connections are kept alive and pooled,
+    and failed GET requests (connection errors, 429 and 5xx responses) are retried with exponential backoff.
+    POST requests are only retried when the connection could not be opened, since a job submission that
+    reached the server may have started a job (see submit_job).
+
+    Args:
+    - pool_size: Maximum number of pooled connections. By default, 16.
+    - retries: Maximum number of retries per request. By default, 5.
+
+    Returns:
+    - session: requests.Session
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=frozenset(['GET']))
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session.hooks['response'].append(count_response)
+        return _session
+
+
+def count_response(response, *args, **kwargs):
+    if profiling.is_enabled():
+        profiling.count('http_requests')
+        profiling.count('http_bytes_received', len(response.content))
+
+
+def payload_key(payload, base_url=REVIGO_URL):
+    '''
+    Function to compute the cache key of a REVIGO job from its payload (GO list and parameters) and server.
+    '''
+    return hashlib.sha256(json.dumps({'url': base_url, 'payload': payload}, sort_keys=True).encode()).hexdigest()
+
+
+def wait_for_job(session, base_url, jobid, initial_delay=0.25, max_delay=5.0, timeout=900):
+    '''
+    Function to poll a REVIGO job until it finishes. The delay between polls starts short and grows by
+    half at every poll, up to max_delay.
+
+    Args:
+    - session: HTTP session as returned by get_session
+    - base_url: URL of the REVIGO server
+    - jobid: ID of the job
+    - initial_delay: Delay before the first poll, in seconds. By default, 0.25.
+    - max_delay: Maximum delay between polls, in seconds. By default, 5.
+    - timeout: Maximum time to wait, in seconds. By default, 900.
+
+    Returns:
+    - polls: Number of polls performed
+    '''
+    delay = initial_delay
+    start = time.monotonic()
+    polls = 0
+    while True:
+        time.sleep(delay)
+        polls += 1
+        profiling.count('revigo_polls')
+        r = session.get(f"{base_url}/QueryJob", params={'jobid': jobid, 'type': 'jstatus'}, timeout=REQUEST_TIMEOUT)
+        r.raise_for_status()
+        if r.json()['running'] == 0:
+            return polls
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(f"REVIGO job {jobid} did not finish in {timeout} s")
+        delay = min(delay * 1.5, max_delay)
+
+
+def submit_job(session, base_url, payload, retries=5, backoff_factor=0.5):
+    '''
+    Function to submit a REVIGO job. The submission is only sent again when the server answers that it did
+    not start the job (429 or 503), never after a timeout or an error answer, so that no job is submitted twice.
+
+    Args:
+    - session: HTTP session as returned by get_session
+    - base_url: URL of the REVIGO server
+    - payload: Form fields of the job
+    - retries: Maximum number of resubmissions. By default, 5.
+    - backoff_factor: Delay before the first resubmission, in seconds, doubled at every resubmission. By default, 0.5.
+
+    Returns:
+    - jobid: ID of the job
+    '''
+    for attempt in range(retries + 1):
+        r = session.post(f"{base_url}/StartJob", data=payload, timeout=REQUEST_TIMEOUT)
+        if r.status_code not in SUBMIT_RETRY_STATUS or attempt == retries:
+            break
+        time.sleep(backoff_factor * 2 ** attempt)
+    r.raise_for_status()
+    return r.json()['jobid']
+
+
+def job_lock(key):
+    with _job_locks_lock:
+        return _job_locks.setdefault(key, threading.Lock())
+
+
+def revigo_results(go_list, cutoff='0.7', base_url=REVIGO_URL, cache_folder=CACHE_FOLDER):
+    '''
+    Function to get all the REVIGO results of a GO list: one job is submitted per unique GO list and
+    parameters, and the table, scatterPlot, TreeMap and RTreeMap results of the three namespaces are
+    fetched from that job over the pooled session. Results are cached on disk, keyed by the hash of the
+    payload, and concurrent calls with the same payload wait for the first one instead of submitting again.
+
+    Args:
+    - go_list: Text with the GO IDs and p-values, as sent in the 'goList' field
+    - cutoff: Similarity cutoff. By default, '0.7'.
+    - base_url: URL of the REVIGO server. By default, http://revigo.irb.hr.
+    - cache_folder: Folder where the results are cached. By default, 'data/revigo_cache'.
+
+    Returns:
+    - results: Dictionary with the namespace numbers (as strings) as keys and dictionaries with the result
+      texts of each type as values
+    '''
+    payload = {'cutoff': str(cutoff), 'valueType': 'pvalue', 'speciesTaxon': '0', 'measure': 'SIMREL', 'goList': go_list}
+    key = payload_key(payload, base_url)
+    cache_file = os.path.join(cache_folder, f"{key}.json")
+
+    with job_lock(key):
+        if os.path.exists(cache_file):
+            profiling.count('revigo_cache_hits')
+            with open(cache_file, 'r') as file:
+                return json.load(file)
+
+        session = get_session()
+        jobid = submit_job(session, base_url, payload)
+        profiling.count('revigo_jobs')
+        print(f"Job submitted with ID {jobid}")
+        polls = wait_for_job(session, base_url, jobid)
+        print(f"Job {jobid} finished after {polls} polls")
+
+        def fetch(request):
+            ns, result_type = request
+            r = session.get(f"{base_url}/QueryJob", params={'jobid': jobid, 'type': result_type, 'namespace': ns}, timeout=REQUEST_TIMEOUT)
+            r.raise_for_status()
+            return r.text
+
+        requests_list = [(ns, result_type) for ns in NAMESPACES for result_type in RESULT_TYPES]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            texts = list(executor.map(fetch, requests_list))
+
+        results = {str(ns): {} for ns in NAMESPACES}
+        for (ns, result_type), text in zip(requests_list, texts):
+            results[str(ns)][result_type] = text
+
+        # Error answers are returned but not cached, so they are requested again in the next run
+        if any('error' in text for text in texts):
+            return results
+
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_path = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(results, file)
+        os.replace(tmp_path, cache_file)
+
+    return results
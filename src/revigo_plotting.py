@@ -1,168 +1,207 @@
 import os
-import requests
-import time
 import json
-import pandas as pd
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import plotly.graph_objects as go
-import csv
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from barplot_generator import create_individual_barplot, create_combined_barplot
-from barplot_generator import process_and_plot
+import profiling
+from semantic_clustering import revigo_outputs
+from revigo_client import revigo_results, REVIGO_URL
+from barplot_generator import plot_job, render_jobs, COLORS
 
-tables_paths = {}
+NAMESPACE_NAMES = {1: 'BP', 2: 'CC', 3: 'MF'}
 
 
-def process_file(file_path, ns):
+def fetch_revigo(file_path, ns, cutoff='0.7', base_url=REVIGO_URL):
+    '''
+    Function to summarize the GO terms of a file for one namespace with the REVIGO web service. The job of
+    the file is shared by the three namespaces and its results are cached on disk (see revigo_client).
+
+    Returns:
+    - outputs: Dictionary with the 'table', 'scatterPlot', 'TreeMap' and 'RTreeMap' texts, or None on error
+    '''
     with open(file_path, 'r') as file:
         userData = file.read()
-    print(f"Processing file {file_path} for namespace {ns}")
 
-    namespace_names = {1: 'BP', 2: 'CC', 3: 'MF'}
-    
-    colors = {'BP': 'skyblue', 'MF': 'lightcoral', 'CC': 'lightgreen'}
+    outputs = revigo_results(userData, cutoff, base_url)[str(ns)]
 
-    payload = {'cutoff': '0.7', 'valueType': 'pvalue', 'speciesTaxon': '0', 'measure': 'SIMREL', 'goList': userData}
-    r = requests.post("http://revigo.irb.hr/StartJob", data=payload)
-    jobid = r.json()['jobid']
-    print(f"Job submitted with ID {jobid} for namespace {namespace_names[ns]}")
+    if "error" in outputs['table'] or "error" in outputs['scatterPlot'] or "error" in outputs['TreeMap']:
+        return None
+    return outputs
 
-    running = 1
-    while running != 0:
-        r = requests.get("http://revigo.irb.hr/QueryJob", params={'jobid': jobid, 'type': 'jstatus'})
-        running = r.json()['running']
-        time.sleep(1)
 
-    r_table = requests.get("http://revigo.irb.hr/QueryJob", params={'jobid': jobid, 'type': 'table', 'namespace': ns})
-    r_scatterplot = requests.get("http://revigo.irb.hr/QueryJob", params={'jobid': jobid, 'type': 'scatterPlot', 'namespace': ns})
-    r_jTreeMap = requests.get("http://revigo.irb.hr/QueryJob", params={'jobid': jobid, 'type': 'TreeMap', 'namespace': ns})
-    r_Rscript = requests.get("http://revigo.irb.hr/QueryJob", params={'jobid': jobid, 'type': 'RTreeMap', 'namespace': ns})
+def process_file(file_path, ns, index=None, cutoff=0.7, base_url=REVIGO_URL):
+    '''
+    Function to summarize the enriched GO terms of a file for one namespace and write the REVIGO outputs.
+    The plots are created afterwards from these outputs, see plot_jobs.
 
-    if "error" in r_table.text or "error" in r_scatterplot.text or "error" in r_jTreeMap.text:
-        print(f"Error occurred while fetching results for namespace {namespace_names[ns]}")
-        return
+    Args:
+    - file_path: Path to the *_IDs_Pvalues.txt file
+    - ns: Namespace number (1: BP, 2: CC, 3: MF)
+    - index: Annotation index as returned by go_enrichment.build_annotation_index. If given, the terms are
+      clustered locally (semantic_clustering) instead of with the REVIGO web service.
+    - cutoff: Similarity cutoff used to remove redundant terms. By default, 0.7.
+    - base_url: URL of the REVIGO server used when index is None. By default, http://revigo.irb.hr.
 
-    output_folder = os.path.join(os.path.dirname(file_path), "results_revigo")
-    graphics_folder = os.path.join(output_folder, "obtained_graphics")
-    os.makedirs(graphics_folder, exist_ok=True)
+    Returns:
+    - outputs: List of paths of the files written. Empty if the results could not be obtained, in which case
+      the outputs of a previous run are removed.
+    '''
+    print(f"Processing file {file_path} for namespace {ns}")
+
+    namespace_names = NAMESPACE_NAMES
 
+    # Results are written to <output_folder>/<group>/<candidates name>/, see go_enrichment.write_results
+    group = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(file_path))))
+    output_folder = os.path.join(os.path.dirname(file_path), "results_revigo")
     file_name = os.path.splitext(os.path.basename(file_path))[0]
-    graphic_name = file_name.split('_')
-    graphic_name = graphic_name[0] + ' ' + graphic_name[1] + ' ' + graphic_name[2]
     namespace_name = namespace_names[ns]
-    
-    output_file_table = os.path.join(output_folder, f"{file_name}_{namespace_name}_table.tsv")
-
-    tables_paths[namespace_name] = output_file_table
 
+    output_file_table = os.path.join(output_folder, f"{file_name}_{namespace_name}_table.tsv")
     output_file_jTreeMap = os.path.join(output_folder, f"{file_name}_{namespace_name}_TreeMap.tsv")
     output_file_scatterplot = os.path.join(output_folder, f"{file_name}_{namespace_name}_scatterPlot.tsv")
     output_file_Rscript = os.path.join(output_folder, f"{file_name}_{namespace_name}_Rscript.R")
+    output_files = [output_file_table, output_file_jTreeMap, output_file_scatterplot, output_file_Rscript]
+
+    def remove_outputs():
+        # Without new results, the outputs of a previous run must not be plotted or stored with the new enrichment
+        for path in output_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+    try:
+        with profiling.stage('revigo', group=group, namespace=namespace_name,
+                             mode='local' if index is not None else 'web') as metrics:
+            if index is not None:
+                outputs = revigo_outputs(index, file_path, namespace_name, cutoff)
+            else:
+                outputs = fetch_revigo(file_path, ns, cutoff, base_url)
+            metrics['items'] = outputs['table'].count('\n') - 1 if outputs else 0
+    except Exception:
+        remove_outputs()
+        raise
+
+    if outputs is None:
+        print(f"Error occurred while fetching results for namespace {namespace_name}")
+        remove_outputs()
+        return []
+
+    os.makedirs(output_folder, exist_ok=True)
     print(f"Generated file paths:\nTable: {output_file_table}\nTreeMap: {output_file_jTreeMap}\nScatterPlot: {output_file_scatterplot}\nRscript: {output_file_Rscript}")
 
     with open(output_file_table, 'w') as f:
-        f.write(r_table.text)
+        f.write(outputs['table'])
         print(f"Table results written to {output_file_table}")
     with open(output_file_jTreeMap, 'w') as f:
-        f.write(r_jTreeMap.text)    
+        f.write(outputs['TreeMap'])    
         print(f"jTreeMap results written to {output_file_jTreeMap}")
     with open(output_file_scatterplot, 'w') as f:
-        f.write(r_scatterplot.text)
+        f.write(outputs['scatterPlot'])
         print(f"Scatterplot results written to {output_file_scatterplot}")
     pdf_destination = os.path.join(output_folder, f"{file_name}_{namespace_name}_treemap.pdf")
     with open(output_file_Rscript, 'w') as f:
-        script_content = r_Rscript.text.replace('pdf( file="revigo_treemap.pdf", width=16, height=9 )',
+        script_content = outputs['RTreeMap'].replace('pdf( file="revigo_treemap.pdf", width=16, height=9 )',
                                                 f'pdf( file="{pdf_destination}", width=16, height=9 )')
         script_content = script_content.replace('title = "Revigo TreeMap"', f'title = "{file_name} {namespace_name} TreeMap"')
         script_content = script_content.replace ('position.legend = "none"', 'position.legend = "none", fontsize.labels = c(12,15), align.labels = list(c("left","top"),c("center","center")),')
         f.write(script_content)
         print(f"Rscript results written to {output_file_Rscript}")
 
-    os.system(f"Rscript {output_file_Rscript}")
-    print("Treemap created and saved.")
-
-    create_individual_barplot(output_file_table, f'{graphic_name} {namespace_name} Bar Plot', os.path.join(output_folder, f"{file_name}_{namespace_name}_barplot.png"), colors[namespace_name])
-
-    with open(output_file_scatterplot, 'r') as tsv_file:
-        scatterplot_data = pd.read_csv(tsv_file, sep='\t')
-
-    scatterplot_data = scatterplot_data.dropna(subset=['PC_0', 'PC_1'])
-    
-    x_values = scatterplot_data['PC_0']
-    y_values = scatterplot_data['PC_1']
-    log_size = scatterplot_data['LogSize']
-    term = scatterplot_data['TermID']
-
-    plt.scatter(x_values, y_values, s=abs(log_size*30), c='blue', edgecolors='black', alpha=0.6, linewidth=0.5)
-    plt.xlabel('Semantic Space X')
-    plt.ylabel('Semantic Space Y')
-    plt.title(f'{graphic_name} {namespace_name} PC_0 vs PC_1')
-    plt.savefig(os.path.join(graphics_folder, f"{file_name}_{namespace_name}_scatterplot.png"))
-    plt.close()
-    print("Scatterplot created and saved.")
-
-    with open(output_file_jTreeMap, encoding='utf-8') as inputfile:
-        data = json.load(inputfile)
-        json_to_csv(output_file_jTreeMap, f'{output_file_jTreeMap}.csv')
-
-def json_to_csv(json_file, csv_file):
-    with open(json_file) as json_file:
-        data = json.load(json_file)
-
-    employee_data = data['children']
-
-    with open(csv_file, 'w', newline='') as data_file:
-        csv_writer = csv.writer(data_file)
-        count = 0
-        for emp in employee_data:
-            if count == 0:
-                header = emp.keys()
-                csv_writer.writerow(header)
-                count += 1
-            csv_writer.writerow(emp.values())
-
-def create_treemap_from_csv(csv_file, output_file):
-    sizes = []
-    labels = []
-    parents = []
-    values = []
-
-    print("Reading CSV...")
-
-    with open(csv_file, 'r') as f:
-        csv_reader = csv.DictReader(f)
-        for row in csv_reader:
-            labels.append(row['name'])
-            parents.append("")
-            values.append(0)
-            sizes.append(1)
-
-    fig = go.Figure(go.Treemap(
-        labels=labels,
-        parents=parents,
-        values=sizes,
-        textinfo="label+value+percent root",
-        marker=dict(
-            colorscale="Viridis",
-            cmid=0,
-            showscale=True
-        )
-    ))
-
-    fig.update_layout(title_text="Treemap Title")
-
-    fig.write_image(output_file)
-
-    print("Treemap created and saved.")
-
-def make_request(file_path):
+    # The treemaps are drawn from the TreeMap file by treemap_generator, the R script is kept for reference
+    return output_files
+
+def plot_jobs(file_path, plotlyjs_folder=None, scatter_png=False):
+    '''
+    Function to describe the plots of a *_IDs_Pvalues.txt file as jobs for barplot_generator.render_jobs:
+    the bar plot and treemaps of every namespace with results, and the individual and combined bar plots of
+    the three namespaces when all of them have results. The semantic space of the terms is drawn by the
+    explorer of all the groups (see semantic_explorer.write_explorer).
+
+    Args:
+    - file_path: Path to the *_IDs_Pvalues.txt file
+    - plotlyjs_folder: Folder of the shared plotly.js bundle. By default, the folder of each HTML plot.
+    - scatter_png: Whether to also draw the static PC_0 vs PC_1 scatter plot of every namespace in
+      obtained_graphics. By default, False.
+
+    Returns:
+    - jobs: List of jobs as returned by barplot_generator.plot_job
+    '''
+    output_folder = os.path.join(os.path.dirname(file_path), "results_revigo")
+    graphics_folder = os.path.join(output_folder, "obtained_graphics")
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    graphic_name = file_name.split('_')
+    graphic_name = graphic_name[0] + ' ' + graphic_name[1] + ' ' + graphic_name[2]
+
+    jobs = []
+    paths = table_paths(file_path)
+    for namespace_name, table_path in paths.items():
+        if not os.path.exists(table_path):
+            continue
+        jobs.append(plot_job('barplot', table_path=table_path, title=f'{graphic_name} {namespace_name} Bar Plot',
+                             filename=os.path.join(output_folder, f"{file_name}_{namespace_name}_barplot.png"),
+                             color=COLORS[namespace_name], plotlyjs_folder=plotlyjs_folder))
+        if scatter_png:
+            jobs.append(plot_job('scatter', scatterplot_path=os.path.join(output_folder, f"{file_name}_{namespace_name}_scatterPlot.tsv"),
+                                 title=f'{graphic_name} {namespace_name} PC_0 vs PC_1',
+                                 filename=os.path.join(graphics_folder, f"{file_name}_{namespace_name}_scatterplot.png")))
+        jobs.append(plot_job('treemap', treemap_path=os.path.join(output_folder, f"{file_name}_{namespace_name}_TreeMap.tsv"),
+                             title=f'{file_name} {namespace_name} TreeMap',
+                             filename=os.path.join(output_folder, f"{file_name}_{namespace_name}_treemap.pdf"),
+                             html_file=os.path.join(output_folder, "3d_results", f"{file_name}_{namespace_name}_TreeMap.html"),
+                             plotlyjs_folder=plotlyjs_folder))
+
+    missing = [ns for ns, path in paths.items() if not os.path.exists(path)]
+    if missing:
+        print(f"Skipping combined bar plots of {file_path}, missing results for {', '.join(missing)}")
+    else:
+        jobs.append(plot_job('combined', bp_path=paths['BP'], mf_path=paths['MF'], cc_path=paths['CC'],
+                             output_folder=output_folder, plotlyjs_folder=plotlyjs_folder))
+    return jobs
+
+def table_paths(file_path):
+    '''
+    Function to get the paths of the REVIGO tables of a *_IDs_Pvalues.txt file, one per namespace.
+
+    Returns:
+    - paths: Dictionary with the namespaces (BP, MF, CC) as keys and the table paths as values
+    '''
+    output_folder = os.path.join(os.path.dirname(file_path), "results_revigo")
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    return {ns: os.path.join(output_folder, f"{file_name}_{ns}_table.tsv") for ns in ['BP', 'MF', 'CC']}
+
+def make_request(file_path, index=None, cutoff=0.7, base_url=REVIGO_URL):
     print(f"Starting processing for file: {file_path}")
     with ThreadPoolExecutor(max_workers=3) as executor:
-        futures = [executor.submit(process_file, file_path, ns) for ns in [1, 2, 3]]
+        futures = [executor.submit(process_file, file_path, ns, index, cutoff, base_url) for ns in [1, 2, 3]]
         for future in as_completed(futures):
-            future.result()  
+            future.result()
+    render_jobs(plot_jobs(file_path))
+
+def file_indexes(files, backgrounds, curr_dir):
+    '''
+    Function to get the annotation index of the background of every file, as assigned by
+    enrichment.select_backgrounds. A file belongs to the background with the deepest output folder that
+    contains it, and backgrounds with the same annotation file and gene map share one index.
+
+    Args:
+    - files: List of *_IDs_Pvalues.txt files
+    - backgrounds: Dictionary of backgrounds as returned by enrichment.select_backgrounds
+    - curr_dir: Folder the output folders of the backgrounds are relative to
+
+    Returns:
+    - indexes: Dictionary with the files as keys and their annotation indexes as values
+    '''
+    from enrichment import load_annotation_index
+    folders = sorted(((os.path.join(os.path.abspath(os.path.join(curr_dir, background['parameters']['output_folder'])), ''), background)
+                      for background in backgrounds.values()), key=lambda item: len(item[0]), reverse=True)
+    loaded, indexes = {}, {}
+    for file_path in files:
+        background = next((background for folder, background in folders if os.path.abspath(file_path).startswith(folder)), None)
+        if background is None:
+            print(f"Skipping {file_path}, it is not in the output folder of any background")
+            continue
+        key = (os.path.abspath(background['annotation']), background['parameters'].get('gene_map'))
+        if key not in loaded:
+            loaded[key] = load_annotation_index(background['annotation'], background['parameters'])
+        indexes[file_path] = loaded[key]
+    return indexes
 
 def main():
     curr_dir = os.path.dirname(os.path.abspath(__file__))
@@ -174,21 +213,44 @@ def main():
     output_folder = config['output_folder']
     output_folder = os.path.join(curr_dir, output_folder)
 
+    # By default the terms are clustered locally with the background of each group, 'revigo': 'web' uses
+    # the REVIGO web service instead
+    local = config.get('revigo', 'local') == 'local'
+    backgrounds = {}
+    if local:
+        from enrichment import select_files, select_ranked_files, select_backgrounds
+        grouped_files, annotation_file = select_files()
+        backgrounds = select_backgrounds(sorted(set(grouped_files) | set(select_ranked_files())), annotation_file, config)
+    cutoff = config.get('revigo_cutoff', 0.7)
+    base_url = config.get('revigo_url', REVIGO_URL)
+    workers = config.get('workers', os.cpu_count() or 1)
+
+    # Only the GO results are grouped: the results of the other vocabularies (<group>/<vocabulary>) and the
+    # partial results of the shards are left out
+    from eggnog_to_gsc import VOCABULARIES
+    from shards import SHARDS_FOLDER
+    skipped = {vocabulary for vocabulary in VOCABULARIES if vocabulary != 'GO'} | {SHARDS_FOLDER}
     files_to_process = []
     for root, dirs, files in os.walk(output_folder):
+        dirs[:] = [directory for directory in dirs if directory not in skipped]
         for file in files:
             if file.endswith('IDs_Pvalues.txt'):
                 file_path = os.path.join(root, file)
                 files_to_process.append(file_path)
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        [executor.submit(make_request, file_path) for file_path in files_to_process]
-
-    file_dir = os.path.dirname(os.path.abspath(file_path))
-
-    #create_combined_barplot(tables_paths, os.path.join(file_dir, 'results_revigo'))
+    # A single pool for every file and namespace, the plots of each file use only its own tables
+    indexes = {}
+    if local:
+        indexes = file_indexes(files_to_process, backgrounds, curr_dir)
+        files_to_process = [file_path for file_path in files_to_process if file_path in indexes]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_file, file_path, ns, indexes.get(file_path), cutoff, base_url) for file_path in files_to_process for ns in [1, 2, 3]]
+        for future in as_completed(futures):
+            future.result()
 
-    process_and_plot(tables_paths['BP'], tables_paths['MF'], tables_paths['CC'], os.path.join(file_dir, 'results_revigo'))
+    # All the plots are rendered in one process pool, referencing a single plotly.js bundle
+    jobs = [job for file_path in files_to_process for job in plot_jobs(file_path, output_folder, config.get('scatter_png', False))]
+    render_jobs(jobs, workers=workers)
 
     print("All files processed.")
 
@@ -0,0 +1,148 @@
+import json
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+NAMESPACE_NAMES = {'1': 'biological_process', '2': 'cellular_component', '3': 'molecular_function'}
+
+
+class RevigoStubServer(ThreadingHTTPServer):
+    '''
+    Local stand-in for the REVIGO web service (StartJob and QueryJob endpoints), used to test the client,
+    its cache and its retries without network access.
+
+    Args:
+    - address: (host, port) tuple. Port 0 picks a free port.
+    - running_polls: Number of 'jstatus' polls answered as running before a job finishes. By default, 2.
+    - fail_first: Number of requests answered with a 503 error before the server starts working. By default, 0.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, running_polls=2, fail_first=0):
+        super().__init__(address, RevigoStubHandler)
+        self.running_polls = running_polls
+        self.fail_first = fail_first
+        self.jobs = {}
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+class RevigoStubHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_text(self, text, status=200, content_type='text/plain'):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def failing(self):
+        with self.server.lock:
+            self.server.counts['requests'] += 1
+            if self.server.fail_first > 0:
+                self.server.fail_first -= 1
+                self.server.counts['failed'] += 1
+                return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        if self.failing():
+            return self.send_text('Service Unavailable', 503)
+        if urlparse(self.path).path != '/StartJob':
+            return self.send_text('Not Found', 404)
+
+        with self.server.lock:
+            jobid = len(self.server.jobs) + 1
+            self.server.jobs[jobid] = {'form': form, 'polls': 0}
+            self.server.counts['StartJob'] += 1
+        self.send_text(json.dumps({'jobid': jobid}), content_type='application/json')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if self.failing():
+            return self.send_text('Service Unavailable', 503)
+        if url.path != '/QueryJob':
+            return self.send_text('Not Found', 404)
+
+        with self.server.lock:
+            job = self.server.jobs.get(int(params.get('jobid', 0)))
+            if job is None:
+                return self.send_text('error: unknown job')
+            result_type = params.get('type')
+            self.server.counts[result_type] += 1
+            if result_type == 'jstatus':
+                job['polls'] += 1
+                running = int(job['polls'] <= self.server.running_polls)
+                return self.send_text(json.dumps({'running': running, 'message': ''}), content_type='application/json')
+
+        terms = [line.split()[:2] for line in job['form'].get('goList', '').splitlines() if line.startswith('GO:')]
+        namespace = NAMESPACE_NAMES.get(params.get('namespace'), 'biological_process')
+        self.send_text(canned_output(result_type, terms, namespace))
+
+
+def canned_output(result_type, terms, namespace):
+    '''
+    Function to build a REVIGO-like answer with every term kept as its own representative.
+
+    Args:
+    - result_type: 'table', 'scatterPlot', 'TreeMap' or 'RTreeMap'
+    - terms: List of [GO ID, p-value] pairs
+    - namespace: Namespace name written in the answer
+
+    Returns:
+    - text: Answer text
+    '''
+    if result_type == 'table':
+        lines = ['TermID\tName\tFrequency\tValue\tUniqueness\tDispensability\tRepresentative\tEliminated']
+        lines += [f'"{go_id}"\t"{namespace} term {go_id}"\t0.1\t{value}\t1\t0\tnull\tFalse' for go_id, value in terms]
+    elif result_type == 'scatterPlot':
+        lines = ['TermID\tName\tValue\tLogSize\tFrequency\tUniqueness\tDispensability\tPC_0\tPC_1\tRepresentative']
+        lines += [f'"{go_id}"\t"{namespace} term {go_id}"\t{value}\t1\t0.1\t1\t0\t{i}\t{-i}\tnull'
+                  for i, (go_id, value) in enumerate(terms)]
+    elif result_type == 'TreeMap':
+        lines = ['# WARNING - This is an automatically generated file.',
+                 'TermID\tName\tFrequency\tValue\tUniqueness\tDispensability\tRepresentative']
+        lines += [f'"{go_id}"\t"{namespace} term {go_id}"\t0.1\t{value}\t1\t0\tnull' for go_id, value in terms]
+    elif result_type == 'RTreeMap':
+        lines = ['# A treemap R script produced by the Revigo stub server',
+                 'pdf( file="revigo_treemap.pdf", width=16, height=9 )',
+                 'treemap(stuff, title = "Revigo TreeMap", position.legend = "none")',
+                 'dev.off()']
+    else:
+        return 'error: unknown result type'
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the REVIGO web service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--running-polls', type=int, default=2, help='Polls answered as running before a job finishes')
+    parser.add_argument('--fail-first', type=int, default=0, help='Number of initial requests answered with a 503 error')
+    args = parser.parse_args()
+
+    server = RevigoStubServer((args.host, args.port), args.running_polls, args.fail_first)
+    print(f"REVIGO stub server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
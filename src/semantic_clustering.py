@@ -0,0 +1,297 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Terms annotated to more than this fraction of the background are considered too general (as in REVIGO)
+GENERAL_TERM_FREQUENCY = 0.05
+# Permissive cutoff used to group the terms of the TreeMap, as in the REVIGO TreeMap export
+TREEMAP_CUTOFF = 0.1
+
+TREEMAP_HEADER = """# WARNING - This exported Revigo data is only useful for the specific purpose of constructing a TreeMap visualization.
+# Do not use this table as a general list of non-redundant GO categories, as it sets an extremely permissive
+# threshold to detect redundancies (c=0.10) and fill the 'representative' column, while normally c>=0.4 is recommended.
+# To export a reduced-redundancy set of GO terms, go to the Scatterplot or Table tab, and export from there.
+"""
+
+RSCRIPT_TEMPLATE = """# A treemap R script produced locally in the format of the Revigo server at http://revigo.irb.hr/
+# If you found Revigo useful in your work, please cite the following reference:
+# Supek F et al. "REVIGO summarizes and visualizes long lists of Gene Ontology
+# terms" PLoS ONE 2011. doi:10.1371/journal.pone.0021800
+
+library(treemap) 								# treemap package by Martijn Tennekes
+
+revigo.names <- c("term_ID","description","frequency","value","uniqueness","dispensability","representative");
+revigo.data <- rbind({rows});
+
+stuff <- data.frame(revigo.data);
+names(stuff) <- revigo.names;
+
+stuff$value <- as.numeric( as.character(stuff$value) );
+stuff$frequency <- as.numeric( as.character(stuff$frequency) );
+stuff$uniqueness <- as.numeric( as.character(stuff$uniqueness) );
+stuff$dispensability <- as.numeric( as.character(stuff$dispensability) );
+
+# by default, outputs to a PDF file
+pdf( file="revigo_treemap.pdf", width=16, height=9 ) # width and height are in inches
+
+treemap(
+  stuff,
+  index = c("representative","description"),
+  vSize = "value",
+  type = "categorical",
+  vColor = "representative",
+  title = "Revigo TreeMap",
+  inflate.labels = FALSE,      # set this to TRUE for space-filling group labels - good for posters
+  lowerbound.cex.labels = 0,   # try to draw as many labels as possible (still, some small squares may not get a label)
+  bg.labels = "#CCCCCCAA",   # define background color of group labels
+								 # "#CCCCCC00" is fully transparent, "#CCCCCCAA" is semi-transparent grey, NA is opaque
+  position.legend = "none"
+)
+
+dev.off()
+"""
+
+
+def simrel_matrix(index, term_codes):
+    '''
+    Function to compute the pairwise SimRel semantic similarity of a list of GO terms.
+
+    The information content of each term is computed from the background: p(t) is the fraction of the
+    annotated background transcripts of the ontology that are annotated to t. For every pair, the most
+    informative common ancestor (MICA) is found by updating, for every shared ancestor, the block of pairs
+    it covers, and SimRel = 2 ln p(MICA) / (ln p(t1) + ln p(t2)) * (1 - p(MICA)).
+
+    Args:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index
+    - term_codes: Array with the codes of the terms in index['terms']. All must belong to the same ontology.
+
+    Returns:
+    - similarity: Array of shape (n, n) with the pairwise SimRel values (1 on the diagonal)
+    - frequency: Array with the background frequency p(t) of each term
+    '''
+    ontology = index['dag']['namespace'][term_codes[0]] if len(term_codes) else 'BP'
+    frequency_all = index['term_size'] / max(index['ontology_size'][ontology], 1)
+
+    n_terms = len(term_codes)
+    ancestors = (index['ancestors'][term_codes] + sparse.identity(len(index['terms']), dtype=np.int32, format='csr')[term_codes]).tocsc()
+    log_p = np.log(np.clip(frequency_all, 1e-300, 1.0))
+    # Only ancestors shared by at least two terms and more informative than the root can be a MICA
+    used = np.flatnonzero((ancestors.getnnz(axis=0) > 1) & (log_p < 0))
+    ancestors = ancestors[:, used]
+
+    # Most informative (lowest log p) common ancestor of every pair: each ancestor updates the block of
+    # pairs it covers, so the cost is the sum of the squared ancestor sizes
+    mica = np.zeros((n_terms, n_terms))
+    for column, ancestor in enumerate(used):
+        members = ancestors.indices[ancestors.indptr[column]:ancestors.indptr[column + 1]]
+        block = np.ix_(members, members)
+        mica[block] = np.minimum(mica[block], log_p[ancestor])
+
+    log_terms = np.log(np.clip(frequency_all[term_codes], 1e-300, 1.0))
+    denominator = log_terms[:, None] + log_terms[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = np.where(denominator < 0, 2 * mica / denominator, 0.0) * (1 - np.exp(mica))
+    np.fill_diagonal(similarity, 1.0)
+    return np.clip(similarity, 0.0, 1.0), frequency_all[term_codes]
+
+
+def dispensability(similarity, frequency, pvalues, is_child):
+    '''
+    Function to reduce the redundancy of a term list with the REVIGO greedy procedure.
+
+    The most similar pair of remaining terms is found, and one of them is rejected: a term annotated to more
+    than 5% of the background is rejected first, then the term with the worse p-value, then the child term
+    if one is a parent of the other. The similarity at which a term was rejected is its dispensability, and
+    the term that rejected it is its representative. The process goes on until one term remains. Only the rows
+    whose most similar term was rejected are rescanned at each step.
+
+    Args:
+    - similarity: Pairwise similarity matrix as returned by simrel_matrix
+    - frequency: Array with the background frequency of each term
+    - pvalues: Array with the p-value of each term
+    - is_child: Boolean matrix, is_child[i, j] is True when term i is a descendant of term j
+
+    Returns:
+    - dispensabilities: Array with the dispensability of each term (0 for the last remaining term)
+    - rejected_by: Array with the position of the term that rejected each term (-1 if never rejected)
+    '''
+    n_terms = len(pvalues)
+    remaining_similarity = similarity.astype(float).copy()
+    np.fill_diagonal(remaining_similarity, -np.inf)
+    row_best = remaining_similarity.argmax(axis=1) if n_terms else np.zeros(0, dtype=np.int64)
+    row_max = remaining_similarity[np.arange(n_terms), row_best] if n_terms else np.zeros(0)
+    dispensabilities = np.zeros(n_terms)
+    rejected_by = np.full(n_terms, -1, dtype=np.int64)
+    alive = np.ones(n_terms, dtype=bool)
+
+    for _ in range(n_terms - 1):
+        first = int(np.argmax(np.where(alive, row_max, -np.inf)))
+        second = int(row_best[first])
+        general = frequency[[first, second]] > GENERAL_TERM_FREQUENCY
+        if general.any() and not general.all():
+            rejected = first if general[0] else second
+        elif general.all() and frequency[first] != frequency[second]:
+            rejected = first if frequency[first] > frequency[second] else second
+        elif pvalues[first] != pvalues[second]:
+            rejected = first if pvalues[first] > pvalues[second] else second
+        elif is_child[first, second] or is_child[second, first]:
+            rejected = first if is_child[first, second] else second
+        else:
+            rejected = max(first, second)
+        kept = second if rejected == first else first
+
+        dispensabilities[rejected] = remaining_similarity[first, second]
+        rejected_by[rejected] = kept
+        alive[rejected] = False
+        remaining_similarity[rejected, :] = -np.inf
+        remaining_similarity[:, rejected] = -np.inf
+        stale = np.flatnonzero(alive & (row_best == rejected))
+        if len(stale):
+            row_best[stale] = remaining_similarity[stale].argmax(axis=1)
+            row_max[stale] = remaining_similarity[stale, row_best[stale]]
+
+    return np.clip(dispensabilities, 0.0, None), rejected_by
+
+
+def representatives(dispensabilities, rejected_by, cutoff):
+    '''
+    Function to find, for every term, the term that represents it at a given similarity cutoff.
+
+    Returns:
+    - representative: Array with the position of the representative of each removed term, or -1 for the
+      terms kept at the cutoff
+    '''
+    removed = dispensabilities > cutoff
+    representative = np.where(removed, rejected_by, -1)
+    # Follow the chain of rejections until a kept term is reached
+    while True:
+        chained = (representative >= 0) & removed[np.maximum(representative, 0)]
+        if not chained.any():
+            return representative
+        representative[chained] = rejected_by[representative[chained]]
+
+
+def classical_mds(distance, dimensions=2):
+    '''
+    Function to embed a distance matrix in a low dimensional space with classical multidimensional scaling.
+    '''
+    n_terms = len(distance)
+    if n_terms < 2:
+        return np.zeros((n_terms, dimensions))
+    centering = np.eye(n_terms) - 1.0 / n_terms
+    gram = -0.5 * centering @ (distance ** 2) @ centering
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    order = np.argsort(eigenvalues)[::-1][:dimensions]
+    coordinates = eigenvectors[:, order] * np.sqrt(np.clip(eigenvalues[order], 0.0, None))
+    if coordinates.shape[1] < dimensions:
+        coordinates = np.hstack([coordinates, np.zeros((n_terms, dimensions - coordinates.shape[1]))])
+    return coordinates
+
+
+def cluster_terms(index, go_ids, pvalues, ontology, cutoff=0.7):
+    '''
+    Function to summarize a list of enriched GO terms of one ontology, as the REVIGO web service does.
+
+    Args:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index
+    - go_ids: List of GO IDs
+    - pvalues: List with the p-value of each GO ID
+    - ontology: Ontology to summarize ('BP', 'CC' or 'MF'). Terms of other ontologies are ignored.
+    - cutoff: Similarity above which a term is considered redundant. By default, 0.7.
+
+    Returns:
+    - table: DataFrame with TermID, Name, Value, LogSize, Frequency, Uniqueness, Dispensability, PC_0, PC_1
+      and Representative columns, one row per term
+    - treemap: DataFrame with TermID, Name, Frequency, Value, Uniqueness, Dispensability and Representative
+      columns for the terms kept at the cutoff, grouped by their representative at c=0.1
+    '''
+    codes = np.array([index['dag']['codes'].get(go_id, -1) for go_id in go_ids], dtype=np.int64)
+    keep = (codes >= 0)
+    keep[keep] = (index['dag']['namespace'][codes[keep]] == ontology) & (index['term_size'][codes[keep]] > 0)
+    codes, pvalues = codes[keep], np.asarray(pvalues, dtype=float)[keep]
+    codes, first = np.unique(codes, return_index=True)
+    pvalues = pvalues[first]
+
+    similarity, frequency = simrel_matrix(index, codes)
+    is_child = (index['ancestors'][codes][:, codes].toarray() > 0) if len(codes) else np.zeros((0, 0), dtype=bool)
+    dispensabilities, rejected_by = dispensability(similarity, frequency, pvalues, is_child)
+    n_terms = len(codes)
+    uniqueness = 1 - (similarity.sum(axis=1) - 1) / max(n_terms - 1, 1) if n_terms > 1 else np.ones(n_terms)
+
+    representative = representatives(dispensabilities, rejected_by, cutoff)
+    kept = representative < 0
+    coordinates = np.full((n_terms, 2), np.nan)
+    coordinates[kept] = classical_mds(1 - similarity[np.ix_(kept, kept)])
+
+    go_terms = index['terms'][codes]
+    table = pd.DataFrame({'TermID': go_terms,
+                          'Name': index['names'][codes],
+                          'Value': np.log10(np.clip(pvalues, 1e-300, None)),
+                          'LogSize': np.log10(index['term_size'][codes]),
+                          'Frequency': frequency * 100,
+                          'Uniqueness': uniqueness,
+                          'Dispensability': dispensabilities,
+                          'PC_0': coordinates[:, 0],
+                          'PC_1': coordinates[:, 1],
+                          'Representative': pd.Series([int(go_terms[r].split(':')[1]) if r >= 0 else None for r in representative], dtype=object)})
+
+    group = representatives(dispensabilities, rejected_by, TREEMAP_CUTOFF)
+    group = np.where(group < 0, np.arange(n_terms), group)
+    order = [i for head in np.flatnonzero(kept & (group == np.arange(n_terms)))
+             for i in [head] + [j for j in np.flatnonzero(kept & (group == head)) if j != head]]
+    treemap = pd.DataFrame({'TermID': go_terms[order],
+                            'Name': index['names'][codes][order],
+                            'Frequency': frequency[order] * 100,
+                            'Value': table['Value'].to_numpy()[order],
+                            'Uniqueness': uniqueness[order],
+                            'Dispensability': dispensabilities[order],
+                            'Representative': pd.Series([None if group[i] == i else index['names'][codes][group[i]] for i in order], dtype=object)})
+    return table, treemap
+
+
+def format_tsv(df, quoted):
+    '''
+    Function to format a DataFrame as tab-separated text with the REVIGO quoting: the given columns are
+    double-quoted and missing values are written as null.
+    '''
+    lines = ['\t'.join(df.columns)]
+    for row in df.itertuples(index=False):
+        fields = []
+        for column, value in zip(df.columns, row):
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                fields.append('null')
+            elif column in quoted:
+                fields.append(f'"{value}"')
+            else:
+                fields.append(str(value))
+        lines.append('\t'.join(fields))
+    return '\n'.join(lines) + '\n'
+
+
+def revigo_outputs(index, ids_pvalues_file, ontology, cutoff=0.7):
+    '''
+    Function to produce, without the REVIGO web service, the table, scatterPlot, TreeMap and R treemap
+    script that REVIGO returns for one ontology of an *_IDs_Pvalues.txt file.
+
+    Args:
+    - index: Annotation index as returned by go_enrichment.build_annotation_index
+    - ids_pvalues_file: Path to the *_IDs_Pvalues.txt file
+    - ontology: Ontology to summarize ('BP', 'CC' or 'MF')
+    - cutoff: Similarity above which a term is considered redundant. By default, 0.7.
+
+    Returns:
+    - outputs: Dictionary with the 'table', 'scatterPlot', 'TreeMap' and 'RTreeMap' texts
+    '''
+    enriched = pd.read_csv(ids_pvalues_file, sep='\t')
+    table, treemap = cluster_terms(index, enriched.iloc[:, 0].tolist(), enriched.iloc[:, 1].tolist(), ontology, cutoff)
+
+    scatter_columns = ['TermID', 'Name', 'Value', 'LogSize', 'Frequency', 'Uniqueness', 'Dispensability', 'PC_0', 'PC_1', 'Representative']
+    rows = ',\n'.join('c("{}","{}",{},{},{},{},"{}")'.format(row.TermID, row.Name.replace('"', '\\"'), row.Frequency, abs(row.Value),
+                                                             row.Uniqueness, row.Dispensability,
+                                                             (row.Representative or row.Name).replace('"', '\\"'))
+                      for row in treemap.itertuples(index=False))
+
+    return {'table': format_tsv(table.drop(columns=['PC_0', 'PC_1']), quoted={'TermID', 'Name'}),
+            'scatterPlot': format_tsv(table[scatter_columns], quoted={'TermID', 'Name'}),
+            'TreeMap': TREEMAP_HEADER + format_tsv(treemap, quoted={'TermID', 'Name', 'Representative'}),
+            'RTreeMap': RSCRIPT_TEMPLATE.replace('{rows}', rows)}
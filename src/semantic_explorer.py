@@ -0,0 +1,481 @@
+import os
+import re
+import sys
+import csv
+import glob
+import json
+import argparse
+import threading
+import numpy as np
+from plotly.offline import get_plotlyjs
+from barplot_generator import plotlyjs_reference
+from results_store import ONTOLOGIES
+
+# Name of the explorer, at the root of the output folder
+EXPLORER_FILE = 'semantic_space.html'
+SCATTERPLOT_PATTERN = re.compile(r'_(BP|MF|CC)_scatterPlot\.tsv$')
+# Colors of the ontologies, as in the bar plots
+ONTOLOGY_COLORS = {'BP': '#87ceeb', 'MF': '#f08080', 'CC': '#90ee90'}
+
+
+def scatterplot_files(ids_files):
+    '''
+    Function to find the REVIGO scatter plot tables of the GO results of the candidates and ranked files.
+
+    Args:
+    - ids_files: List of tuples (group, ids_file), where ids_file is the _IDs_Pvalues.txt file of a candidates
+      or ranked file
+
+    Returns:
+    - files: List of tuples (group, name, ontology, scatterplot_file), where name is the name of the candidates or
+      ranked file
+    '''
+    files = []
+    for group, ids_file in ids_files:
+        revigo_folder = os.path.join(os.path.dirname(ids_file), 'results_revigo')
+        file_name = os.path.splitext(os.path.basename(ids_file))[0]
+        for ontology in ONTOLOGIES:
+            scatterplot_file = os.path.join(revigo_folder, f"{file_name}_{ontology}_scatterPlot.tsv")
+            if os.path.exists(scatterplot_file) and os.path.getsize(scatterplot_file):
+                files.append((group, os.path.basename(os.path.dirname(ids_file)), ontology, scatterplot_file))
+    return files
+
+
+def find_scatterplots(output_folder):
+    '''
+    Function to find the REVIGO scatter plot tables of every group of an output folder, laid out as
+    <output_folder>/<group>/<name>/results_revigo/<name>_<p>_IDs_Pvalues_<ontology>_scatterPlot.tsv.
+
+    Returns:
+    - files: List of tuples as returned by scatterplot_files
+    '''
+    files = []
+    for scatterplot_file in sorted(glob.glob(os.path.join(output_folder, '*', '*', 'results_revigo', '*_scatterPlot.tsv'))):
+        match = SCATTERPLOT_PATTERN.search(scatterplot_file)
+        if match and os.path.getsize(scatterplot_file):
+            name_folder = os.path.dirname(os.path.dirname(scatterplot_file))
+            files.append((os.path.basename(os.path.dirname(name_folder)), os.path.basename(name_folder), match.group(1),
+                          scatterplot_file))
+    return files
+
+
+def read_scatterplot(scatterplot_file):
+    '''
+    Function to read the terms of a REVIGO scatter plot table that have coordinates in the semantic space (the
+    redundant terms have null coordinates). The csv module is used instead of pandas, as the explorer reads
+    thousands of small tables.
+
+    Returns:
+    - rows: List of tuples (GO ID, name, -log10 p-value, LogSize, PC_0, PC_1, representative), where representative
+      is True if the term is the representative of its cluster
+    '''
+    rows = []
+    with open(scatterplot_file, 'r', encoding='utf-8', newline='') as file:
+        reader = csv.DictReader(file, delimiter='\t')
+        for row in reader:
+            if row['PC_0'] in ('', 'null') or row['PC_1'] in ('', 'null'):
+                continue
+            # REVIGO gives the representative as the number of its GO ID, and null for the representatives
+            representative = row['Representative']
+            is_representative = representative in ('', 'null') or representative.lstrip('0') == row['TermID'].split(':')[-1].lstrip('0')
+            value = float(row['Value']) if row['Value'] not in ('', 'null') else 0.0
+            log_size = float(row['LogSize']) if row['LogSize'] not in ('', 'null') else 0.0
+            rows.append((row['TermID'], row['Name'], -value, log_size, float(row['PC_0']), float(row['PC_1']), is_representative))
+    return rows
+
+
+def explorer_data(files):
+    '''
+    Function to gather the semantic space of the terms of every group into compact columns. The terms of each
+    group are sorted from the most to the least significant, and their IDs and names are stored once in a
+    table shared by all the groups.
+
+    Args:
+    - files: List of tuples as returned by scatterplot_files
+
+    Returns:
+    - index: Dictionary with the 'ontologies', the 'terms' table (IDs and names), the 'groups' (name and number
+      of points of each group) and the 'extent' of the coordinates
+    - groups: List with the columns of every group: the names of its 'files', the coordinates 'x' and 'y'
+      (PC_0 and PC_1), 'v' (-log10 p-value), 's' (LogSize), 'o' (ontology), 't' (term), 'f' (file) and 'r' (1 if
+      the term is a representative)
+    '''
+    rows, keys = [], []
+    for group, name, ontology, scatterplot_file in files:
+        file_rows = read_scatterplot(scatterplot_file)
+        rows += file_rows
+        keys += [(group, name, ONTOLOGIES.index(ontology))] * len(file_rows)
+    if not rows:
+        return None, []
+    go_ids, names, values, log_sizes, pc_0, pc_1, representatives = zip(*rows)
+    group_names, files_names, ontology_codes = zip(*keys)
+    values, pc_0, pc_1 = np.array(values), np.array(pc_0), np.array(pc_1)
+
+    term_ids, first, term_codes = np.unique(np.array(go_ids, dtype=str), return_index=True, return_inverse=True)
+    group_list, group_codes = np.unique(np.array(group_names, dtype=str), return_inverse=True)
+    index = {'ontologies': ONTOLOGIES, 'terms': {'ids': term_ids.tolist(), 'names': [names[i] for i in first]}, 'groups': [],
+             'extent': [float(pc_0.min()), float(pc_0.max()), float(pc_1.min()), float(pc_1.max()), 0.0, float(values.max())]}
+    columns = {'x': np.round(pc_0, 5), 'y': np.round(pc_1, 5), 'v': np.round(values, 4), 's': np.round(np.array(log_sizes), 3),
+               'o': np.array(ontology_codes), 't': term_codes.ravel(), 'r': np.array(representatives, dtype=int)}
+    files_names = np.array(files_names, dtype=str)
+    # Points of every group, from the most to the least significant
+    order = np.lexsort((-values, group_codes.ravel()))
+    bounds = np.searchsorted(group_codes.ravel()[order], np.arange(len(group_list) + 1))
+    groups = []
+    for number, group in enumerate(group_list):
+        selected = order[bounds[number]:bounds[number + 1]]
+        file_names, file_codes = np.unique(files_names[selected], return_inverse=True)
+        groups.append(dict({'files': file_names.tolist(), 'f': file_codes.ravel().tolist()},
+                           **{key: column[selected].tolist() for key, column in columns.items()}))
+        index['groups'].append({'name': str(group), 'points': len(selected)})
+    return index, groups
+
+
+def json_script(element_id, value):
+    # JSON data block of the page, parsed by the browser only when it is needed. '</' is escaped so that
+    # a term name cannot close the script element.
+    text = json.dumps(value, separators=(',', ':')).replace('</', '<\\/')
+    return f'<script type="application/json" id="{element_id}">{text}</script>\n'
+
+
+def write_explorer(files, output_file, title='Semantic space of the enriched GO terms', plotlyjs_folder=None,
+                   standalone=False, max_points=20000, initial_points=200000):
+    '''
+    Function to save an interactive WebGL explorer of the semantic space of the enriched terms of every group
+    and ontology, in one HTML file (see EXPLORER_TEMPLATE).
+
+    The page draws a 2D WebGL scatter of the REVIGO coordinates, or a 3D scatter with the -log10 p-value as the
+    height. The data of every group is kept in its own JSON block, which is only parsed when the group is
+    selected, and the filters (groups, ontologies, p-value, term search, representatives) are applied in the
+    browser. At most max_points points are drawn for the current view: when more points are visible, the view is
+    divided into a grid of max_points cells and the most significant point of every cell is drawn, so zooming in
+    shows more detail and the page stays responsive with hundreds of thousands of terms.
+
+    Args:
+    - files: List of tuples as returned by scatterplot_files
+    - output_file: Path to the HTML file
+    - title: Title of the page
+    - plotlyjs_folder: Folder of the shared plotly.js bundle. By default, the folder of the HTML file.
+    - standalone: Whether to embed plotly.js in the page, so that it can be opened without the bundle. By
+      default, False.
+    - max_points: Largest number of points drawn for the current view. By default, 20000.
+    - initial_points: Largest number of points of the groups selected when the page is opened (at least the first
+      group is selected). By default, 200000.
+
+    Returns:
+    - output_file: Path to the HTML file, or None if there are no terms to plot
+    '''
+    index, groups = explorer_data(files)
+    if index is None:
+        print(f"No terms to plot in the semantic space explorer {output_file}")
+        return None
+    index['settings'] = {'title': title, 'max_points': int(max_points), 'initial_points': int(initial_points),
+                         'colors': ONTOLOGY_COLORS}
+
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    if standalone:
+        plotlyjs = f'<script type="text/javascript">{get_plotlyjs()}</script>'
+    else:
+        plotlyjs = f'<script src="{plotlyjs_reference(output_file, plotlyjs_folder)}"></script>'
+    data = json_script('explorer-index', index) + ''.join(json_script(f'group-{number}', group) for number, group in enumerate(groups))
+    page = EXPLORER_TEMPLATE.replace('__TITLE__', title.replace('<', '&lt;')).replace('__PLOTLYJS__', plotlyjs).replace('__DATA__', data)
+
+    # The page is replaced at once, so a merged output folder never modifies the file of a shard (see shards.py)
+    tmp_path = f"{output_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(page)
+    os.replace(tmp_path, output_file)
+    print(f"Semantic space explorer written to {output_file}: {sum(group['points'] for group in index['groups'])} terms "
+          f"of {len(groups)} groups")
+    return output_file
+
+
+EXPLORER_TEMPLATE = r'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>__TITLE__</title>
+__PLOTLYJS__
+<style>
+  body { margin: 0; font-family: sans-serif; font-size: 13px; display: flex; height: 100vh; }
+  #sidebar { width: 280px; padding: 10px; overflow-y: auto; border-right: 1px solid #ddd; box-sizing: border-box; }
+  #sidebar h3 { margin: 12px 0 4px; font-size: 13px; }
+  #sidebar input[type=text], #sidebar select { width: 100%; box-sizing: border-box; }
+  #groups { max-height: 35vh; overflow-y: auto; border: 1px solid #eee; padding: 2px; }
+  #groups label { display: block; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
+  #plot { flex: 1; min-width: 0; }
+  #status { color: #555; margin-top: 10px; }
+</style>
+</head>
+<body>
+<div id="sidebar">
+  <b id="title"></b>
+  <h3>Groups</h3>
+  <input type="text" id="group-search" placeholder="Filter groups">
+  <div><a href="#" id="groups-all">Select shown</a> · <a href="#" id="groups-none">Clear</a></div>
+  <div id="groups"></div>
+  <h3>Ontologies</h3>
+  <div id="ontologies"></div>
+  <h3>Minimum -log10(p): <span id="min-value-label">0</span></h3>
+  <input type="range" id="min-value" min="0" step="0.1" value="0" style="width: 100%">
+  <h3>Terms</h3>
+  <input type="text" id="term-search" placeholder="GO ID or name">
+  <label><input type="checkbox" id="representatives"> Representative terms only</label>
+  <h3>View</h3>
+  <select id="mode"><option value="2d">2D semantic space</option><option value="3d">3D (height: -log10 p)</option></select>
+  <select id="color"><option value="group">Color by group</option><option value="ontology">Color by ontology</option>
+    <option value="value">Color by -log10(p)</option></select>
+  <div id="status"></div>
+</div>
+<div id="plot"></div>
+__DATA__
+<script type="text/javascript">
+'use strict';
+const PALETTE = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf',
+                 '#aec7e8', '#ffbb78', '#98df8a', '#ff9896', '#c5b0d5', '#c49c94', '#f7b6d2', '#c7c7c7', '#dbdb8d', '#9edae5'];
+
+// Concatenate the columns of the selected groups into typed arrays
+function combinePoints(groups) {
+  let n = 0;
+  for (const group of groups) n += group.data.x.length;
+  const points = {n: n, x: new Float32Array(n), y: new Float32Array(n), v: new Float32Array(n), s: new Float32Array(n),
+                  o: new Uint8Array(n), t: new Int32Array(n), f: new Int32Array(n), r: new Uint8Array(n), g: new Int32Array(n)};
+  let offset = 0;
+  for (const group of groups) {
+    const data = group.data;
+    for (const key of ['x', 'y', 'v', 's', 'o', 't', 'f', 'r']) points[key].set(data[key], offset);
+    points.g.fill(group.number, offset, offset + data.x.length);
+    offset += data.x.length;
+  }
+  return points;
+}
+
+// Indices of the points that pass the filters. termMatch has one flag per term of the index, or is null.
+function filterPoints(points, ontologies, minValue, representatives, termMatch) {
+  const selected = new Uint32Array(points.n);
+  let count = 0;
+  for (let i = 0; i < points.n; i++) {
+    if (!ontologies[points.o[i]] || points.v[i] < minValue || (representatives && !points.r[i]) ||
+        (termMatch && !termMatch[points.t[i]])) continue;
+    selected[count++] = i;
+  }
+  return selected.subarray(0, count);
+}
+
+// Points to draw for a view [x0, x1, y0, y1] (or the whole space if range is null). The points in the view and in
+// a margin of a quarter of the view around it are kept, so panning does not show empty borders; if there are more
+// than budget, the kept area is divided in a grid of budget cells and only the most significant point of every
+// cell is drawn.
+function downsample(points, selected, range, budget) {
+  let x0 = -Infinity, x1 = Infinity, y0 = -Infinity, y1 = Infinity;
+  if (range) {
+    const marginX = (range[1] - range[0]) / 4, marginY = (range[3] - range[2]) / 4;
+    x0 = range[0] - marginX; x1 = range[1] + marginX; y0 = range[2] - marginY; y1 = range[3] + marginY;
+  }
+  const inside = new Uint32Array(selected.length);
+  let count = 0;
+  let minX = Infinity, maxX = -Infinity, minY = Infinity, maxY = -Infinity;
+  for (let k = 0; k < selected.length; k++) {
+    const i = selected[k], x = points.x[i], y = points.y[i];
+    if (x < x0 || x > x1 || y < y0 || y > y1) continue;
+    inside[count++] = i;
+    if (x < minX) minX = x;
+    if (x > maxX) maxX = x;
+    if (y < minY) minY = y;
+    if (y > maxY) maxY = y;
+  }
+  if (count <= budget) return inside.subarray(0, count);
+
+  const side = Math.max(1, Math.floor(Math.sqrt(budget)));
+  const cellX = (maxX - minX) / side || 1, cellY = (maxY - minY) / side || 1;
+  const best = new Int32Array(side * side).fill(-1);
+  for (let k = 0; k < count; k++) {
+    const i = inside[k];
+    const cell = Math.min(Math.floor((points.x[i] - minX) / cellX), side - 1) * side +
+                 Math.min(Math.floor((points.y[i] - minY) / cellY), side - 1);
+    if (best[cell] < 0 || points.v[i] > points.v[best[cell]]) best[cell] = i;
+  }
+  return best.filter(i => i >= 0);
+}
+
+// Flags of the terms whose ID or name contains the query
+function matchTerms(terms, query) {
+  query = query.trim().toLowerCase();
+  if (!query) return null;
+  const flags = new Uint8Array(terms.ids.length);
+  for (let i = 0; i < flags.length; i++) {
+    flags[i] = terms.ids[i].toLowerCase().includes(query) || terms.names[i].toLowerCase().includes(query) ? 1 : 0;
+  }
+  return flags;
+}
+
+function readJSON(id) {
+  return JSON.parse(document.getElementById(id).textContent);
+}
+
+function startExplorer() {
+  const index = readJSON('explorer-index');
+  const settings = index.settings;
+  const plot = document.getElementById('plot');
+  const groups = index.groups.map((group, number) => ({name: group.name, points: group.points, number: number, data: null,
+                                                       active: false}));
+  const ontologies = index.ontologies.map(() => true);
+  const state = {points: combinePoints([]), selected: new Uint32Array(0), range: null, termMatch: null, pending: false};
+  const extent = index.extent;
+  const padX = (extent[1] - extent[0]) / 20 || 1, padY = (extent[3] - extent[2]) / 20 || 1;
+  const fullRange = [extent[0] - padX, extent[1] + padX, extent[2] - padY, extent[3] + padY];
+  document.getElementById('title').textContent = settings.title;
+
+  // The data of a group is only parsed the first time it is selected
+  function activate(group, active) {
+    if (active && !group.data) group.data = readJSON('group-' + group.number);
+    group.active = active;
+  }
+  let total = 0;
+  for (const group of groups) {
+    if (total === 0 || total + group.points <= settings.initial_points) {
+      activate(group, true);
+      total += group.points;
+    }
+  }
+
+  const groupList = document.getElementById('groups');
+  function showGroups() {
+    const query = document.getElementById('group-search').value.trim().toLowerCase();
+    const shown = groups.filter(group => group.name.toLowerCase().includes(query)).slice(0, 2000);
+    groupList.innerHTML = '';
+    for (const group of shown) {
+      const label = document.createElement('label');
+      const box = document.createElement('input');
+      box.type = 'checkbox';
+      box.checked = group.active;
+      box.addEventListener('change', () => { activate(group, box.checked); update(true); });
+      label.appendChild(box);
+      label.appendChild(document.createTextNode(' ' + group.name + ' (' + group.points + ')'));
+      label.style.color = PALETTE[group.number % PALETTE.length];
+      groupList.appendChild(label);
+    }
+    return shown;
+  }
+  document.getElementById('group-search').addEventListener('input', showGroups);
+  for (const [id, active] of [['groups-all', true], ['groups-none', false]]) {
+    document.getElementById(id).addEventListener('click', event => {
+      event.preventDefault();
+      const query = document.getElementById('group-search').value.trim().toLowerCase();
+      groups.filter(group => group.name.toLowerCase().includes(query)).forEach(group => activate(group, active));
+      showGroups();
+      update(true);
+    });
+  }
+
+  const ontologyList = document.getElementById('ontologies');
+  index.ontologies.forEach((ontology, number) => {
+    const label = document.createElement('label');
+    const box = document.createElement('input');
+    box.type = 'checkbox';
+    box.checked = true;
+    box.addEventListener('change', () => { ontologies[number] = box.checked; update(false); });
+    label.appendChild(box);
+    label.appendChild(document.createTextNode(' ' + ontology + ' '));
+    ontologyList.appendChild(label);
+  });
+
+  const minValue = document.getElementById('min-value');
+  minValue.max = Math.ceil(extent[5] * 10) / 10;
+  minValue.addEventListener('input', () => {
+    document.getElementById('min-value-label').textContent = minValue.value;
+    update(false);
+  });
+  let searchTimer = null;
+  document.getElementById('term-search').addEventListener('input', event => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => { state.termMatch = matchTerms(index.terms, event.target.value); update(false); }, 200);
+  });
+  document.getElementById('representatives').addEventListener('change', () => update(false));
+  document.getElementById('color').addEventListener('change', () => draw());
+  document.getElementById('mode').addEventListener('change', () => { state.range = null; draw(true); });
+
+  function update(regroup) {
+    if (regroup) state.points = combinePoints(groups.filter(group => group.active));
+    state.selected = filterPoints(state.points, ontologies, parseFloat(minValue.value),
+                                  document.getElementById('representatives').checked, state.termMatch);
+    draw();
+  }
+
+  function draw(newLayout) {
+    const points = state.points, mode = document.getElementById('mode').value, color = document.getElementById('color').value;
+    const shown = downsample(points, state.selected, mode === '2d' ? state.range : null, settings.max_points);
+    const n = shown.length;
+    const x = new Float32Array(n), y = new Float32Array(n), z = new Float32Array(n), sizes = new Float32Array(n);
+    const text = new Array(n), colors = new Array(n);
+    for (let k = 0; k < n; k++) {
+      const i = shown[k], group = groups[points.g[i]];
+      x[k] = points.x[i];
+      y[k] = points.y[i];
+      z[k] = points.v[i];
+      sizes[k] = Math.min(4 + 2 * Math.abs(points.s[i]), 16);
+      text[k] = group.name + ' · ' + group.data.files[points.f[i]] + '<br>' + index.terms.ids[points.t[i]] + ' ' +
+                index.terms.names[points.t[i]] + '<br>' + index.ontologies[points.o[i]] + ', p = ' +
+                Math.pow(10, -points.v[i]).toPrecision(3);
+      colors[k] = color === 'group' ? PALETTE[group.number % PALETTE.length] :
+                  color === 'ontology' ? settings.colors[index.ontologies[points.o[i]]] : points.v[i];
+    }
+    const marker = {size: sizes, color: colors, opacity: 0.7, line: {width: 0}};
+    if (color === 'value') Object.assign(marker, {colorscale: 'Viridis', showscale: true, colorbar: {title: {text: '-log10(p)'}}});
+    const trace = mode === '2d' ? {type: 'scattergl', mode: 'markers', x: x, y: y, text: text, hoverinfo: 'text', marker: marker}
+                                : {type: 'scatter3d', mode: 'markers', x: x, y: y, z: z, text: text, hoverinfo: 'text',
+                                   marker: Object.assign(marker, {size: Array.from(sizes, size => size / 2)})};
+    const range = state.range || fullRange;
+    const layout = {uirevision: mode, margin: {t: 30, l: 50, r: 10, b: 40}, hovermode: 'closest', plot_bgcolor: 'white',
+                    xaxis: {title: {text: 'Semantic Space X'}, range: [range[0], range[1]], gridcolor: '#eee', zeroline: false},
+                    yaxis: {title: {text: 'Semantic Space Y'}, range: [range[2], range[3]], gridcolor: '#eee', zeroline: false},
+                    scene: {xaxis: {title: {text: 'Semantic Space X'}}, yaxis: {title: {text: 'Semantic Space Y'}},
+                            zaxis: {title: {text: '-log10(p)'}}}};
+    Plotly.react(plot, [trace], layout, {responsive: true, displaylogo: false, scrollZoom: true});
+    document.getElementById('status').textContent = n + ' of ' + state.selected.length + ' filtered terms drawn (' + points.n +
+      ' terms in ' + groups.filter(group => group.active).length + ' of ' + groups.length + ' groups)';
+  }
+
+  showGroups();
+  update(true);
+  // Zooming and panning draw the points of the new view, once per animation frame
+  plot.on('plotly_relayout', event => {
+    if (document.getElementById('mode').value !== '2d') return;
+    if (event['xaxis.autorange'] || event['yaxis.autorange']) {
+      state.range = null;
+    } else if ('xaxis.range[0]' in event || 'yaxis.range[0]' in event) {
+      const range = state.range || fullRange;
+      state.range = [event['xaxis.range[0]'] ?? range[0], event['xaxis.range[1]'] ?? range[1],
+                     event['yaxis.range[0]'] ?? range[2], event['yaxis.range[1]'] ?? range[3]];
+    } else {
+      return;
+    }
+    if (!state.pending) {
+      state.pending = true;
+      requestAnimationFrame(() => { state.pending = false; draw(); });
+    }
+  });
+}
+
+if (typeof document !== 'undefined') document.addEventListener('DOMContentLoaded', startExplorer);
+</script>
+</body>
+</html>
+'''
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Save the interactive semantic space explorer of the enriched GO terms of an output folder')
+    parser.add_argument('output_folder', nargs='?', default=None, help='Output folder. By default, the one of params.json.')
+    parser.add_argument('--output', default=None, help=f'HTML file. By default, {EXPLORER_FILE} in the output folder.')
+    parser.add_argument('--standalone', action='store_true', help='Embed plotly.js, so the file can be opened alone')
+    parser.add_argument('--max-points', type=int, default=20000, help='Largest number of points drawn for a view. By default, 20000.')
+    args = parser.parse_args()
+
+    output_folder = args.output_folder
+    if output_folder is None:
+        with open('params.json', 'r') as file:
+            output_folder = json.load(file)['output_folder']
+    output_file = write_explorer(find_scatterplots(output_folder), args.output or os.path.join(output_folder, EXPLORER_FILE),
+                                 plotlyjs_folder=output_folder, standalone=args.standalone, max_points=args.max_points)
+    sys.exit(0 if output_file else 1)
@@ -0,0 +1,275 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import datetime
+import numpy as np
+import pandas as pd
+from permutation_test import benjamini_hochberg
+from results_store import STORE_FILE, open_store, plot_comparison, store_path, store_run
+from semantic_explorer import EXPLORER_FILE, scatterplot_files, write_explorer
+
+# Shards are written to output_folder/shards/shard-<K>-of-<N>
+SHARDS_FOLDER = 'shards'
+SHARD_PATTERN = re.compile(r'^shard-(\d+)-of-(\d+)$')
+MANIFEST_FILE = 'shard.json'
+# Files of a shard folder that describe the shard run itself, and are not copied by the merge
+SHARD_FILES = {'.pipeline_state.json', MANIFEST_FILE, STORE_FILE, f'{STORE_FILE}-wal', f'{STORE_FILE}-shm',
+               'profile_summary.json', 'profile_trace.json', EXPLORER_FILE}
+# Ontologies of the GO vocabulary, corrected together as one family
+GO_ONTOLOGIES = ['BP', 'MF', 'CC']
+
+
+def parse_shard(text):
+    '''
+    Function to parse a shard given as K/N (the K-th of N shards, counting from 1).
+
+    Returns:
+    - shard: Tuple (K, N)
+    '''
+    match = re.fullmatch(r'(\d+)/(\d+)', text.strip())
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f"Invalid shard {text}, expected K/N with 1 <= K <= N (e.g. 3/16)")
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_of(group, n_shards):
+    '''
+    Function to assign a group to a shard. The shard only depends on the group name, so every node computes
+    the same split, and adding or removing groups does not move the other groups to another shard.
+
+    Args:
+    - group: Name of the group
+    - n_shards: Number of shards
+
+    Returns:
+    - shard: Shard of the group, from 1 to n_shards
+    '''
+    return int(hashlib.sha256(group.encode()).hexdigest()[:16], 16) % n_shards + 1
+
+
+def select_shard(grouped_files, ranked_files, shard, n_shards):
+    '''
+    Function to keep the candidates and ranked files of the groups of a shard.
+
+    Args:
+    - grouped_files: Dictionary as returned by enrichment.select_files
+    - ranked_files: Dictionary as returned by enrichment.select_ranked_files
+    - shard: Shard to keep, from 1 to n_shards
+    - n_shards: Number of shards
+
+    Returns:
+    - grouped_files: Dictionary with the groups of the shard
+    - ranked_files: Dictionary with the ranked files of the groups of the shard
+    '''
+    return ({group: files for group, files in grouped_files.items() if shard_of(group, n_shards) == shard},
+            {group: files for group, files in ranked_files.items() if shard_of(group, n_shards) == shard})
+
+
+def shard_folder(output_folder, shard, n_shards):
+    return os.path.join(output_folder, SHARDS_FOLDER, f'shard-{shard}-of-{n_shards}')
+
+
+def shard_parameters(parameters, shard, n_shards):
+    '''
+    Function to get the parameters of a shard run: its output folder is the shard folder, which has its own
+    task state and results store, and the background cache is only read, so many nodes can share it.
+    '''
+    return dict(parameters, output_folder=shard_folder(parameters['output_folder'], shard, n_shards),
+                results_store=None, cache_read_only=True)
+
+
+def write_shard_manifest(folder, shard, n_shards, groups, status=None):
+    '''
+    Function to write the shard.json file of a shard folder, with its groups and the status of its tasks.
+    The shard is complete when every task is done or up to date, so a shard that failed or was interrupted
+    (written before its tasks run, with no status) is found by merge_shards and can be run again.
+
+    Args:
+    - folder: Shard folder
+    - shard: Shard number
+    - n_shards: Number of shards
+    - groups: List of the groups of the shard
+    - status: Dictionary with the status of every task, as returned by pipeline.run_tasks. By default, None
+      (the shard is running).
+    '''
+    os.makedirs(folder, exist_ok=True)
+    manifest = {'shard': shard, 'shards': n_shards, 'groups': sorted(groups),
+                'updated': datetime.datetime.now().isoformat(timespec='seconds'),
+                'complete': status is not None and all(value in ('done', 'skipped') for value in status.values()),
+                'failed': sorted(name for name, value in (status or {}).items() if value not in ('done', 'skipped'))}
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def find_shards(output_folder, n_shards=None):
+    '''
+    Function to find the shard folders of an output folder.
+
+    Args:
+    - output_folder: Output folder of the analysis
+    - n_shards: Number of shards. By default, the number of the shard folders found, which must be unique.
+
+    Returns:
+    - n_shards: Number of shards
+    - manifests: Dictionary with the shard numbers as keys and the content of their shard.json (None if
+      missing) as values
+    '''
+    root = os.path.join(output_folder, SHARDS_FOLDER)
+    found = {}
+    for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        match = SHARD_PATTERN.match(name)
+        if match:
+            found.setdefault(int(match.group(2)), []).append(int(match.group(1)))
+    if n_shards is None:
+        if len(found) != 1:
+            raise ValueError(f"Expected the shards of one run in {root}, found runs of {sorted(found) or 'no'} shards")
+        n_shards = next(iter(found))
+
+    manifests = {}
+    for shard in range(1, n_shards + 1):
+        manifest_path = os.path.join(shard_folder(output_folder, shard, n_shards), MANIFEST_FILE)
+        manifests[shard] = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                manifests[shard] = json.load(file)
+    return n_shards, manifests
+
+
+def link_or_copy(source, destination):
+    # Hard links avoid copying the plots, the files rewritten by the merge are replaced instead of modified
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+    return destination
+
+
+def shard_groups(folder):
+    '''
+    Function to read the files of the latest run of a shard from its results store.
+
+    Returns:
+    - groups: DataFrame with the name, source, kind, annotation, results_file and tests of every file
+    '''
+    connection = open_store(os.path.join(folder, STORE_FILE))
+    try:
+        return pd.read_sql_query('''SELECT name, source, kind, annotation, results_file, tests FROM groups
+                                    WHERE run_id = (SELECT MAX(run_id) FROM runs WHERE output_folder = ?)
+                                    ORDER BY group_id''', connection, params=[os.path.abspath(folder)])
+    finally:
+        connection.close()
+
+
+def global_qvalues(results_files, tests):
+    '''
+    Function to correct the p-values of many results files together, with the Benjamini-Hochberg method
+    over all the tests of all the files. The GO ontologies are one family, and each other vocabulary
+    (e.g. KEGG_Pathway) is a family of its own. Only the terms below the p-value cutoff are in the
+    results files, so the total number of tests of each family is given: the q-values are exact when they are
+    below the cutoff, and an upper bound otherwise.
+
+    Args:
+    - results_files: List of results files, as written by go_enrichment.write_results
+    - tests: Dictionary with the families as keys and their number of tests as values
+
+    Returns:
+    - qvalues: List with an array of q-values for every results file, in the order of its rows
+    '''
+    tables = [pd.read_csv(results_file, sep='\t', usecols=['Ontology', 'Pvalue'], keep_default_na=False)
+              for results_file in results_files]
+    pvalues = np.concatenate([table['Pvalue'].to_numpy(dtype=float) for table in tables]) if tables else np.zeros(0)
+    families = np.concatenate([table['Ontology'].map(lambda ontology: 'GO' if ontology in GO_ONTOLOGIES else ontology).to_numpy(dtype=str)
+                               for table in tables]) if tables else np.zeros(0, dtype=str)
+    qvalues = np.ones(len(pvalues))
+    for family in np.unique(families):
+        selected = families == family
+        qvalues[selected] = benjamini_hochberg(pvalues[selected], tests.get(family, 0))
+    bounds = np.cumsum([0] + [len(table) for table in tables])
+    return [qvalues[bounds[i]:bounds[i + 1]] for i in range(len(tables))]
+
+
+def merge_shards(parameters, n_shards=None):
+    '''
+    Function to merge the shards of an analysis into the output folder, as if every group had been analysed
+    in one run: the files of every shard are linked (or copied) into the output folder, a GlobalQvalue
+    column with the false discovery rate over all the groups is added to every results file (see
+    global_qvalues), the merged results are added to the results store of the output folder, and a heatmap
+    comparing the groups is saved for every ontology in output_folder/combined_plots, with the semantic space
+    explorer of all the groups (see semantic_explorer.write_explorer).
+
+    Args:
+    - parameters: Dictionary with the parameters of params.json
+    - n_shards: Number of shards. By default, it is found from the shard folders.
+
+    Returns:
+    - summary: Dictionary with the number of 'shards', 'files' and 'tests' of each family, and the paths of
+      the combined 'plots' and explorer
+    '''
+    output_folder = parameters['output_folder']
+    n_shards, manifests = find_shards(output_folder, n_shards)
+    incomplete = [shard for shard, manifest in manifests.items() if not manifest or not manifest['complete']]
+    if incomplete:
+        raise RuntimeError(f"Shards {', '.join(map(str, incomplete))} of {n_shards} are missing or did not finish. "
+                           f"Run them again with: python3 src/main.py --shard K/{n_shards}")
+
+    groups = []
+    for shard in manifests:
+        folder = shard_folder(output_folder, shard, n_shards)
+        print(f"Merging shard {shard} of {n_shards} ({len(manifests[shard]['groups'])} groups)...")
+        for name in os.listdir(folder):
+            if name in SHARD_FILES:
+                continue
+            source, destination = os.path.join(folder, name), os.path.join(output_folder, name)
+            if os.path.isdir(source):
+                shutil.copytree(source, destination, copy_function=link_or_copy, dirs_exist_ok=True)
+            else:
+                link_or_copy(source, destination)
+        if manifests[shard]['groups']:
+            for row in shard_groups(folder).itertuples(index=False):
+                # Paths of the merged files, at the same place relative to the output folder as in the shard folder
+                results_file = os.path.join(output_folder, os.path.relpath(os.path.abspath(row.results_file), os.path.abspath(folder))) \
+                    if isinstance(row.results_file, str) else None
+                groups.append((row.name, row.source, row.kind, results_file, row.annotation,
+                               json.loads(row.tests) if isinstance(row.tests, str) else {}))
+
+    tests = {}
+    for *_, file_tests in groups:
+        for ontology, count in file_tests.items():
+            family = 'GO' if ontology in GO_ONTOLOGIES else ontology
+            tests[family] = tests.get(family, 0) + count
+    results_files = [results_file for _, _, _, results_file, _, _ in groups if results_file]
+    for results_file, qvalues in zip(results_files, global_qvalues(results_files, tests)):
+        # The file is read as text and replaced, so the other columns keep their format and the shard copy is kept
+        results = pd.read_csv(results_file, sep='\t', dtype=str, keep_default_na=False)
+        results['GlobalQvalue'] = ['%.15g' % value for value in qvalues]
+        tmp_path = f"{results_file}.{os.getpid()}.tmp"
+        results.to_csv(tmp_path, sep='\t', index=False)
+        os.replace(tmp_path, results_file)
+
+    store_file = store_path(parameters)
+    stored = [(group, source, kind, results_file[:-len('.txt')] + '_IDs_Pvalues.txt' if results_file else None, annotation, file_tests)
+              for group, source, kind, results_file, annotation, file_tests in groups]
+    store_run(store_file, output_folder, dict(parameters, shards=n_shards), stored)
+
+    plots = []
+    for family in sorted(tests):
+        for ontology in GO_ONTOLOGIES if family == 'GO' else [family]:
+            plot_file = plot_comparison(store_file, os.path.join(output_folder, 'combined_plots', f'{ontology}_comparison.html'),
+                                        ontology, plotlyjs_folder=output_folder)
+            if plot_file is not None:
+                plots.append(plot_file)
+    if parameters.get('explorer', True):
+        explorer_file = write_explorer(scatterplot_files([(group, ids_file) for group, _, _, ids_file, _, _ in stored if ids_file]),
+                                       os.path.join(output_folder, EXPLORER_FILE), plotlyjs_folder=output_folder,
+                                       max_points=parameters.get('explorer_max_points', 20000))
+        if explorer_file is not None:
+            plots.append(explorer_file)
+    print(f"Merged {n_shards} shards: {len(groups)} files, {', '.join(f'{count} {family} tests' for family, count in tests.items()) or 'no tests'}")
+    return {'shards': n_shards, 'files': len(groups), 'tests': tests, 'plots': plots}
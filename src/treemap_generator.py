@@ -0,0 +1,239 @@
+import os
+import textwrap
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+from matplotlib.collections import PatchCollection
+from matplotlib import colormaps
+import plotly.graph_objs as go
+import plotly.io as pio
+from barplot_generator import plotlyjs_reference
+
+# Size of the static treemaps in inches, as in the REVIGO R script
+TREEMAP_SIZE = (16, 9)
+# Font sizes of the group (representative) and term labels, as in the R script rewritten by process_file
+GROUP_FONTSIZE = 12
+TERM_FONTSIZE = 15
+# Labels are shrunk to fit their rectangle and omitted below this size
+MIN_FONTSIZE = 3
+
+
+def worst_ratio(row, side):
+    '''
+    Function to compute the worst aspect ratio of a row of areas laid out along a side of the given length.
+    '''
+    total = sum(row)
+    return max(max(row) * side * side / (total * total), total * total / (side * side * min(row)))
+
+
+def squarify(values, x, y, width, height):
+    '''
+    Function to compute a squarified treemap layout (Bruls, Huizing and van Wijk, 2000): rectangles are
+    added to a row along the shorter side of the remaining space while that improves the worst aspect ratio
+    of the row, so that the rectangles stay close to squares.
+
+    Args:
+    - values: Sizes of the rectangles
+    - x, y, width, height: Rectangle to fill
+
+    Returns:
+    - rects: Array of shape (len(values), 4) with the x, y, width and height of each rectangle, in the order
+      of values. Rectangles of non-positive values have no area.
+    '''
+    values = np.asarray(values, dtype=float)
+    rects = np.zeros((len(values), 4))
+    order = [i for i in np.argsort(-values, kind='stable') if values[i] > 0]
+    if not order or width <= 0 or height <= 0:
+        return rects
+    areas = values[order] * width * height / values[order].sum()
+
+    start = 0
+    while start < len(order):
+        side = min(width, height)
+        end = start + 1
+        while end < len(order) and worst_ratio(areas[start:end + 1], side) <= worst_ratio(areas[start:end], side):
+            end += 1
+        row = areas[start:end]
+        thickness = row.sum() / side
+        offset = 0
+        for i, area in zip(order[start:end], row):
+            length = area / thickness
+            if width >= height:
+                rects[i] = (x, y + offset, thickness, length)
+            else:
+                rects[i] = (x + offset, y, length, thickness)
+            offset += length
+        if width >= height:
+            x, width = x + thickness, width - thickness
+        else:
+            y, height = y + thickness, height - thickness
+        start = end
+    return rects
+
+
+def read_treemap(treemap_path):
+    '''
+    Function to read a REVIGO _TreeMap.tsv file.
+
+    Args:
+    - treemap_path: Path to the _TreeMap.tsv file
+
+    Returns:
+    - data: DataFrame with the 'TermID', 'Name' and 'Value' (absolute value) of each term and its 'Group',
+      the name of its representative term (the term itself for representatives)
+    '''
+    with open(treemap_path, 'r', encoding='utf-8') as file:
+        skip = 0
+        for line in file:
+            if not line.startswith('#'):
+                break
+            skip += 1
+    data = pd.read_csv(treemap_path, sep='\t', skiprows=skip, na_values=['null'], keep_default_na=False)
+    data['Value'] = data['Value'].abs()
+    data['Group'] = data['Representative'].fillna(data['Name'])
+    return data[['TermID', 'Name', 'Value', 'Group']]
+
+
+def treemap_layout(data, width, height):
+    '''
+    Function to lay out the terms of a treemap in two levels: the groups of each representative term get an
+    area proportional to the sum of the values of their terms, and the terms of each group are laid out
+    inside it with an area proportional to their value.
+
+    Args:
+    - data: DataFrame as returned by read_treemap
+    - width, height: Size of the treemap
+
+    Returns:
+    - groups: DataFrame with the 'Group' name, its 'Value' and its rectangle ('x', 'y', 'width', 'height')
+    - terms: data with the rectangle of each term and the 'GroupIndex' of its group
+    '''
+    groups = data.groupby('Group', sort=False)['Value'].sum().reset_index()
+    groups[['x', 'y', 'width', 'height']] = squarify(groups['Value'], 0, 0, width, height)
+
+    terms = data.copy()
+    terms['GroupIndex'] = pd.Index(groups['Group']).get_indexer(terms['Group'])
+    rects = np.zeros((len(terms), 4))
+    for index, group in groups.iterrows():
+        members = np.flatnonzero(terms['GroupIndex'].to_numpy() == index)
+        rects[members] = squarify(terms['Value'].to_numpy()[members], group['x'], group['y'], group['width'], group['height'])
+    terms[['x', 'y', 'width', 'height']] = rects
+    return groups, terms
+
+
+def fit_label(text, width, height, fontsize):
+    '''
+    Function to wrap a label and shrink its font so that it fits in a rectangle given in inches.
+
+    Returns:
+    - label: Wrapped label
+    - fontsize: Font size in points, or 0 if the label does not fit at MIN_FONTSIZE
+    '''
+    while fontsize >= MIN_FONTSIZE:
+        # Approximate width of a character and height of a line, in inches
+        chars = max(int(width * 72 / (0.55 * fontsize)), 1)
+        lines = textwrap.wrap(text, chars, break_long_words=False) or ['']
+        if max(len(line) for line in lines) <= chars and len(lines) * fontsize * 1.2 <= height * 72:
+            return '\n'.join(lines), fontsize
+        fontsize -= 1
+    return text, 0
+
+
+def create_static_treemap(groups, terms, title, filenames):
+    '''
+    Function to draw a treemap with matplotlib, in the style of the REVIGO R treemaps: one color per group,
+    term labels centered in their rectangles and group labels at the top left corner of their group.
+
+    Args:
+    - groups, terms: DataFrames as returned by treemap_layout, in inches
+    - title: Title of the plot
+    - filenames: Paths of the files to save (e.g. a PDF and a PNG)
+    '''
+    fig = Figure(figsize=TREEMAP_SIZE)
+    width, height = TREEMAP_SIZE[0], TREEMAP_SIZE[1] * 0.94
+    ax = fig.add_axes([0, 0, 1, 0.94])
+    ax.set_xlim(0, width)
+    ax.set_ylim(height, 0)
+    ax.axis('off')
+    fig.suptitle(title, fontsize=16, y=0.985)
+
+    palette = colormaps['tab20'].colors
+    colors = [palette[index % len(palette)] for index in terms['GroupIndex']]
+    ax.add_collection(PatchCollection([Rectangle((x, y), w, h) for x, y, w, h in terms[['x', 'y', 'width', 'height']].to_numpy()],
+                                      facecolors=colors, edgecolors='white', linewidths=0.5))
+    ax.add_collection(PatchCollection([Rectangle((x, y), w, h) for x, y, w, h in groups[['x', 'y', 'width', 'height']].to_numpy()],
+                                      facecolors='none', edgecolors='white', linewidths=2))
+
+    for term in terms.itertuples():
+        label, fontsize = fit_label(term.Name, term.width, term.height, TERM_FONTSIZE)
+        if fontsize:
+            ax.text(term.x + term.width / 2, term.y + term.height / 2, label, ha='center', va='center', fontsize=fontsize)
+    for group in groups.itertuples():
+        label, fontsize = fit_label(group.Group, group.width, group.height, GROUP_FONTSIZE)
+        if fontsize:
+            ax.text(group.x + 0.02, group.y + 0.02, label, ha='left', va='top', fontsize=fontsize,
+                    bbox=dict(facecolor='#CCCCCC', alpha=0.67, edgecolor='none', pad=1))
+
+    for filename in filenames:
+        fig.savefig(filename)
+
+
+def create_interactive_treemap(data, title, filename, plotlyjs_folder=None):
+    '''
+    Function to save an interactive treemap with plotly, where each group can be expanded to show its terms.
+
+    Args:
+    - data: DataFrame as returned by read_treemap
+    - title: Title of the plot
+    - filename: Path to the HTML file
+    - plotlyjs_folder: Folder of the shared plotly.js bundle. By default, the folder of the HTML file.
+    '''
+    groups = data.groupby('Group', sort=False)['Value'].sum()
+    fig = go.Figure(go.Treemap(
+        ids=[f'group:{group}' for group in groups.index] + data['TermID'].tolist(),
+        labels=groups.index.tolist() + data['Name'].tolist(),
+        parents=[''] * len(groups) + [f'group:{group}' for group in data['Group']],
+        values=groups.tolist() + data['Value'].tolist(),
+        customdata=[''] * len(groups) + data['TermID'].tolist(),
+        branchvalues='total',
+        maxdepth=2,
+        hovertemplate='<b>%{label}</b><br>%{customdata}<br>Value: %{value:.2f}<extra></extra>'
+    ))
+    fig.update_layout(title_text=title, margin=dict(t=50, l=10, r=10, b=10))
+    pio.write_html(fig, file=filename, include_plotlyjs=plotlyjs_reference(filename, plotlyjs_folder))
+
+
+def create_treemap(treemap_path, title, filename, html_file=None, plotlyjs_folder=None, render_png=True, render_html=True):
+    '''
+    Function to create the treemaps of a REVIGO _TreeMap.tsv file: a static treemap saved as PDF and PNG,
+    and optionally an interactive HTML treemap.
+
+    Args:
+    - treemap_path: Path to the _TreeMap.tsv file
+    - title: Title of the plots
+    - filename: Path to the PDF file, the PNG file has the same name with the .png extension
+    - html_file: Path to the interactive treemap. By default, it is not created.
+    - plotlyjs_folder: Folder of the shared plotly.js bundle. By default, the folder of the HTML file.
+    - render_png: Whether to render the static (PDF and PNG) treemaps. By default, True.
+    - render_html: Whether to render the interactive treemap. By default, True.
+
+    Returns:
+    - outputs: List of paths of the files written
+    '''
+    data = read_treemap(treemap_path)
+    if data.empty:
+        print(f"No terms to plot in {treemap_path}")
+        return []
+
+    outputs = []
+    if render_png:
+        filenames = [filename, os.path.splitext(filename)[0] + '.png']
+        groups, terms = treemap_layout(data, TREEMAP_SIZE[0], TREEMAP_SIZE[1] * 0.94)
+        create_static_treemap(groups, terms, title, filenames)
+        outputs += filenames
+    if render_html and html_file:
+        os.makedirs(os.path.dirname(html_file), exist_ok=True)
+        create_interactive_treemap(data, title, html_file, plotlyjs_folder)
+        outputs.append(html_file)
+    return outputs
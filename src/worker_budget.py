@@ -0,0 +1,84 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# Number of free slots of the budget of the running pipeline, None outside of a pipeline run
+_BUDGET = {'lock': threading.Lock(), 'free': None}
+
+
+def start_budget(workers):
+    '''
+    Function to start the budget of processes shared by the tasks of a pipeline run (see pipeline.run_tasks).
+    Every running task takes one slot (see task_slot), and the process pools started by the tasks, such as the
+    parser of the annotation files and the permutations, borrow the free slots (see pool_workers), so the
+    whole run uses about workers processes.
+
+    Args:
+    - workers: Number of slots of the budget
+    '''
+    with _BUDGET['lock']:
+        _BUDGET['free'] = workers
+
+
+def stop_budget():
+    '''
+    Function to end the budget of a pipeline run, so that the pools started afterwards use their own number of processes.
+    '''
+    with _BUDGET['lock']:
+        _BUDGET['free'] = None
+
+
+def _change(count):
+    with _BUDGET['lock']:
+        if _BUDGET['free'] is not None:
+            _BUDGET['free'] += count
+
+
+@contextmanager
+def task_slot():
+    '''
+    Function to take a slot of the budget while a task runs.
+    '''
+    _change(-1)
+    try:
+        yield
+    finally:
+        _change(1)
+
+
+@contextmanager
+def idle_slot():
+    '''
+    Function to give the slot of a task back to the budget while it waits for another one (e.g. for a
+    background loaded by another task), so that the pools of the other tasks can use it.
+    '''
+    _change(1)
+    try:
+        yield
+    finally:
+        _change(-1)
+
+
+@contextmanager
+def pool_workers(workers=None):
+    '''
+    Function to get the number of processes of a pool started by a task. Outside of a pipeline run, it is
+    workers. In a pipeline run, it is the slot of the task plus the free slots of the budget, up to workers,
+    and the borrowed slots are given back when the pool is closed.
+
+    Args:
+    - workers: Maximum number of processes. By default, the number of CPUs.
+
+    Yields:
+    - workers: Number of processes of the pool, at least 1
+    '''
+    workers = max(workers or os.cpu_count() or 1, 1)
+    with _BUDGET['lock']:
+        borrowed = 0 if _BUDGET['free'] is None else min(max(_BUDGET['free'], 0), workers - 1)
+        if _BUDGET['free'] is not None:
+            _BUDGET['free'] -= borrowed
+            workers = borrowed + 1
+    try:
+        yield workers
+    finally:
+        _change(borrowed)
@@ -0,0 +1,44 @@
+import os
+import sys
+import pytest
+
+TESTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_FOLDER, '..', 'src'))
+sys.path.insert(0, os.path.join(TESTS_FOLDER, '..', 'benchmarks'))
+
+from synthetic_data import generate_dataset
+from background_cache import load_background
+from go_ontology import load_go_ontology
+from go_enrichment import read_ids
+
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+    '''
+    Small synthetic dataset (see benchmarks/synthetic_data.py) shared by the tests, with the ontology, the
+    background and the candidates and universe IDs of every group already loaded.
+    '''
+    folder = tmp_path_factory.mktemp('dataset')
+    dataset = generate_dataset(str(folder), n_transcripts=3000, n_terms=150, n_groups=3, candidate_fraction=0.05, seed=7)
+    dataset['terms'], dataset['alt_ids'] = load_go_ontology(dataset['obo'])
+    dataset['background'] = load_background(dataset['annotation'], str(folder / 'cache'))
+    dataset['groups'] = [(read_ids(candidates), read_ids(universe))
+                         for candidates, universe in zip(dataset['candidates'], dataset['universe'])]
+    return dataset
+
+
+@pytest.fixture
+def project(dataset, tmp_path, monkeypatch):
+    '''
+    Working folder with the data folder layout of the pipeline (see enrichment.select_files), filled with
+    the dataset, and the parameters of a small local run. Groups 0 and 1 share their universe, so they are
+    tested in the same batch.
+    '''
+    import shutil
+    folder = os.path.dirname(dataset['obo'])
+    for name in ['ontology', 'annotation', 'candidates', 'universe']:
+        shutil.copytree(os.path.join(folder, '..', name), tmp_path / 'data' / name)
+    shutil.copy(tmp_path / 'data' / 'universe' / 'group000.universe.txt', tmp_path / 'data' / 'universe' / 'group001.universe.txt')
+    monkeypatch.chdir(tmp_path)
+    return {'pvalue_cutoff': 0.05, 'category_size': 2, 'output_folder': 'out', 'go_obo': 'data/ontology/go-basic.obo',
+            'revigo': 'local', 'workers': 2}
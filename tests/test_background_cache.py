@@ -0,0 +1,117 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+import background_cache
+from background_cache import write_arrays, read_arrays, load_background, lookup_ids
+
+HEADER = '#query\tseed_ortholog\tGOs\n'
+
+
+def write_annotation(path, lines):
+    with open(path, 'w') as file:
+        file.write(HEADER + ''.join(f'{transcript}\ts\t{terms}\n' for transcript, terms in lines))
+    return str(path)
+
+
+def entries(cache_folder):
+    return sorted(name for name in os.listdir(cache_folder) if name.endswith('.bgc'))
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    # Counts the cache entries built, i.e. the misses
+    calls = []
+    build_background = background_cache.build_background
+    monkeypatch.setattr(background_cache, 'build_background', lambda *args: calls.append(args[0]) or build_background(*args))
+    return calls
+
+
+def test_arrays_round_trip(tmp_path):
+    arrays = {'ids': np.array([b'a', b'bcd']), 'values': np.arange(1000, dtype=np.int64).reshape(10, 100),
+              'empty': np.zeros(0, dtype=np.int32), 'flags': np.array([True, False])}
+    write_arrays(str(tmp_path / 'a.bgc'), arrays)
+    found = read_arrays(str(tmp_path / 'a.bgc'))
+    assert list(found) == list(arrays)
+    for name, array in arrays.items():
+        assert found[name].dtype == array.dtype
+        np.testing.assert_array_equal(found[name], array)
+
+
+def test_background_matches_the_file(dataset, tmp_path):
+    expected = {}
+    with open(dataset['annotation'], 'r') as file:
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if not line.startswith('#') and fields[9] != '-':
+                expected[fields[0].encode()] = set(term.encode() for term in fields[9].split(','))
+    background = load_background(dataset['annotation'], str(tmp_path))
+    assert list(background['transcripts']) == sorted(expected)
+    for transcript, start, end in zip(background['transcripts'], background['indptr'][:-1], background['indptr'][1:]):
+        assert set(background['terms'][background['indices'][start:end]]) == expected[transcript]
+
+
+def test_cache_hit_and_invalidation(tmp_path, builds):
+    cache_folder = str(tmp_path / 'cache')
+    annotation = write_annotation(tmp_path / 'a.emapper.annotations', [('t1', 'GO:0000001'), ('t2', 'GO:0000002')])
+    load_background(annotation, cache_folder)
+    first = entries(cache_folder)
+    load_background(annotation, cache_folder)
+    assert len(builds) == 1 and len(first) == 1
+
+    # The same content with a new modification time is hashed again, and still found
+    os.utime(annotation, ns=(0, 0))
+    load_background(annotation, cache_folder)
+    assert len(builds) == 1 and entries(cache_folder) == first
+
+    # A new content is a new entry, and the entry of the previous content is evicted
+    write_annotation(annotation, [('t1', 'GO:0000001'), ('t3', 'GO:0000003')])
+    background = load_background(annotation, cache_folder)
+    assert len(builds) == 2
+    assert list(background['transcripts']) == [b't1', b't3']
+    assert len(entries(cache_folder)) == 1 and entries(cache_folder) != first
+    with open(os.path.join(cache_folder, 'manifest.json'), 'r') as file:
+        sources = json.load(file)['sources']
+    assert list(sources) == [os.path.abspath(annotation)]
+    assert sources[os.path.abspath(annotation)]['digest'] + '.bgc' == entries(cache_folder)[0]
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, builds):
+    cache_folder = str(tmp_path / 'cache')
+    annotations = [write_annotation(tmp_path / f'{i}.emapper.annotations', [(f't{i}', 'GO:0000001')]) for i in range(3)]
+    names = []
+    for i, annotation in enumerate(annotations[:2]):
+        load_background(annotation, cache_folder, max_entries=2)
+        names.append((set(entries(cache_folder)) - set(names)).pop())
+        # Entries are used in order, the first one a long time ago
+        os.utime(os.path.join(cache_folder, names[-1]), (1000 * (i + 1), 1000 * (i + 1)))
+    load_background(annotations[2], cache_folder, max_entries=2)
+    assert len(entries(cache_folder)) == 2 and names[0] not in entries(cache_folder)
+
+    load_background(annotations[1], cache_folder, max_entries=2)
+    assert len(builds) == 3
+    load_background(annotations[0], cache_folder, max_entries=2)
+    assert len(builds) == 4
+
+
+def test_read_only_cache(tmp_path, builds):
+    cache_folder = str(tmp_path / 'cache')
+    annotation = write_annotation(tmp_path / 'a.emapper.annotations', [('t1', 'GO:0000001')])
+    load_background(annotation, cache_folder, read_only=True)
+    load_background(annotation, cache_folder, read_only=True)
+    assert len(builds) == 1 and len(entries(cache_folder)) == 1
+    assert not os.path.exists(os.path.join(cache_folder, 'manifest.json'))
+
+
+def test_missing_annotations(tmp_path):
+    annotation = write_annotation(tmp_path / 'a.emapper.annotations', [('t1', '-')])
+    with pytest.raises(ValueError):
+        load_background(annotation, str(tmp_path / 'cache'))
+
+
+def test_lookup_ids():
+    sorted_ids = np.array([b'a', b'c', b'e'])
+    np.testing.assert_array_equal(lookup_ids(sorted_ids, ['e', 'b', 'a', 'z']), [2, -1, 0, -1])
+    np.testing.assert_array_equal(lookup_ids(np.zeros(0, dtype=bytes), ['a']), [-1])
@@ -0,0 +1,30 @@
+import os
+
+from barplot_generator import plot_job, render_jobs, render_deferred, DEFERRED_FILE
+
+
+def write_scatterplot(path):
+    with open(path, 'w') as file:
+        file.write('TermID\tName\tValue\tLogSize\tFrequency\tUniqueness\tDispensability\tPC_0\tPC_1\tRepresentative\n'
+                   '"GO:0000001"\t"term 1"\t-3\t1.5\t0.1\t1\t0\t0.5\t-0.5\tnull\n'
+                   '"GO:0000002"\t"term 2"\t-2\t1.0\t0.1\t1\t0\t-0.5\t0.5\tnull\n')
+    return str(path)
+
+
+def test_deferred_plots_are_rendered_once(tmp_path):
+    jobs = []
+    for group in ['a', 'b']:
+        folder = tmp_path / group / 'results_revigo'
+        folder.mkdir(parents=True)
+        jobs.append((folder, [plot_job('scatter', scatterplot_path=write_scatterplot(folder / 'scatterPlot.tsv'), title=group,
+                                       filename=str(folder / 'obtained_graphics' / 'scatterplot.png'))]))
+    for folder, group_jobs in jobs:
+        outputs = render_jobs(group_jobs, workers=1, deferred_file=str(folder / DEFERRED_FILE))
+        assert outputs == [str(folder / DEFERRED_FILE)]
+        assert not os.path.exists(folder / 'obtained_graphics' / 'scatterplot.png')
+
+    outputs = render_deferred(str(tmp_path), workers=1)
+    assert sorted(outputs) == sorted(str(folder / 'obtained_graphics' / 'scatterplot.png') for folder, _ in jobs)
+    assert all(os.path.exists(path) for path in outputs)
+    assert not any(os.path.exists(folder / DEFERRED_FILE) for folder, _ in jobs)
+    assert render_deferred(str(tmp_path), workers=1) == []
@@ -0,0 +1,121 @@
+import os
+import gzip
+import shutil
+
+import numpy as np
+import pytest
+from scipy.stats import hypergeom
+
+from background_cache import load_background
+from eggnog_to_gsc import find_columns, process_eggnog, byte_ranges, split_terms
+from go_enrichment import build_vocabulary_index, enrich_batch
+
+HEADER = '#query\tseed_ortholog\tevalue\tscore\tPFAMs\tGO_terms\tKEGG_Pathway\n'
+LINES = ('t1\ts1\t1e-30\t100\tPF00001\tGO:0000001,GO:0000002\tko00010,map00010\n'
+         't2\ts2\t1e-30\t100\t-\t-\tmap00020\n'
+         't3\ts3\t1e-30\t100\tPF00002,PF00003\tGO:0000003\t-\n')
+
+
+def write_file(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+    return str(path)
+
+
+def read_lines(path):
+    with open(path, 'r') as file:
+        return file.read().splitlines()
+
+
+def test_columns_from_the_header(tmp_path):
+    annotation = write_file(tmp_path / 'a.emapper.annotations', '## emapper\n' + HEADER + LINES)
+    assert find_columns(annotation) == {'GO': 5, 'KEGG_Pathway': 6, 'PFAMs': 4}
+
+    output = str(tmp_path / 'background.txt')
+    assert process_eggnog(annotation, output, workers=1)['rows'] == 3
+    lines = read_lines(output)
+    assert 'GO:0000001\tIEA\tt1\tGO' in lines
+    assert 'GO:0000003\tIEA\tt3\tGO' in lines
+    assert 'PF00003\tIEA\tt3\tPFAMs' in lines
+    assert not any('\tt2\tGO' in line for line in lines)
+
+
+def test_kegg_ids_are_normalized():
+    assert split_terms('KEGG_ko', b'ko:K00001,K00002') == [b'K00001', b'K00002']
+    assert split_terms('KEGG_Pathway', b'ko00010,map00010,map00020') == [b'map00010', b'map00010', b'map00020']
+    assert split_terms('GO', b'GO:0000001, GO:0000002') == [b'GO:0000001', b'GO:0000002']
+
+
+def test_vocabulary_backgrounds(tmp_path):
+    # Older eggNOG-mapper versions write KEGG IDs with a 'ko:' prefix and KEGG pathways twice
+    annotation = write_file(tmp_path / 'a.emapper.annotations', '#query\tseed_ortholog\tGOs\tKEGG_ko\tKEGG_Pathway\n'
+                            't1\ts1\tGO:0000001\tko:K00001\tko00010,map00010\n'
+                            't2\ts2\t-\tK00001\tmap00010,map00020\n'
+                            't3\ts3\t-\tko:K00002\tko00020\n'
+                            't4\ts4\t-\t-\tmap00010\n'
+                            't5\ts5\tGO:0000001\t-\t-\n')
+    cache_folder = str(tmp_path / 'cache')
+    expected = {'GO': {b't1': [b'GO:0000001'], b't5': [b'GO:0000001']},
+                'KEGG_ko': {b't1': [b'K00001'], b't2': [b'K00001'], b't3': [b'K00002']},
+                'KEGG_Pathway': {b't1': [b'map00010'], b't2': [b'map00010', b'map00020'], b't3': [b'map00020'], b't4': [b'map00010']}}
+    for vocabulary, annotations in expected.items():
+        background = load_background(annotation, cache_folder, vocabulary=vocabulary)
+        found = {transcript: list(background['terms'][background['indices'][start:end]])
+                 for transcript, start, end in zip(background['transcripts'], background['indptr'][:-1], background['indptr'][1:])}
+        assert found == annotations
+    # Every vocabulary comes from the same cache entry
+    assert len([name for name in os.listdir(cache_folder) if name.endswith('.bgc')]) == 1
+
+    index = build_vocabulary_index(load_background(annotation, cache_folder, vocabulary='KEGG_Pathway'), 'KEGG_Pathway')
+    results = enrich_batch(index, {'a': ['t1', 't2']}, ['t1', 't2', 't3', 't4', 't5'], 1.01, 1, False)['a']
+    assert results.attrs['tests'] == {'KEGG_Pathway': 2}
+    assert list(results['KEGG_PathwayID']) == ['map00010', 'map00020']
+    # Of the 4 transcripts annotated in the vocabulary, 3 are in map00010 and 2 in map00020
+    np.testing.assert_allclose(results['Pvalue'], [hypergeom.sf(1, 4, 3, 2), hypergeom.sf(0, 4, 2, 2)])
+
+
+def test_columns_without_header(tmp_path):
+    annotation = write_file(tmp_path / 'a.emapper.annotations', 't1\t' + '\t'.join(['-'] * 8) + '\tGO:0000001\n')
+    columns = find_columns(annotation)
+    assert columns['GO'] == 9
+    output = str(tmp_path / 'background.txt')
+    process_eggnog(annotation, output, workers=1)
+    assert read_lines(output) == ['GO:0000001\tIEA\tt1\tGO']
+
+
+def test_header_without_go_column(tmp_path):
+    annotation = write_file(tmp_path / 'a.emapper.annotations', '#query\tseed_ortholog\tPFAMs\nt1\ts1\tPF00001\n')
+    with pytest.raises(ValueError):
+        find_columns(annotation)
+
+
+def test_byte_ranges_end_at_line_boundaries(dataset):
+    ranges = byte_ranges(dataset['annotation'], 4096)
+    assert len(ranges) > 1
+    with open(dataset['annotation'], 'rb') as file:
+        content = file.read()
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(content)
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start and content[end - 1:end] == b'\n'
+
+
+@pytest.mark.parametrize('compression', [None, 'gz', 'zst'])
+def test_blocks_give_the_same_output(dataset, tmp_path, compression):
+    annotation = dataset['annotation']
+    if compression == 'gz':
+        annotation = str(tmp_path / 'synthetic.emapper.annotations.gz')
+        with open(dataset['annotation'], 'rb') as source, gzip.open(annotation, 'wb') as target:
+            shutil.copyfileobj(source, target)
+    elif compression == 'zst':
+        zstandard = pytest.importorskip('zstandard')
+        annotation = str(tmp_path / 'synthetic.emapper.annotations.zst')
+        with open(dataset['annotation'], 'rb') as source, open(annotation, 'wb') as target:
+            zstandard.ZstdCompressor().copy_stream(source, target)
+
+    expected, found = str(tmp_path / 'single.txt'), str(tmp_path / 'blocks.txt')
+    single = process_eggnog(dataset['annotation'], expected, workers=1)
+    # Blocks far smaller than the file, parsed by a pool of worker processes
+    blocks = process_eggnog(annotation, found, workers=2, chunk_size=4096)
+    assert blocks['rows'] == single['rows'] == dataset['config']['n_transcripts']
+    with open(expected, 'rb') as file_expected, open(found, 'rb') as file_found:
+        assert file_found.read() == file_expected.read()
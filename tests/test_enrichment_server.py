@@ -0,0 +1,99 @@
+import json
+import threading
+import http.client
+
+import numpy as np
+import pytest
+
+from go_enrichment import build_annotation_index, enrich_batch
+from enrichment_server import EnrichmentServer, UnixEnrichmentServer, service_connection, query_service
+
+
+@pytest.fixture(scope='module')
+def index(dataset):
+    return build_annotation_index(dataset['background'], dataset['terms'], dataset['alt_ids'])
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def post(server, body):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request('POST', '/enrich', body=body if isinstance(body, str) else json.dumps(body))
+    answer = connection.getresponse()
+    return answer.status, json.loads(answer.read())
+
+
+def test_results_match_the_batch(dataset, index, start_server):
+    server = start_server(EnrichmentServer(('127.0.0.1', 0), {'synthetic': index}, {'category_size': 2}))
+    candidates, universe = dataset['groups'][0]
+    connection = service_connection(f'127.0.0.1:{server.server_address[1]}')
+    response = query_service(connection, {'candidates': candidates, 'universe': universe, 'pvalue_cutoff': 0.05})
+    expected = enrich_batch(index, {'candidates': candidates}, universe, 0.05, 2, True)['candidates']
+    results = response['results']['candidates']
+    assert len(results) == len(expected) > 0
+    assert [record['GO'] for record in results] == list(expected[['GOBPID', 'GOMFID', 'GOCCID']].bfill(axis=1).iloc[:, 0])
+    np.testing.assert_allclose([record['Pvalue'] for record in results], expected['Pvalue'])
+    assert response['background'] == 'synthetic' and not response['cached']
+
+    # The same connection is reused, and the universe is only sent once
+    again = query_service(connection, {'candidates': candidates, 'universe_id': response['universe_id'], 'pvalue_cutoff': 0.05})
+    assert again['cached'] and again['results'] == response['results']
+
+
+def test_least_recently_used_universes_are_evicted(dataset, index, start_server):
+    server = start_server(EnrichmentServer(('127.0.0.1', 0), {'synthetic': index}, max_universes=2))
+    candidates, universe = dataset['groups'][0]
+    universes = [universe, universe[:-10], universe[:-20]]
+    ids = []
+    for i in [0, 1, 0, 2]:
+        status, response = post(server, {'candidates': candidates, 'universe': universes[i]})
+        assert status == 200
+        ids.append(response['universe_id'])
+    # Universe 0 was used again before universe 2 was added, so universe 1 is the one evicted
+    assert post(server, {'candidates': candidates, 'universe_id': ids[0]})[1]['cached']
+    status, response = post(server, {'candidates': candidates, 'universe_id': ids[1]})
+    assert status == 404 and 'Unknown universe' in response['error']
+    assert server.service['counts']['universe_misses'] == 3 and server.service['counts']['universe_hits'] == 2
+    assert len(server.service['universes']) == 2
+
+
+def test_request_errors(dataset, index, start_server):
+    server = start_server(EnrichmentServer(('127.0.0.1', 0), {'a': index, 'b': index}))
+    candidates, universe = dataset['groups'][0]
+    assert post(server, '{not json')[0] == 400
+    assert post(server, [candidates])[0] == 400
+    assert post(server, {'universe': universe, 'background': 'a'})[0] == 400
+    assert post(server, {'candidates': candidates, 'background': 'a'})[0] == 400
+    assert post(server, {'candidate_sets': {'x': 'TRINITY_DN1'}, 'universe': universe, 'background': 'a'})[0] == 400
+    # With several backgrounds, the background must be named
+    status, response = post(server, {'candidates': candidates, 'universe': universe})
+    assert status == 404 and 'a, b' in response['error']
+
+    connection = service_connection(f'127.0.0.1:{server.server_address[1]}')
+    with pytest.raises(RuntimeError):
+        query_service(connection, {'candidates': candidates, 'universe': universe, 'background': 'c'})
+    connection.request('GET', '/status')
+    status = json.loads(connection.getresponse().read())
+    assert status['counts']['requests'] == 7 and set(status['backgrounds']) == {'a', 'b'}
+
+
+def test_unix_socket(dataset, index, start_server, tmp_path):
+    path = str(tmp_path / 'enrichment.sock')
+    start_server(UnixEnrichmentServer(path, {'synthetic': index}, {'category_size': 2}))
+    candidates, universe = dataset['groups'][1]
+    response = query_service(service_connection(path), {'candidate_sets': {'a': candidates, 'b': candidates[:20]}, 'universe': universe})
+    assert sorted(response['results']) == ['a', 'b']
+    assert response['universe_size'] > 0
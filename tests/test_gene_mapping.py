@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from gene_mapping import read_gene_map, load_gene_map, gene_ids, collapse_background
+from go_enrichment import build_annotation_index, enrich_batch
+
+TRINITY = {'rule': 'trinity'}
+
+
+def test_gene_ids(tmp_path):
+    assert gene_ids(TRINITY, ['TRINITY_DN1_c0_g1_i1', 'TRINITY_DN1_c0_g1_i12', 'TRINITY_DN1_c0_g1']) == ['TRINITY_DN1_c0_g1'] * 3
+
+    path = tmp_path / 'gene_trans_map'
+    path.write_text('geneA\tt2\ngeneA\tt1\n\ngeneB\tt3\n')
+    gene_map = load_gene_map(str(path))
+    assert list(gene_map['transcripts']) == [b't1', b't2', b't3']
+    # IDs missing from the map, such as gene IDs, are kept
+    assert gene_ids(gene_map, ['t3', 't1', 'geneA', 't4']) == ['geneB', 'geneA', 'geneA', 't4']
+    assert load_gene_map(None) is None and load_gene_map('trinity') == TRINITY
+
+    path.write_text('geneA\tt1\ngeneB\n')
+    with pytest.raises(ValueError):
+        read_gene_map(str(path))
+
+
+def test_collapsed_background_is_the_union(dataset):
+    background = dataset['background']
+    expected = {}
+    for transcript, start, end in zip(background['transcripts'], background['indptr'][:-1], background['indptr'][1:]):
+        gene = gene_ids(TRINITY, [transcript.decode()])[0]
+        expected.setdefault(gene, [0, set()])
+        expected[gene][0] += 1
+        expected[gene][1].update(background['terms'][background['indices'][start:end]])
+
+    collapsed = collapse_background(background, TRINITY)
+    assert np.char.decode(collapsed['transcripts']).tolist() == sorted(expected)
+    assert len(collapsed['transcripts']) < len(background['transcripts'])
+    for gene, isoforms, start, end in zip(collapsed['transcripts'], collapsed['isoforms'], collapsed['indptr'][:-1], collapsed['indptr'][1:]):
+        terms = collapsed['terms'][collapsed['indices'][start:end]]
+        assert (isoforms, set(terms)) == (expected[gene.decode()][0], expected[gene.decode()][1])
+        assert len(terms) == len(set(terms))
+
+
+def test_isoforms_count_once(dataset):
+    index = build_annotation_index(dataset['background'], dataset['terms'], dataset['alt_ids'], gene_map=TRINITY)
+    isoforms = {}
+    for transcript in np.char.decode(dataset['background']['transcripts']):
+        isoforms.setdefault(gene_ids(TRINITY, [transcript])[0], []).append(transcript)
+    candidates, universe = dataset['groups'][0]
+    genes = sorted(set(gene_ids(TRINITY, candidates)))
+    # Every isoform of the candidate genes, or the gene IDs themselves, give the same test
+    all_isoforms = [transcript for gene in genes for transcript in isoforms.get(gene, [gene])]
+    results = enrich_batch(index, {'genes': genes, 'isoforms': all_isoforms, 'candidates': candidates}, universe, 0.05, 2)
+    assert len(results['genes'])
+    for name in ['isoforms', 'candidates']:
+        pd.testing.assert_frame_equal(results[name], results['genes'])
+    assert results['genes']['Count'].max() <= len(genes)
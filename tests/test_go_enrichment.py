@@ -0,0 +1,141 @@
+from collections import defaultdict
+
+import numpy as np
+import pytest
+from scipy.stats import hypergeom
+
+from go_enrichment import hypergeometric_sf, build_annotation_index, enrich_batch, id_column, ONTOLOGIES
+
+
+def propagated_annotation(dataset):
+    '''
+    Function to propagate the background of the dataset to the ancestor terms with plain Python sets.
+
+    Returns:
+    - annotation: Dictionary with transcript IDs as keys and sets of GO IDs as values
+    - ancestors: Dictionary with GO IDs as keys and sets of their strict ancestors as values
+    '''
+    terms = dataset['terms']
+    ancestors = {}
+
+    def strict_ancestors(go_id):
+        if go_id not in ancestors:
+            ancestors[go_id] = set()
+            for parent in terms[go_id]['parents']:
+                ancestors[go_id] |= {parent} | strict_ancestors(parent)
+        return ancestors[go_id]
+
+    background = dataset['background']
+    transcripts = np.char.decode(background['transcripts'])
+    go_ids = np.char.decode(background['terms'])
+    annotation = {}
+    for row, transcript in enumerate(transcripts):
+        direct = go_ids[background['indices'][background['indptr'][row]:background['indptr'][row + 1]]]
+        annotation[transcript] = {go_id for term in direct for go_id in {term} | strict_ancestors(term)}
+    return annotation, ancestors
+
+
+def reference_enrichment(dataset, candidates, universe, pvalue_cutoff, category_size, conditional):
+    '''
+    Function to compute the results of enrich_batch term by term, as a brute-force reference.
+
+    Returns:
+    - results: Dictionary with (ontology, GO ID) keys and (Count, Size, Pvalue) values
+    '''
+    annotation, ancestors = propagated_annotation(dataset)
+    terms = dataset['terms']
+    results = {}
+    for ontology in ONTOLOGIES:
+        members = defaultdict(set)
+        for transcript in set(universe) & set(annotation):
+            for go_id in annotation[transcript]:
+                if terms[go_id]['namespace'] == ontology:
+                    members[go_id].add(transcript)
+        annotated = set().union(*members.values())
+        selected = set(candidates) & annotated
+
+        # Every term is tested after all its descendants, as the elim test needs
+        children = defaultdict(set)
+        for go_id in members:
+            for parent in terms[go_id]['parents']:
+                children[parent].add(go_id)
+        order, visited = [], set()
+
+        def visit(go_id):
+            if go_id not in visited:
+                visited.add(go_id)
+                for child in sorted(children[go_id]):
+                    visit(child)
+                order.append(go_id)
+
+        for go_id in sorted(members):
+            visit(go_id)
+
+        removed = defaultdict(set)
+        for go_id in order:
+            transcripts = members[go_id] - removed[go_id] if conditional else members[go_id]
+            count = len(transcripts & selected)
+            if count == 0:
+                continue
+            pvalue = hypergeom.sf(count - 1, len(annotated), len(transcripts), len(selected))
+            if conditional and pvalue < pvalue_cutoff:
+                for ancestor in ancestors[go_id]:
+                    removed[ancestor] |= members[go_id]
+            if pvalue < pvalue_cutoff and len(transcripts) >= category_size:
+                results[(ontology, go_id)] = (count, len(transcripts), pvalue)
+    return results
+
+
+def test_hypergeometric_sf_matches_scipy():
+    rng = np.random.default_rng(3)
+    total = 5000
+    size = rng.integers(1, 800, size=2000)
+    selected = rng.integers(1, 800, size=2000)
+    count = np.minimum(rng.integers(1, 200, size=2000), np.minimum(size, selected))
+    expected = hypergeom.sf(count - 1, total, size, selected)
+    np.testing.assert_allclose(hypergeometric_sf(count, total, size, selected), expected, rtol=1e-8, atol=1e-300)
+
+
+def test_hypergeometric_sf_keeps_tiny_pvalues():
+    count = np.array([40, 80, 120])
+    pvalues = hypergeometric_sf(count, 20000, count, 500)
+    np.testing.assert_allclose(pvalues, np.exp(hypergeom.logsf(count - 1, 20000, count, 500)), rtol=1e-6)
+    assert (pvalues > 0).all()
+
+
+@pytest.mark.filterwarnings('error')
+def test_hypergeometric_sf_at_the_lowest_count():
+    # Every selected transcript outside the term would not fit, so at least 672 of them are in it
+    count = np.array([672, 672, 673, 1])
+    size = np.array([1458, 1458, 1458, 1])
+    selected = np.array([2214, 2214, 2214, 3000])
+    np.testing.assert_allclose(hypergeometric_sf(count, 3000, size, selected), hypergeom.sf(count - 1, 3000, size, selected), rtol=1e-8)
+    assert hypergeometric_sf(count, 3000, size, selected)[0] == 1
+
+
+@pytest.mark.parametrize('conditional', [False, True])
+def test_enrichment_matches_brute_force(dataset, conditional):
+    index = build_annotation_index(dataset['background'], dataset['terms'], dataset['alt_ids'])
+    pvalue_cutoff, category_size = 0.05, 2
+    for candidates, universe in dataset['groups']:
+        results = enrich_batch(index, {'group': candidates}, universe, pvalue_cutoff, category_size, conditional)['group']
+        found = {}
+        for ontology in ONTOLOGIES:
+            rows = results[results['Ontology'] == ontology]
+            for go_id, count, size, pvalue in zip(rows[id_column(ontology)], rows['Count'], rows['Size'], rows['Pvalue']):
+                found[(ontology, go_id)] = (count, size, pvalue)
+
+        expected = reference_enrichment(dataset, candidates, universe, pvalue_cutoff, category_size, conditional)
+        assert expected
+        assert set(found) == set(expected)
+        for key, (count, size, pvalue) in expected.items():
+            assert found[key][:2] == (count, size)
+            assert found[key][2] == pytest.approx(pvalue, rel=1e-8)
+
+
+def test_conditional_removes_terms_explained_by_their_children(dataset):
+    index = build_annotation_index(dataset['background'], dataset['terms'], dataset['alt_ids'])
+    candidates, universe = dataset['groups'][0]
+    classic = enrich_batch(index, {'group': candidates}, universe, 0.05, 2)['group']
+    conditional = enrich_batch(index, {'group': candidates}, universe, 0.05, 2, conditional=True)['group']
+    assert len(conditional) < len(classic)
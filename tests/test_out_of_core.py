@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from background_cache import load_background
+from go_enrichment import build_annotation_index, enrich_batch, universe_blocks, universe_mask
+
+# Smallest memory budget (MB), so that the out-of-core index is spilled and tested in several blocks
+MEMORY_BUDGET = 0.001
+
+
+def sorted_results(results):
+    return results.sort_values(list(results.columns), kind='stable').reset_index(drop=True)
+
+
+@pytest.fixture(scope='module')
+def indexes(dataset, tmp_path_factory):
+    folder = tmp_path_factory.mktemp('out_of_core')
+    in_memory = build_annotation_index(dataset['background'], dataset['terms'], dataset['alt_ids'])
+    # The background is also rebuilt out of core, and the spill folder does not exist yet
+    background = load_background(dataset['annotation'], str(folder / 'cache'), memory_budget=MEMORY_BUDGET)
+    out_of_core = build_annotation_index(background, dataset['terms'], dataset['alt_ids'], memory_budget=MEMORY_BUDGET,
+                                         spill_folder=str(folder / 'spill' / 'index'))
+    return in_memory, out_of_core
+
+
+def test_out_of_core_background_matches(dataset, tmp_path):
+    background = load_background(dataset['annotation'], str(tmp_path), memory_budget=MEMORY_BUDGET)
+    for key in ['transcripts', 'terms', 'indptr', 'indices']:
+        np.testing.assert_array_equal(background[key], dataset['background'][key])
+
+
+def test_out_of_core_index_matches(indexes):
+    in_memory, out_of_core = indexes
+    np.testing.assert_array_equal(in_memory['term_size'], out_of_core['term_size'])
+    for ontology in in_memory['ontologies']:
+        assert (in_memory[ontology] != out_of_core[ontology]).nnz == 0
+        assert in_memory['ontology_size'][ontology] == out_of_core['ontology_size'][ontology]
+
+
+@pytest.mark.parametrize('conditional', [False, True])
+def test_out_of_core_enrichment_matches(dataset, indexes, conditional):
+    in_memory, out_of_core = indexes
+    candidate_sets = {f'group{i}': candidates for i, (candidates, _) in enumerate(dataset['groups'])}
+    universe = dataset['groups'][0][1]
+    is_universe = universe_mask(out_of_core, universe)
+    assert len(list(universe_blocks(out_of_core, 'BP', is_universe))) > 1
+
+    expected = enrich_batch(in_memory, candidate_sets, universe, 0.05, 2, conditional)
+    found = enrich_batch(out_of_core, candidate_sets, universe, 0.05, 2, conditional)
+    for name in candidate_sets:
+        assert len(expected[name])
+        pd.testing.assert_frame_equal(sorted_results(found[name]), sorted_results(expected[name]))
+        assert found[name].attrs['tests'] == expected[name].attrs['tests']
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from go_enrichment import build_annotation_index, universe_view, membership_matrix
+from permutation_test import benjamini_hochberg, empirical_test, random_prefixes
+
+
+def reference_qvalues(pvalues, n_tests):
+    '''
+    Function to compute the Benjamini-Hochberg q-values from their definition, q_i = min over p_j >= p_i of
+    p_j * n_tests / rank_j, with the missing tests of the family at p = 1.
+    '''
+    family = np.concatenate([pvalues, np.ones(n_tests - len(pvalues))])
+    ranks = np.argsort(np.argsort(family, kind='stable'), kind='stable') + 1
+    return np.array([min(min(family[j] * n_tests / ranks[j] for j in range(n_tests) if family[j] >= p), 1.0) for p in pvalues])
+
+
+def test_benjamini_hochberg_matches_definition():
+    rng = np.random.default_rng(5)
+    pvalues = np.concatenate([rng.random(40) ** 4, [0.01, 0.01]])
+    np.testing.assert_allclose(benjamini_hochberg(pvalues), reference_qvalues(pvalues, len(pvalues)))
+    np.testing.assert_allclose(benjamini_hochberg(pvalues, 100), reference_qvalues(pvalues, 100))
+
+
+def test_benjamini_hochberg_by_hand():
+    # Sorted p-values 0.01, 0.02, 0.03, 0.5 of 4 tests: 0.04, 0.04, 0.04, 0.5
+    np.testing.assert_allclose(benjamini_hochberg([0.03, 0.5, 0.01, 0.02]), [0.04, 0.5, 0.04, 0.04])
+    # With 8 tests, the 4 missing ones at p = 1
+    np.testing.assert_allclose(benjamini_hochberg([0.03, 0.5, 0.01, 0.02], 8), [0.08, 1.0, 0.08, 0.08])
+
+
+def test_random_prefixes_are_samples_without_replacement():
+    rng = np.random.default_rng(0)
+    for length in [5, 60]:
+        draws = random_prefixes(rng, 100, length, 50)
+        assert draws.shape == (50, length)
+        assert all(len(np.unique(row)) == length for row in draws)
+
+
+@pytest.fixture(scope='module')
+def enrichment_inputs(dataset):
+    index = build_annotation_index(dataset['background'], dataset['terms'], dataset['alt_ids'])
+    universe = dataset['groups'][0][1]
+    view = universe_view(index, universe)
+    membership = membership_matrix(index, [candidates for candidates, _ in dataset['groups']], view['is_universe'])
+    return index, view, membership
+
+
+def test_empirical_qvalues_cover_every_tested_term(enrichment_inputs):
+    index, view, membership = enrichment_inputs
+    category_size = 2
+    results = empirical_test(index, view, membership, 200, category_size, seed=1, workers=1)
+    n_tests = sum(int((view['sizes'][ontology] >= category_size).sum()) for ontology in index['ontologies'])
+    for _, pairs in results.groupby('Set'):
+        assert len(pairs) < n_tests
+        np.testing.assert_allclose(pairs['Qvalue'], reference_qvalues(pairs['EmpiricalPvalue'].to_numpy(), n_tests))
+    assert results['EmpiricalPvalue'].between(1 / 201, 1).all()
+    assert results['EmpiricalPvalue'].min() == pytest.approx(1 / 201)
+
+
+def test_empirical_test_does_not_depend_on_the_workers(enrichment_inputs):
+    index, view, membership = enrichment_inputs
+    single = empirical_test(index, view, membership, 300, 2, seed=3, workers=1)
+    pooled = empirical_test(index, view, membership, 300, 2, seed=3, workers=2)
+    assert single.equals(pooled)
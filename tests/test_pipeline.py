@@ -0,0 +1,92 @@
+import os
+import glob
+import threading
+
+import pytest
+
+from pipeline import run_pipeline, run_tasks, make_task
+
+
+def pool_processes():
+    '''
+    Function to count the worker processes started with 'spawn' by the current process (Linux only), without
+    the resource tracker of multiprocessing.
+    '''
+    count = 0
+    for pid in os.listdir('/proc'):
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as file:
+                parent = int(file.read().rsplit(')', 1)[1].split()[1])
+            with open(f'/proc/{pid}/cmdline', 'rb') as file:
+                cmdline = file.read()
+        except (OSError, ValueError, IndexError):
+            continue
+        if parent == os.getpid() and b'spawn_main' in cmdline:
+            count += 1
+    return count
+
+
+def test_up_to_date_tasks_are_skipped(project):
+    first = run_pipeline(project)
+    assert set(first.values()) == {'done'}
+    second = run_pipeline(project)
+    assert set(second.values()) == {'skipped'}
+
+
+def test_only_the_changed_group_is_run_again(project):
+    run_pipeline(project)
+    with open('data/candidates/group000.candidates.txt', 'r') as file:
+        candidates = file.read().splitlines()
+    with open('data/candidates/group000.candidates.txt', 'w') as file:
+        file.write('\n'.join(candidates[:len(candidates) // 2]) + '\n')
+    status = run_pipeline(project)
+    rerun = {name for name, value in status.items() if value == 'done'}
+    # Groups 0 and 1 share the enrichment batch, only the summaries of group 0 change
+    assert any(name.startswith('enrichment:') for name in rerun)
+    assert any(name.startswith('revigo:group000/') for name in rerun)
+    assert not any(name.startswith(('revigo:group001/', 'plots:group001/', 'revigo:group002/')) for name in rerun)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc'), reason='Counts the processes through /proc')
+def test_processes_stay_within_the_workers(project):
+    parameters = dict(project, workers=3, permutations=20000, permutation_workers=3)
+    run_pipeline(parameters)
+    # In the next run, the plots of group 0 are drawn while the enrichment of group 2 draws its permutations
+    with open('data/candidates/group002.candidates.txt', 'r') as file:
+        candidates = file.read().splitlines()
+    with open('data/candidates/group002.candidates.txt', 'w') as file:
+        file.write('\n'.join(candidates[:len(candidates) // 2]) + '\n')
+    for path in glob.glob('out/group000/*/results_revigo/*barplot*'):
+        os.remove(path)
+
+    peak, running = [0], [True]
+
+    def sample():
+        while running[0]:
+            peak[0] = max(peak[0], pool_processes())
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        status = run_pipeline(parameters)
+    finally:
+        running[0] = False
+        sampler.join()
+    assert status['plots:group000/group000.candidates'] == 'done'
+    assert 0 < peak[0] <= 3
+
+
+def test_failed_task_blocks_its_dependents(tmp_path):
+    calls = []
+
+    def run(name, fail=False):
+        calls.append(name)
+        if fail:
+            raise RuntimeError(name)
+        return []
+
+    tasks = [make_task('a', run, ('a',)), make_task('b', run, ('b', True)), make_task('c', run, ('c',), deps=['b']),
+             make_task('d', run, ('d',), deps=['a']), make_task('e', run, ('e',), deps=['c'], after=['d'])]
+    status = run_tasks(tasks, str(tmp_path / 'state.json'), workers=2)
+    assert status == {'a': 'done', 'b': 'failed', 'c': 'blocked', 'd': 'done', 'e': 'blocked'}
+    assert sorted(calls) == ['a', 'b', 'd']
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from scipy.stats import hypergeom
+
+from go_enrichment import build_annotation_index, index_codes, ONTOLOGIES
+from ranked_enrichment import read_ranked, running_sum_score, ranked_test, ranked_enrichment
+
+
+def reference_running_sum(term_ranks, n_ranked, weights):
+    '''
+    Function to walk the running sum of a term rank by rank and return its maximum deviation from zero.
+    '''
+    hits = set(term_ranks)
+    total = sum(weights[rank] for rank in hits)
+    running, highest, lowest = 0.0, 0.0, 0.0
+    for rank in range(n_ranked):
+        running += weights[rank] / total if rank in hits else -1 / (n_ranked - len(hits))
+        highest, lowest = max(highest, running), min(lowest, running)
+    return highest if highest >= -lowest else lowest
+
+
+@pytest.fixture(scope='module')
+def ranked_inputs(dataset):
+    index = build_annotation_index(dataset['background'], dataset['terms'], dataset['alt_ids'])
+    candidates, universe = dataset['groups'][0]
+    # The candidates, which are enriched in a few terms, at the top of the list
+    rng = np.random.default_rng(2)
+    top = [transcript for transcript in rng.permutation(candidates) if transcript in set(universe)]
+    ranked = top + [transcript for transcript in rng.permutation(universe) if transcript not in set(top)]
+    codes = index_codes(index, ranked)
+    return index, ranked, codes[codes >= 0]
+
+
+def test_read_ranked(tmp_path):
+    path = tmp_path / 'a.ranked.txt'
+    path.write_text('id\tlogFC\nt2\t-2.5\nt1\t1.0\nt2\t3.0\n\nt3\t0.5\n')
+    ids, scores = read_ranked(str(path))
+    assert ids == ['t2', 't1', 't3']
+    np.testing.assert_array_equal(scores, [-2.5, 1.0, 0.5])
+
+    path.write_text('t1\nt2\n')
+    assert read_ranked(str(path)) == (['t1', 't2'], None)
+
+    path.write_text('t1\t1.0\nt2\n')
+    with pytest.raises(ValueError):
+        read_ranked(str(path))
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_running_sum_matches_brute_force(weighted):
+    rng = np.random.default_rng(4)
+    n_ranked = 200
+    weights = rng.random(n_ranked) * 3 if weighted else np.ones(n_ranked)
+    terms = [np.sort(rng.choice(n_ranked, size=size, replace=False)) for size in [1, 5, 30, 199]]
+    # A term at the top and one at the bottom of the list
+    terms += [np.arange(10), np.arange(n_ranked - 10, n_ranked)]
+    indptr = np.concatenate([[0], np.cumsum([len(ranks) for ranks in terms])])
+    scores = running_sum_score(np.concatenate(terms), indptr, n_ranked, weights if weighted else None)
+    expected = [reference_running_sum(ranks, n_ranked, weights) for ranks in terms]
+    np.testing.assert_allclose(scores, expected, rtol=1e-10, atol=1e-12)
+    assert scores[-2] > 0 > scores[-1]
+
+
+def test_mhg_matches_brute_force(ranked_inputs):
+    index, _, codes = ranked_inputs
+    below = 0
+    for ontology in ONTOLOGIES:
+        results = ranked_test(index, ontology, codes, category_size=1)
+        matrix = index[ontology][codes].toarray() > 0
+        matrix = matrix[matrix.any(axis=1)]
+        n_ranked = len(matrix)
+        assert results.attrs['tests'] == int((matrix.sum(axis=0) > 0).sum())
+        for go_id, size, pvalue, mhg, cutoff in zip(results['GO'], results['Size'], results['Pvalue'], results['mHG'], results['Cutoff']):
+            column = matrix[:, index['terms'].get_loc(go_id)]
+            cutoffs = np.arange(1, n_ranked + 1)
+            tails = hypergeom.sf(np.cumsum(column) - 1, n_ranked, column.sum(), cutoffs)
+            assert size == column.sum()
+            # mHG is exact below 1 / K, and the bound K * mHG is 1 otherwise
+            assert pvalue == pytest.approx(min(tails.min() * size, 1.0), rel=1e-8)
+            if tails.min() < 1 / size:
+                below += 1
+                assert mhg == pytest.approx(tails.min(), rel=1e-8)
+                assert cutoff == cutoffs[np.argmin(tails)]
+    assert below > 0
+
+
+def test_max_cutoff_limits_the_prefixes(ranked_inputs):
+    index, ranked, codes = ranked_inputs
+    results = ranked_test(index, 'BP', codes, category_size=1, max_cutoff=50)
+    assert (results['Cutoff'] <= 50).all()
+    combined = ranked_enrichment(index, ranked, pvalue_cutoff=0.05, category_size=2, running_sum=True)
+    assert len(combined) and (combined['Pvalue'] < 0.05).all()
+    assert (combined['EnrichmentScore'] > 0).all()
+    assert set(combined.attrs['tests']) == set(ONTOLOGIES)
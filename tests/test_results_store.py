@@ -0,0 +1,116 @@
+import os
+import json
+import sqlite3
+
+import numpy as np
+import pytest
+
+from results_store import open_store, store_run, query_enrichment, comparison_matrix
+
+RESULTS_HEADER = 'Ontology\tGOBPID\tPvalue\tOddsRatio\tExpCount\tCount\tSize\tTerm\tGOMFID\tGOCCID\n'
+
+
+def write_group(folder, name, rows, tests, clusters=None):
+    '''
+    Function to write the results files of a group as the pipeline does, with rows of (ontology, GO ID, p-value,
+    odds ratio, count), and return its *_IDs_Pvalues.txt file.
+    '''
+    os.makedirs(folder / name / 'results_revigo', exist_ok=True)
+    prefix = str(folder / name / f'{name}_0.05')
+    with open(prefix + '.txt', 'w') as file:
+        file.write(RESULTS_HEADER)
+        for ontology, go_id, pvalue, odds_ratio, count in rows:
+            ids = [go_id if ontology == column else 'NA' for column in ['BP', 'MF', 'CC']]
+            file.write(f'{ontology}\t{ids[0]}\t{pvalue}\t{odds_ratio}\t1.5\t{count}\t10\tterm {go_id}\t{ids[1]}\t{ids[2]}\n')
+    with open(prefix + '_IDs_Pvalues.txt', 'w') as file:
+        file.write(''.join(f'{go_id} {pvalue}\n' for _, go_id, pvalue, _, _ in rows))
+    with open(prefix + '_tests.json', 'w') as file:
+        json.dump(tests, file)
+    if clusters:
+        with open(str(folder / name / 'results_revigo' / f'{name}_0.05_IDs_Pvalues_BP_scatterPlot.tsv'), 'w') as file:
+            file.write('TermID\tName\tValue\tLogSize\tFrequency\tUniqueness\tDispensability\tPC_0\tPC_1\tRepresentative\n')
+            for go_id, representative in clusters:
+                file.write(f'"{go_id}"\t"term {go_id}"\t-2\t1\t0.5\t0.9\t0.1\t0.0\t0.0\t{representative}\n')
+    return prefix + '_IDs_Pvalues.txt'
+
+
+@pytest.fixture
+def store(tmp_path):
+    output_folder = tmp_path / 'out'
+    first = write_group(output_folder, 'a', [('BP', 'GO:0000001', 0.001, 'Inf', 3), ('MF', 'GO:0000002', 0.02, 4.5, 2)],
+                        {'BP': 40, 'MF': 30, 'CC': 0}, clusters=[('GO:0000001', 'null'), ('GO:0000003', 1)])
+    second = write_group(output_folder, 'b', [('BP', 'GO:0000001', 0.04, 2.0, 2), ('CC', 'GO:0000004', 0.0001, 10.0, 5)],
+                         {'BP': 20, 'MF': 0, 'CC': 25})
+    store_file = str(tmp_path / 'results.sqlite')
+    groups = [('a', 'a.candidates.txt', 'candidates', first, 'x.emapper.annotations'),
+              ('b', 'b.candidates.txt', 'candidates', second, 'x.emapper.annotations'),
+              ('c', 'c.candidates.txt', 'candidates', None, 'x.emapper.annotations')]
+    store_run(store_file, str(output_folder), {'output_folder': str(output_folder)}, groups)
+    return store_file, output_folder, groups
+
+
+def test_round_trip(store):
+    store_file, output_folder, _ = store
+    results = query_enrichment(store_file)
+    assert list(results['GO']) == ['GO:0000004', 'GO:0000001', 'GO:0000002', 'GO:0000001']
+    assert list(results['Group']) == ['b', 'a', 'a', 'b']
+    np.testing.assert_allclose(results['Pvalue'], [0.0001, 0.001, 0.02, 0.04])
+    assert np.isinf(results['OddsRatio'][1]) and list(results['Count']) == [5, 3, 2, 2]
+    assert list(results['Term']) == [f'term {go_id}' for go_id in results['GO']]
+    assert set(results['output_folder']) == {os.path.abspath(output_folder)}
+    # Columns of tests that were not run are left out
+    assert 'mHG' not in results.columns and 'GlobalQvalue' not in results.columns
+
+    connection = open_store(store_file)
+    try:
+        groups = connection.execute('SELECT name, tests, results_file FROM groups ORDER BY name').fetchall()
+        clusters = connection.execute('SELECT GO, Representative FROM clusters ORDER BY GO').fetchall()
+    finally:
+        connection.close()
+    assert [(name, json.loads(tests)) for name, tests, _ in groups[:2]] == [('a', {'BP': 40, 'MF': 30, 'CC': 0}), ('b', {'BP': 20, 'MF': 0, 'CC': 25})]
+    assert groups[2][2] is None
+    assert clusters == [('GO:0000001', None), ('GO:0000003', 'GO:0000001')]
+
+
+def test_queries(store):
+    store_file, _, _ = store
+    assert list(query_enrichment(store_file, go_ids=['GO:0000001'])['Group']) == ['a', 'b']
+    assert list(query_enrichment(store_file, max_pvalue=0.001)['GO']) == ['GO:0000004', 'GO:0000001']
+    assert list(query_enrichment(store_file, groups=['b'], ontology='BP')['GO']) == ['GO:0000001']
+    assert query_enrichment(store_file, go_ids=['GO:9999999']).empty
+
+
+def test_latest_runs(store, tmp_path):
+    store_file, output_folder, groups = store
+    # A new run of the same output folder, where group a has a single result, and a run of another folder
+    write_group(output_folder, 'a', [('BP', 'GO:0000005', 0.003, 1.0, 2)], {'BP': 40})
+    store_run(store_file, str(output_folder), {}, groups[:1])
+    other = write_group(tmp_path / 'other', 'd', [('BP', 'GO:0000001', 0.01, 1.0, 2)], {'BP': 40})
+    store_run(store_file, str(tmp_path / 'other'), {}, [('d', 'd.candidates.txt', 'candidates', other, None)])
+
+    latest = query_enrichment(store_file)
+    assert sorted(zip(latest['run_id'], latest['Group'], latest['GO'])) == [(2, 'a', 'GO:0000005'), (3, 'd', 'GO:0000001')]
+    assert set(query_enrichment(store_file, run_id=1)['Group']) == {'a', 'b'}
+    assert len(query_enrichment(store_file, all_runs=True)) == 6
+
+
+def test_comparison_matrix(store):
+    store_file, _, _ = store
+    matrix = comparison_matrix(store_file, ontology='BP')
+    assert list(matrix.columns) == ['GO:0000001 term GO:0000001']
+    np.testing.assert_allclose(matrix.iloc[:, 0], [3, -np.log10(0.04)])
+    assert comparison_matrix(store_file, ontology='BP', max_pvalue=0.01).shape == (1, 1)
+    assert comparison_matrix(store_file, ontology='KEGG_Pathway').empty
+
+
+def test_older_stores_get_the_new_columns(tmp_path):
+    store_file = str(tmp_path / 'results.sqlite')
+    connection = sqlite3.connect(store_file)
+    connection.execute('CREATE TABLE groups (group_id INTEGER PRIMARY KEY, run_id INTEGER, name TEXT, source TEXT, kind TEXT, results_file TEXT)')
+    connection.close()
+    connection = open_store(store_file)
+    try:
+        assert {'annotation', 'tests'} <= {row[1] for row in connection.execute('PRAGMA table_info(groups)')}
+        assert 'GlobalQvalue' in {row[1] for row in connection.execute('PRAGMA table_info(enrichment)')}
+    finally:
+        connection.close()
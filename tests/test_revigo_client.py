@@ -0,0 +1,75 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from revigo_client import revigo_results, NAMESPACES, RESULT_TYPES
+from revigo_stub_server import RevigoStubServer
+
+GO_LIST = 'GO:0008150 0.001\nGO:0003674 0.01\n'
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(**kwargs):
+        server = RevigoStubServer(('127.0.0.1', 0), running_polls=1, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_results_of_every_namespace(start_server, tmp_path):
+    server = start_server()
+    results = revigo_results(GO_LIST, base_url=server.url, cache_folder=str(tmp_path))
+    assert sorted(results) == [str(ns) for ns in NAMESPACES]
+    for ns in NAMESPACES:
+        assert sorted(results[str(ns)]) == sorted(RESULT_TYPES)
+        assert 'GO:0008150' in results[str(ns)]['table']
+    assert server.counts['StartJob'] == 1
+    assert server.counts['table'] == len(NAMESPACES)
+
+
+def test_results_are_cached(start_server, tmp_path):
+    server = start_server()
+    first = revigo_results(GO_LIST, base_url=server.url, cache_folder=str(tmp_path))
+    requests = server.counts['requests']
+    assert revigo_results(GO_LIST, base_url=server.url, cache_folder=str(tmp_path)) == first
+    assert server.counts['requests'] == requests
+    assert len(os.listdir(tmp_path)) == 1
+
+    # Another cutoff is another job
+    revigo_results(GO_LIST, cutoff='0.5', base_url=server.url, cache_folder=str(tmp_path))
+    assert server.counts['StartJob'] == 2
+
+
+def test_concurrent_calls_submit_one_job(start_server, tmp_path):
+    server = start_server()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: revigo_results(GO_LIST, base_url=server.url, cache_folder=str(tmp_path)), range(4)))
+    assert all(result == results[0] for result in results)
+    assert server.counts['StartJob'] == 1
+
+
+def test_unavailable_server_is_retried(start_server, tmp_path):
+    # The first answers are 503 errors, to the job submission and then to the polls
+    server = start_server(fail_first=3)
+    results = revigo_results(GO_LIST, base_url=server.url, cache_folder=str(tmp_path))
+    assert 'GO:0008150' in results['1']['table']
+    assert server.counts['failed'] == 3
+    assert server.counts['StartJob'] == 1
+
+
+def test_error_answers_are_not_cached(start_server, tmp_path, monkeypatch):
+    server = start_server()
+    monkeypatch.setattr('revigo_stub_server.canned_output', lambda result_type, terms, namespace: 'error: job failed\n')
+    results = revigo_results(GO_LIST, base_url=server.url, cache_folder=str(tmp_path))
+    assert 'error' in results['1']['table']
+    assert not os.path.exists(tmp_path) or not os.listdir(tmp_path)
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from go_enrichment import build_annotation_index
+from semantic_clustering import simrel_matrix, dispensability, representatives, cluster_terms, GENERAL_TERM_FREQUENCY
+
+
+def reference_dispensability(similarity, frequency, pvalues, is_child):
+    '''
+    Function to run the REVIGO greedy procedure by rescanning every remaining pair at each step.
+    '''
+    n_terms = len(pvalues)
+    remaining = similarity.astype(float).copy()
+    np.fill_diagonal(remaining, -np.inf)
+    dispensabilities, rejected_by = np.zeros(n_terms), np.full(n_terms, -1)
+    for _ in range(n_terms - 1):
+        first, second = np.unravel_index(np.argmax(remaining), remaining.shape)
+        general = frequency[[first, second]] > GENERAL_TERM_FREQUENCY
+        if general.any() and not general.all():
+            rejected = first if general[0] else second
+        elif general.all() and frequency[first] != frequency[second]:
+            rejected = first if frequency[first] > frequency[second] else second
+        elif pvalues[first] != pvalues[second]:
+            rejected = first if pvalues[first] > pvalues[second] else second
+        else:
+            rejected = first if is_child[first, second] else second
+        dispensabilities[rejected] = remaining[first, second]
+        rejected_by[rejected] = second if rejected == first else first
+        remaining[rejected, :] = remaining[:, rejected] = -np.inf
+    return dispensabilities, rejected_by
+
+
+@pytest.fixture(scope='module')
+def index(dataset):
+    return build_annotation_index(dataset['background'], dataset['terms'], dataset['alt_ids'])
+
+
+def test_simrel_matches_brute_force(index):
+    codes = np.flatnonzero((index['dag']['namespace'] == 'BP') & (index['term_size'] > 0))[:40]
+    similarity, frequency = simrel_matrix(index, codes)
+    p = index['term_size'] / index['ontology_size']['BP']
+    np.testing.assert_allclose(frequency, p[codes])
+    ancestors = [set(index['ancestors'][code].indices) | {code} for code in codes]
+    for i, first in enumerate(codes):
+        for j, second in enumerate(codes):
+            if i == j:
+                assert similarity[i, j] == 1
+                continue
+            # Most informative common ancestor, the root (p = 1) has no information
+            common = [ancestor for ancestor in ancestors[i] & ancestors[j] if p[ancestor] < 1]
+            mica = min(p[common]) if common else 1.0
+            expected = 2 * np.log(mica) / (np.log(p[first]) + np.log(p[second])) * (1 - mica)
+            assert similarity[i, j] == pytest.approx(expected, abs=1e-12)
+    assert (similarity > 0).sum() > len(codes)
+
+
+def test_dispensability_matches_full_rescans():
+    rng = np.random.default_rng(6)
+    n_terms = 60
+    similarity = rng.random((n_terms, n_terms))
+    similarity = (similarity + similarity.T) / 2
+    np.fill_diagonal(similarity, 1.0)
+    frequency = rng.random(n_terms) * 0.1
+    # Ties of the p-values and the frequencies, to go through every rule
+    pvalues = rng.choice([1e-5, 1e-3, 0.01], n_terms)
+    frequency[:10] = 0.2
+    is_child = np.triu(rng.random((n_terms, n_terms)) < 0.1, 1)
+    found = dispensability(similarity, frequency, pvalues, is_child)
+    expected = reference_dispensability(similarity, frequency, pvalues, is_child)
+    np.testing.assert_array_equal(found[1], expected[1])
+    np.testing.assert_allclose(found[0], expected[0])
+
+
+def test_dispensability_rules():
+    similarity = np.array([[1, 0.9, 0.2], [0.9, 1, 0.5], [0.2, 0.5, 1]])
+    pvalues = np.array([1e-3, 1e-5, 1e-4])
+    dispensabilities, rejected_by = dispensability(similarity, np.full(3, 0.01), pvalues, np.zeros((3, 3), dtype=bool))
+    # Term 0 has the worse p-value of the most similar pair, then term 2 is rejected by term 1
+    np.testing.assert_allclose(dispensabilities, [0.9, 0, 0.5])
+    np.testing.assert_array_equal(rejected_by, [1, -1, 1])
+    # A general term is rejected first, whatever its p-value
+    _, rejected_by = dispensability(similarity, np.array([0.01, 0.5, 0.01]), pvalues, np.zeros((3, 3), dtype=bool))
+    assert rejected_by[1] == 0
+    # With the same p-values, the child is rejected
+    is_child = np.array([[0, 0, 0], [1, 0, 0], [0, 0, 0]], dtype=bool)
+    _, rejected_by = dispensability(similarity, np.full(3, 0.01), np.full(3, 0.01), is_child)
+    assert rejected_by[1] == 0
+
+
+def test_representatives_follow_the_rejections():
+    # Term 0 was rejected by term 1 (at 0.9), itself rejected by term 2 (at 0.8)
+    dispensabilities, rejected_by = np.array([0.9, 0.8, 0.0]), np.array([1, 2, -1])
+    np.testing.assert_array_equal(representatives(dispensabilities, rejected_by, 0.7), [2, 2, -1])
+    np.testing.assert_array_equal(representatives(dispensabilities, rejected_by, 0.85), [1, -1, -1])
+    np.testing.assert_array_equal(representatives(dispensabilities, rejected_by, 0.95), [-1, -1, -1])
+
+
+def test_cluster_terms_cut(index):
+    codes = np.flatnonzero((index['dag']['namespace'] == 'BP') & (index['term_size'] > 0))
+    go_ids = list(index['terms'][codes])
+    pvalues = np.random.default_rng(1).random(len(go_ids)) * 0.01
+    table, treemap = cluster_terms(index, go_ids + ['GO:9999999'], list(pvalues) + [1e-3], 'BP', cutoff=0.4)
+    assert sorted(table['TermID']) == sorted(go_ids)
+    removed = table['Dispensability'] > 0.4
+    assert removed.any() and not removed.all()
+    assert table.loc[removed, 'Representative'].notna().all() and table.loc[~removed, 'Representative'].isna().all()
+    kept_ids = {int(term.split(':')[1]) for term in table.loc[~removed, 'TermID']}
+    assert set(table.loc[removed, 'Representative']) <= kept_ids
+    assert table.loc[~removed, ['PC_0', 'PC_1']].notna().all().all()
+    assert sorted(treemap['TermID']) == sorted(table.loc[~removed, 'TermID'])
@@ -0,0 +1,74 @@
+import os
+import glob
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from permutation_test import benjamini_hochberg
+from pipeline import run_pipeline
+from shards import parse_shard, shard_of, select_shard, global_qvalues, merge_shards, shard_folder, MANIFEST_FILE
+
+# Groups 0 and 1 fall in shard 3 of 3, group 2 in shard 1, and shard 2 has no groups
+N_SHARDS = 3
+
+
+def test_parse_shard():
+    assert parse_shard('3/16') == (3, 16)
+    for text in ['0/4', '5/4', '3', 'a/b']:
+        with pytest.raises(ValueError):
+            parse_shard(text)
+
+
+def test_select_shard_splits_the_groups():
+    grouped_files = {f'group{i:03d}': [f'group{i:03d}.candidates.txt'] for i in range(40)}
+    selected = [select_shard(grouped_files, {}, shard, 4)[0] for shard in range(1, 5)]
+    assert sum(len(files) for files in selected) == len(grouped_files)
+    assert set().union(*selected) == set(grouped_files)
+    assert all(shard_of(group, 4) == shard for shard, files in enumerate(selected, 1) for group in files)
+
+
+def test_global_qvalues_by_family(tmp_path):
+    files = [str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')]
+    pd.DataFrame({'Ontology': ['BP', 'KEGG_Pathway', 'MF'], 'Pvalue': [0.01, 0.002, 0.03]}).to_csv(files[0], sep='\t', index=False)
+    pd.DataFrame({'Ontology': ['CC', 'KEGG_Pathway'], 'Pvalue': [0.02, 0.04]}).to_csv(files[1], sep='\t', index=False)
+    qvalues = global_qvalues(files, {'GO': 10, 'KEGG_Pathway': 4})
+    # The GO ontologies are one family of 10 tests, KEGG_Pathway another of 4
+    go = benjamini_hochberg([0.01, 0.03, 0.02], 10)
+    kegg = benjamini_hochberg([0.002, 0.04], 4)
+    np.testing.assert_allclose(qvalues[0], [go[0], kegg[0], go[1]])
+    np.testing.assert_allclose(qvalues[1], [go[2], kegg[1]])
+
+
+def test_merged_shards_match_one_run(project):
+    assert sorted(shard_of(f'group{i:03d}', N_SHARDS) for i in range(3)) == [1, 3, 3]
+    run_pipeline(dict(project, output_folder='single'))
+    for shard in range(1, N_SHARDS + 1):
+        assert 'failed' not in run_pipeline(project, shard=(shard, N_SHARDS)).values()
+    summary = merge_shards(project)
+
+    tests, pvalues, qvalues = 0, [], []
+    single_files = sorted(glob.glob('single/group*/*/*_0.05.txt'))
+    assert len(single_files) == 3
+    for single_file in single_files:
+        merged_file = os.path.join('out', os.path.relpath(single_file, 'single'))
+        single = pd.read_csv(single_file, sep='\t', dtype=str, keep_default_na=False)
+        merged = pd.read_csv(merged_file, sep='\t', dtype=str, keep_default_na=False)
+        pd.testing.assert_frame_equal(merged.drop(columns='GlobalQvalue'), single)
+        pvalues.append(single['Pvalue'].to_numpy(dtype=float))
+        qvalues.append(merged['GlobalQvalue'].to_numpy(dtype=float))
+        with open(single_file[:-len('.txt')] + '_tests.json', 'r') as file:
+            tests += sum(json.load(file).values())
+
+    assert summary['shards'] == N_SHARDS and summary['files'] == 3
+    assert summary['tests'] == {'GO': tests}
+    np.testing.assert_allclose(np.concatenate(qvalues), benjamini_hochberg(np.concatenate(pvalues), tests), rtol=1e-12)
+
+
+def test_incomplete_shards_are_not_merged(project):
+    for shard in range(1, N_SHARDS + 1):
+        run_pipeline(project, shard=(shard, N_SHARDS))
+    os.remove(os.path.join(shard_folder('out', 3, N_SHARDS), MANIFEST_FILE))
+    with pytest.raises(RuntimeError, match='Shards 3 of 3'):
+        merge_shards(project)
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from semantic_clustering import TREEMAP_HEADER
+from treemap_generator import squarify, worst_ratio, read_treemap, treemap_layout, create_treemap
+
+
+def overlap(first, second):
+    width = min(first[0] + first[2], second[0] + second[2]) - max(first[0], second[0])
+    height = min(first[1] + first[3], second[1] + second[3]) - max(first[1], second[1])
+    return max(width, 0) * max(height, 0)
+
+
+def check_tiling(rects, values, x, y, width, height):
+    '''
+    Function to check that the rectangles fill the given rectangle without overlapping, with areas
+    proportional to the values. Rectangles of non-positive values have no area and no position.
+    '''
+    values = np.clip(np.asarray(values, dtype=float), 0, None)
+    np.testing.assert_allclose(rects[:, 2] * rects[:, 3], values * width * height / values.sum(), atol=1e-9)
+    rects = rects[values > 0]
+    assert (rects[:, 0] >= x - 1e-9).all() and (rects[:, 0] + rects[:, 2] <= x + width + 1e-9).all()
+    assert (rects[:, 1] >= y - 1e-9).all() and (rects[:, 1] + rects[:, 3] <= y + height + 1e-9).all()
+    for i in range(len(rects)):
+        for j in range(i):
+            assert overlap(rects[i], rects[j]) < 1e-9
+
+
+def test_squarify_example_of_the_paper():
+    # The example of Bruls, Huizing and van Wijk (2000): the two 6 stacked in the first column, then 4 and 3 in a row
+    rects = squarify([6, 6, 4, 3, 2, 2, 1], 0, 0, 6, 4)
+    np.testing.assert_allclose(rects[:4], [[0, 0, 3, 2], [0, 2, 3, 2], [3, 0, 12 / 7, 7 / 3], [3 + 12 / 7, 0, 9 / 7, 7 / 3]])
+    check_tiling(rects, [6, 6, 4, 3, 2, 2, 1], 0, 0, 6, 4)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_squarify_tiles_the_rectangle(seed):
+    rng = np.random.default_rng(seed)
+    values = rng.pareto(1.5, 40) + 0.01
+    values[:3] = [0, -1, 0]
+    rects = squarify(values, 2, 1, 16, 9)
+    check_tiling(rects, values, 2, 1, 16, 9)
+    assert (rects[:3] == 0).all()
+    # Each row stops when the next rectangle would worsen its worst aspect ratio, so the rectangles stay close to squares
+    ratios = np.maximum(rects[3:, 2] / rects[3:, 3], rects[3:, 3] / rects[3:, 2])
+    assert np.median(ratios) < 3
+
+
+def test_worst_ratio():
+    assert worst_ratio([4], 2) == 1
+    assert worst_ratio([6, 6], 4) == pytest.approx(1.5)
+
+
+def test_treemap_layout(tmp_path):
+    path = tmp_path / 'a_TreeMap.tsv'
+    rows = [('GO:0000001', 'a', -3.0, None), ('GO:0000002', 'b', -2.0, 'a'), ('GO:0000003', 'c', -1.5, None), ('GO:0000004', 'd', -1.0, 'c')]
+    path.write_text(TREEMAP_HEADER + 'TermID\tName\tFrequency\tValue\tUniqueness\tDispensability\tRepresentative\n' +
+                    ''.join(f'"{term}"\t"{name}"\t1.0\t{value}\t0.9\t0.1\t{representative or "null"}\n' for term, name, value, representative in rows))
+    data = read_treemap(str(path))
+    assert list(data['Group']) == ['a', 'a', 'c', 'c']
+    np.testing.assert_allclose(data['Value'], [3, 2, 1.5, 1])
+
+    groups, terms = treemap_layout(data, 16, 9)
+    assert list(groups['Group']) == ['a', 'c']
+    check_tiling(groups[['x', 'y', 'width', 'height']].to_numpy(), [5, 2.5], 0, 0, 16, 9)
+    for _, group in groups.iterrows():
+        members = terms[terms['Group'] == group['Group']]
+        check_tiling(members[['x', 'y', 'width', 'height']].to_numpy(), members['Value'], group['x'], group['y'], group['width'], group['height'])
+
+    outputs = create_treemap(str(path), 'BP', str(tmp_path / 'a_treemap.pdf'), html_file=str(tmp_path / 'html' / 'a_treemap.html'))
+    assert [os.path.basename(output) for output in outputs] == ['a_treemap.pdf', 'a_treemap.png', 'a_treemap.html']
+    assert all(os.path.getsize(output) for output in outputs)